@@ -11,8 +11,10 @@
 """
 
 import os
-import shutil
-import wave
+import signal
+import subprocess
+import tempfile
+import time
 import re
 
 try:
@@ -20,19 +22,38 @@ try:
 except:
     import json
 
-# for converting numbers to words
-import inflect
-import jsonschema
-import click
-import tgt
-
 # this may only work when this is run from the command line
 this_dir = os.path.dirname(os.path.realpath(__file__))
 
-TRANSCRIPT_SCHEMA = json.load(open(os.path.join(this_dir, "alignment-schemas/transcript_schema.json")))
-ALIGNMENT_SCHEMA = json.load(open(os.path.join(this_dir, "alignment-schemas/alignment_schema.json")))
+from . import schemas
+from . import metrics
+from .dictionary import DictionaryIndex, load_dictionary
+from .numerals import NumberPronouncer
+from .audio import prepare_wav, link_or_copy, wav_info
+from . import decoder
+from .features import default_feature_cache
+from .mlf import read_aligned_mlf
+from .normalize import iter_words
+from .export import EXTENSIONS, export_alignment
+from .alignment import Alignment
+
+# total acoustic score of a file in HVite's output
+acPat = re.compile(r"\[Ac=(-?[\d.]+(?:e[-+]?\d+)?)")
+
+
+MODEL_DIR = os.path.join(this_dir, "model")
+HTK_BIN = os.environ.get("P2FA_HTK_BIN", "/home/wenhao/software/bin")
+
+# sample rates for which there are acoustic models set up, otherwise
+# the signal must be resampled to one of these rates.
+SR_MODELS = [8000, 11025, 16000]
+
+# "native" aligns in this process (decoder.py) instead of running HVite
+DECODER = os.environ.get("P2FA_DECODER", "hvite")
 
-from .pronunciation import Pronounce
+# HVite beam widths (-t) to try in turn, from a tight and fast search to no
+# pruning at all (0); only files that fail to align are retried with the next one
+VITERBI_BEAMS = [float(b) for b in os.environ.get("P2FA_VITERBI_BEAMS", "250,1000,0").split(",")]
 
 
 class GlobalMap:
@@ -45,68 +66,56 @@ class GlobalMap:
         self.global_lineidx_map = []
 
 
-def prep_wav(orig_wav, out_wav, sr_override, sr_models, wave_start, wave_end):
-    if os.path.exists(out_wav) and False:
-        f = wave.open(out_wav, 'r')
-        SR = f.getframerate()
-        f.close()
-        # print("Already re-sampled the wav file to " + str(SR))
-        return SR
+def target_sr(orig_wav, sr_override, sr_models, wave_start, wave_end):
+    # the sample rate prep_wav will give orig_wav, and whether it has to be converted
+    SR, nframes = wav_info(orig_wav)
 
-    f = wave.open(orig_wav, 'r')
-    SR = f.getframerate()
-    f.close()
+    trim = float(wave_start) != 0.0 or wave_end != None
 
-    soxopts = ""
-    if float(wave_start) != 0.0 or wave_end != None:
-        soxopts += " trim " + wave_start
-        if wave_end != None:
-            soxopts += " " + str(float(wave_end) - float(wave_start))
-
-    if (sr_models != None and SR not in sr_models) or (sr_override != None and SR != sr_override) or soxopts != "":
+    if (sr_models != None and SR not in sr_models) or (sr_override != None and SR != sr_override) or trim:
         new_sr = 11025
         if sr_override != None:
             new_sr = sr_override
+        return new_sr, True
+    return SR, False
+
 
-        # print("Resampling wav file from " + str(SR) + " to " + str(new_sr) + soxopts + "...")
-        SR = new_sr
-        # print("sox " + orig_wav + " -r " + str(SR) + " " + out_wav + "" + soxopts)
-        os.system("sox " + orig_wav + " -r " + str(SR) + " " + out_wav + "" + soxopts)
+def prep_wav(orig_wav, out_wav, sr_override, sr_models, wave_start, wave_end):
+    SR, convert = target_sr(orig_wav, sr_override, sr_models, wave_start, wave_end)
+
+    if convert:
+        # resample and trim in process, a block at a time
+        prepare_wav(orig_wav, out_wav, SR, float(wave_start), None if wave_end == None else float(wave_end))
     else:
-        # os.system("cp -f " + orig_wav + " " + out_wav)
-        shutil.copy(orig_wav, out_wav)
+        # HCopy only reads it, so link rather than copy
+        link_or_copy(orig_wav, out_wav)
 
     return SR
 
 
-def prep_mlf(trsfile, mlffile, word_dictionary, surround, between, file_name, global_map, dialog_file = False):
-    dict_tmp = {}
+def prep_mlf(trsfile, mlffile, word_dictionary, surround, between, file_name, global_map, dialog_file = False,
+             dict_tmp_file = "dict.tmp"):
+    # words missing from the dictionary, resolved together once the transcript is read
+    oov_words = []
+    oov_seen = set()
 
-    infl = inflect.engine()
-
-    # Read in the dictionary to ensure all of the words
-    # we put in the MLF file are in the dictionary. Words
-    # that are not are skipped with a warning.
-    f = open(word_dictionary, 'r')
-    dictionary = {}  # build hash table
-    for line in f.readlines():
-        if line != "\n" and line != "":
-            dictionary[line.split()[0]] = True
-    f.close()
+    # Use the compiled dictionary index to check that all of the
+    # words we put in the MLF file are in the dictionary. Words
+    # that are not get a pronunciation from Pronounce.
+    if isinstance(word_dictionary, DictionaryIndex):
+        dictionary = word_dictionary
+    else:
+        dictionary = DictionaryIndex.load([word_dictionary])
 
     speakers = None
     emotions = None
 
     if dialog_file:
-        dialog = json.load(open(trsfile, 'r'))
+        with open(trsfile, 'r') as f:
+            dialog = json.load(f)
 
         # make sure this is a valid transcript
-        try:
-            jsonschema.validate(dialog, TRANSCRIPT_SCHEMA)
-        except jsonschema.ValidationError as e:
-            # print("Input transcript file is not in the proper format.\nSee alignment-schemas/transcript_schema.json "
-            #       "or https://github.com/srubin/p2fa-steve")
-            raise e
+        schemas.validate("transcript", dialog)
 
         lines = [dl["line"] for dl in dialog]
         speakers = [dl["speaker"] for dl in dialog]
@@ -122,126 +131,26 @@ def prep_mlf(trsfile, mlffile, word_dictionary, surround, between, file_name, gl
     if surround != None:
         words += surround.split(',')
 
-    i = 0
-
-    # this pattern matches hyphenated words, such as TWENTY-TWO; however, it doesn't work with longer things like SOMETHING-OR-OTHER
-    hyphenPat = re.compile(r'([a-zA-Z]+)-([a-zA-Z]+)')
-
-    while (i < len(lines)):
-        txt = lines[i].replace('\n', '')
-        txt = txt.replace('{br}', '{BR}').replace('&lt;noise&gt;', '{NS}')
-        txt = txt.replace('{laugh}', '{LG}').replace('{laughter}', '{LG}')
-        txt = txt.replace('{cough}', '{CG}').replace('{lipsmack}', '{LS}')
-
-        for pun in [',', '.', ':', ';', '!', '?', '"', '%', '(', ')', '-', '--', '---']:
-            if txt.startswith(pun + ' '):
-                txt = txt[2:]
-
-            # remove hanging punctuation before we get started
-            txt = txt.replace(' ' + pun + ' ', ' ')
-
-        hyph_punct = re.compile(r"(-[-]+[,\.:;!\?\"%\(\)-]*)")
-        txt = hyph_punct.sub(r"\1 ", txt)
-
-        txt = re.sub(r"([A-Za-z])\.\.\.([A-Za-z])", r"\1... \2", txt)
-
-        txt_with_pun = txt.split()
-
-        for pun in ['...']:
-            txt = txt.replace(pun, '')
-
-        for pun in [',', '.', ':', ';', '!', '?', '"', '%', '(', ')', '--', '---']:
-            txt = txt.replace(pun, '')
-
-        txt = re.sub('\s+', ' ', txt)
-        txt = re.sub(r"\s'", " ", txt)
-
-        txt = txt.split()
-
-        if (len(txt) != len(txt_with_pun)):
-            # Try not to use hyphenated words either, if at all possible!
-            import pdb;
-            pdb.set_trace()
-            raise Exception("Floating punctuation! Remove this from your transcript.")
-
-        for w_idx, wrd in enumerate(txt):
-            # break up any hyphenated words into two separate words
-            new_wrd = re.sub(hyphenPat, r'\1 \2', wrd)
-            new_wrd = new_wrd.split()
-
-            gwm_entry = [txt_with_pun[w_idx]]
-
-            new_up_wrd = [x.upper() for x in new_wrd]
-            # print new_wrd
-            # print new_up_wrd
-            for wrd2 in new_up_wrd:
-                if (wrd2 not in dictionary) and (wrd2 not in dict_tmp):
-                    # print(wrd2)
-                    try:
-                        if wrd2[-1] in ['s', 'S']:
-                            twrd2 = int(wrd2[:-1])
-                        else:
-                            twrd2 = int(wrd2)
-                        num2wrd = infl.number_to_words(twrd2, andword = '', threshold = 1000)
-
-                        if len(str(twrd2)) == 4 and 1000 < twrd2 < 2000:
-                            # this is probably a year
-                            year1 = str(twrd2)[:2]
-                            year2 = str(twrd2)[2:]
-
-                            year1word = infl.number_to_words(int(year1), andword = '', threshold = 1000)
-                            year2word = infl.number_to_words(int(year2), andword = '', threshold = 1000)
-
-                            extraword = None
-                            if year2 == "00":
-                                year2word = "HUNDRED"
-                            elif year2[0] == "0":
-                                extraword = "OH"
-                                year2word = infl.number_to_words(int(year2[1]), andword = '', threshold = 1000)
-
-                            year_all_words = [year1word, year2word]
-                            if extraword is not None:
-                                year_all_words.append(extraword)
-
-                            yearprs = Pronounce(words = year_all_words).p(add_fake_stress = True)
-                            year1pr = yearprs[year1word][1]
-                            year2pr = yearprs[year2word][1]
-
-                            if extraword is not None:
-                                dict_tmp[wrd2] = year1pr + ' ' + yearprs[extraword][1] + ' ' + year2pr
-                            else:
-                                dict_tmp[wrd2] = year1pr + ' ' + year2pr  # print(wrd2, dict_tmp[wrd2])
-
-                        else:
-                            num2wrd = num2wrd.upper()
-                            num2wrd = num2wrd.replace('-', ' ')
-                            num2wrd = num2wrd.replace(',', '')
-                            num2wrd = num2wrd.replace(' ', '')
-                            # print(num2wrd)
-                            # import pdb; pdb.set_trace()
-                            pr = Pronounce(words = [num2wrd]).p(add_fake_stress = True)
-                            prn = pr[num2wrd][1]
-                            if wrd2[-1] in ['s', 'S']:
-                                prn += ' S'
-                            dict_tmp[wrd2] = prn  # print(prn)
-                    except:
-                        # print "###", e
-                        pr = Pronounce(words = [wrd2]).p(add_fake_stress = True)
-                        dict_tmp[pr[wrd2][0]] = pr[wrd2][1]  # print(pr)
-
-                words.append(wrd2)
-                gwm_entry.append(wrd2)
-                if len(between) != 0:
-                    words.extend(between)
-
-            if len(gwm_entry) > 1:
-                global_map.global_word_map.append(gwm_entry)
-                global_map.global_lineidx_map.append(i)
-                if speakers is not None:
-                    global_map.global_speaker_map.append(speakers[i])
-                if emotions is not None:
-                    global_map.global_emo_map.append(emotions[i])
-        i += 1
+    for i, token, new_up_wrd in iter_words(lines):
+        gwm_entry = [token]
+
+        for wrd2 in new_up_wrd:
+            if (wrd2 not in oov_seen) and (wrd2 not in dictionary):
+                oov_seen.add(wrd2)
+                oov_words.append(wrd2)
+
+            words.append(wrd2)
+            gwm_entry.append(wrd2)
+            if len(between) != 0:
+                words.extend(between)
+
+        if len(gwm_entry) > 1:
+            global_map.global_word_map.append(gwm_entry)
+            global_map.global_lineidx_map.append(i)
+            if speakers is not None:
+                global_map.global_speaker_map.append(speakers[i])
+            if emotions is not None:
+                global_map.global_emo_map.append(emotions[i])
 
     # remove the last 'between' token from the end
     if between != None:
@@ -250,8 +159,46 @@ def prep_mlf(trsfile, mlffile, word_dictionary, surround, between, file_name, gl
     if surround != None:
         words += surround.split(',')
 
+    with metrics.stage("resolve_oov"):
+        dict_tmp = resolve_oov(oov_words, dictionary)
+
     writeInputMLF(mlffile, words, file_name)
-    writeDictTmp(dict_tmp)
+    # (dict_tmp_file None keeps the new pronunciations in memory only)
+    if dict_tmp_file is not None:
+        writeDictTmp(dict_tmp, dict_tmp_file)
+
+    return words, dict_tmp
+
+
+def resolve_oov(oov_words, dictionary):
+    # Find pronunciations for all of the words that aren't in the dictionary.
+    # Numbers are spelled out from dictionary words; everything else goes
+    # to the pronunciation service in one batch.
+    numbers = NumberPronouncer.for_dictionary(dictionary)
+    metrics.count("oov_words", len(oov_words))
+
+    dict_tmp = {}
+    queries = []
+    for wrd2 in oov_words:
+        pr = numbers.pronounce(wrd2)
+        if pr is not None:
+            dict_tmp[wrd2] = pr
+        else:
+            queries.append(wrd2)
+
+    metrics.count("oov_numbers", len(oov_words) - len(queries))
+    if len(queries) > 0:
+        # the pronunciation service (and requests) are only loaded when needed
+        from .pronunciation import Pronounce
+        metrics.count("oov_lookups", len(queries))
+        prs = Pronounce(words = queries).p(add_fake_stress = True)
+        missing = [wrd2 for wrd2 in queries if wrd2 not in prs]
+        if len(missing) > 0:
+            raise LookupError("No pronunciation for: " + " ".join(missing))
+        for wrd2 in queries:
+            dict_tmp[prs[wrd2][0]] = prs[wrd2][1]
+
+    return dict_tmp
 
 
 def writeInputMLF(mlffile, words, file_name):
@@ -273,73 +220,85 @@ def writeInputMLF(mlffile, words, file_name):
     fw.close()
 
 
-def writeDictTmp(dict_tmp):
+def writeDictTmp(dict_tmp, dict_tmp_file = "dict.tmp"):
     if len(dict_tmp.keys()) > 0:
-        with open("dict.tmp", 'w') as f:
-            for w, pr in dict_tmp.items():
-                f.write("%s  %s\n" % (w, pr))
+        with open(dict_tmp_file, 'w') as f:
+            f.writelines(dictTmpLines(dict_tmp))
+
+
+def dictTmpLines(dict_tmp):
+    return ["%s  %s\n" % (w, pr) for w, pr in dict_tmp.items()]
 
 
 def readAlignedMLF(mlffile, SR, wave_start):
-    # This reads a MLFalignment output  file with phone and word
-    # alignments and returns a list of words, each word is a list containing
-    # the word label followed by the phones, each phone is a tuple
-    # (phone, start_time, end_time) with times in seconds.
+    # This reads a MLFalignment output file with phone and word
+    # alignments and returns them as a mlf.PhoneAlignment, with
+    # times in seconds.
+    with open(mlffile, 'r') as f:
+        # skip the #!MLF!# header and the entry's label
+        if f.readline() == '' or f.readline() == '':
+            raise ValueError("Alignment did not complete succesfully.")
+        alignment = read_aligned_mlf(f, SR, wave_start)
+
+    if len(alignment) == 0:
+        raise ValueError("Alignment did not complete succesfully.")
+    return alignment
+
 
+def splitAlignedMLF(mlffile):
+    # Split the output of a batch HVite run into the lines of each file's
+    # alignment, keyed by the file_name used for its .plp file
     f = open(mlffile, 'r')
     lines = [l.rstrip() for l in f.readlines()]
     f.close()
 
-    if len(lines) < 3:
-        raise ValueError("Alignment did not complete succesfully.")
-
-    j = 2
-    ret = []
-    while (lines[j] != '.'):
-        if (len(lines[j].split()) == 5):  # Is this the start of a word; do we have a word label?
-            # Make a new word list in ret and put the word label at the beginning
-            wrd = lines[j].split()[4]
-            ret.append([wrd])
-
-        # Append this phone to the latest word (sub-)list
-        ph = lines[j].split()[2]
-        if (SR == 11025):
-            st = (float(lines[j].split()[0]) / 10000000.0 + 0.0125) * (11000.0 / 11025.0)
-            en = (float(lines[j].split()[1]) / 10000000.0 + 0.0125) * (11000.0 / 11025.0)
-        else:
-            st = float(lines[j].split()[0]) / 10000000.0 + 0.0125
-            en = float(lines[j].split()[1]) / 10000000.0 + 0.0125
-        if st < en:
-            ret[-1].append([ph, st + wave_start, en + wave_start])
+    entries = {}
+    j = 1
+    while j < len(lines):
+        label = os.path.basename(lines[j].strip('"'))
+        name = label[:-len("_tmp.rec")] if label.endswith("_tmp.rec") else os.path.splitext(label)[0]
+        end = j + 1
+        while end < len(lines) and lines[end] != '.':
+            end += 1
+        entries[name] = lines[j + 1:end + 1]
+        j = end + 1
+    return entries
+
+
+def readAcousticScores(results):
+    # {file_name: total acoustic log likelihood} from the HVite output of a
+    # (batch) run, keyed like splitAlignedMLF
+    scores = {}
+    name = None
+    for line in results.splitlines():
+        if line.startswith("Aligning File:"):
+            plp = os.path.basename(line.split(":", 1)[1].strip())
+            name = plp[:-len("_tmp.plp")] if plp.endswith("_tmp.plp") else os.path.splitext(plp)[0]
+            continue
+        match = acPat.search(line)
+        if match and name is not None:
+            scores[name] = float(match.group(1))
+            name = None
+    return scores
 
-        j += 1
 
-    return ret
+def parseAlignedMLFEntry(lines, SR, wave_start):
+    # the lines of one entry, as split out by splitAlignedMLF
+    return read_aligned_mlf(lines, SR, wave_start)
 
 
 # steve added 1/23/2013
-def writeJSON(outfile, word_alignments, global_map, phonemes = False):
-    # make the list of just phone alignments
-    phons = []
-    word_phons = []
-    for wrd in word_alignments:
-        phons.extend(wrd[1:])  # skip the word label
-        if len(wrd) != 1:
-            word_phons.append(wrd[1:])
-
-    # make the list of just word alignments
-    # we're getting elements of the form:
-    #   ["word label", ["phone1", start, end], ["phone2", start, end], ...]
-
-    wrds = []
-    for wrd in word_alignments:
-        # If no phones make up this word, then it was an optional word
-        # like a pause that wasn't actually realized.
-        if len(wrd) == 1:
-            continue
-        wrds.append([wrd[0], wrd[1][1], wrd[-1][2]])  # word label, first phone start time, las t phone end time
-
-    out_dict = {"words": []}
+def alignedWords(word_alignments, global_map, phonemes = False):
+    # The words of the output, in order, as dicts. word_alignments is a
+    # mlf.PhoneAlignment. If no phones make up a word, then it was an
+    # optional word like a pause that wasn't actually realized.
+    spoken = word_alignments.spoken_words()
+    starts = word_alignments.start[word_alignments.word_first[spoken]].tolist()
+    ends = word_alignments.end[word_alignments.word_first[spoken + 1] - 1].tolist()
+
+    # the list of just word alignments, of the form:
+    #   ["word label", first phone start time, last phone end time]
+    wrds = [[word_alignments.word_labels[i], st, en] for i, st, en in zip(spoken.tolist(), starts, ends)]
 
     real_word_count = 0
     total_word_idx = 0
@@ -350,27 +309,26 @@ def writeJSON(outfile, word_alignments, global_map, phonemes = False):
 
         # print(wrds[total_word_idx], global_word_map[real_word_count])
 
-        if wrds[total_word_idx][0] != "sp" and wrds[total_word_idx][0] != "{BR}":
-            word_length = len(global_map.global_word_map[real_word_count]) - 1
-        else:
-            word_length = 1
-
         try:
+            if wrds[total_word_idx][0] != "sp" and wrds[total_word_idx][0] != "{BR}":
+                word_length = len(global_map.global_word_map[real_word_count]) - 1
+            else:
+                word_length = 1
 
             tmp_word = {"alignedWord": wrds[total_word_idx][0], "start": round(wrds[total_word_idx][1], 5),
                         "end": round(wrds[total_word_idx + word_length - 1][2], 5)
                         # "end": round(wrds[total_word_idx + word_length][1], 5)
                         }
-        except:
-            import pdb;
-            pdb.set_trace()
+        except IndexError:
+            # more words in the MLF than in the transcript, or fewer
+            raise ValueError("Aligned MLF does not match the transcript at word %d" % real_word_count)
 
         if wrds[total_word_idx][0] != "sp" and wrds[total_word_idx][0] != "{BR}":
             tmp_word["word"] = global_map.global_word_map[real_word_count][0]
             if phonemes:
                 tmp_word["phonemes"] = []
                 for wl_i in range(word_length):
-                    tmp_word["phonemes"].extend(word_phons[total_word_idx + wl_i])
+                    tmp_word["phonemes"].extend(word_alignments.word_phones(spoken[total_word_idx + wl_i]))
 
             tmp_word["line_idx"] = global_map.global_lineidx_map[real_word_count]
 
@@ -385,9 +343,6 @@ def writeJSON(outfile, word_alignments, global_map, phonemes = False):
         elif wrds[total_word_idx][0] == "{BR}":
             tmp_word["word"] = "{br}"
 
-        # if word_length > 1:
-        #     import pdb; pdb.set_trace()
-
         if word_length == 1:
             total_word_idx += 1
         else:
@@ -412,9 +367,10 @@ def writeJSON(outfile, word_alignments, global_map, phonemes = False):
         #         real_words_to_skip -= 1
         #     total_word_idx += 1
 
-        out_dict["words"].append(tmp_word)
+        yield tmp_word
 
-    tmp_word = {"alignedWord": wrds[-1][0], "start": round(wrds[-1][1], 5), "end": round(phons[-1][2], 5)}
+    tmp_word = {"alignedWord": wrds[-1][0], "start": round(wrds[-1][1], 5),
+                "end": round(float(word_alignments.end[-1]), 5)}
 
     dont_add = False
 
@@ -429,7 +385,7 @@ def writeJSON(outfile, word_alignments, global_map, phonemes = False):
                 tmp_word["emotion"] = global_map.global_emo_map[real_word_count]
 
             if phonemes:
-                tmp_word["phonemes"] = word_phons[total_word_idx]
+                tmp_word["phonemes"] = word_alignments.word_phones(spoken[-1])
 
         except:
             # will get here if last word is compound word
@@ -442,68 +398,212 @@ def writeJSON(outfile, word_alignments, global_map, phonemes = False):
         tmp_word["word"] = "{br}"
 
     if not dont_add:
-        out_dict["words"].append(tmp_word)
+        yield tmp_word
 
-    try:
-        jsonschema.validate(out_dict, ALIGNMENT_SCHEMA)
-    except jsonschema.ValidationError as e:
-        print("Output is not a valid Alignment according to alignment-schemas/alignment_schema.json")
-        print(e)
 
-    with open(outfile, "w") as f_out:
-        json.dump(out_dict, f_out, indent = 4)
+def makeAlignment(word_alignments, global_map, viterbi_report = None):
+    # the in-memory result of an alignment (see alignment.py)
+    return Alignment(word_alignments, alignedWords(word_alignments, global_map, phonemes = True), viterbi_report)
+
+
+def writeJSON(outfile, word_alignments, global_map, phonemes = False, viterbi_report = None, validate = True):
+    writeOutputs(outfile, makeAlignment(word_alignments, global_map, viterbi_report), phonemes = phonemes,
+                 validate = validate)
 
 
 def writeTextGrid(outfile, word_alignments):
-    tg = tgt.TextGrid()
-    phone_tier = tgt.IntervalTier(name = 'phone')
-    word_tier = tgt.IntervalTier(name = 'word')
+    export_alignment({"textgrid": outfile}, word_alignments, ())
+
+
+def job_file_name(wavfile):
+    return '_'.join('_'.join(wavfile.split('.')).split('/'))
+
 
-    for data in word_alignments:
-        word = data[0]
-        phones = data[1:]
+def phoneset_file(mypath):
+    mpfile = mypath + '/monophones'
+    if not os.path.exists(mpfile):
+        mpfile = mypath + '/hmmnames'
+    return mpfile
 
-        if len(phones) > 0:
-            start_time = phones[0][1]
-            end_time = phones[-1][2]
 
-            word_tier.add_interval(tgt.Interval(start_time, end_time, text = word))
+def output_paths(outfile, json = True, textgrid = False, formats = ()):
+    # {format: path}: json goes to outfile, then textgrid if json is off, and
+    # every other format to outfile with the format's extension
+    outputs = {}
+    if json:
+        outputs["json"] = outfile
+    if textgrid:
+        outputs["textgrid"] = outfile if not json else os.path.splitext(outfile)[0] + EXTENSIONS["textgrid"]
+    for fmt in formats:
+        if fmt not in outputs:
+            outputs[fmt] = os.path.splitext(outfile)[0] + EXTENSIONS[fmt]
+    return outputs
 
-            for (p, p_start, p_end) in phones:
-                phone_tier.add_interval(tgt.Interval(p_start, p_end, text = p))
-    tg.add_tier(phone_tier)
-    tg.add_tier(word_tier)
 
-    tgt.io.write_to_file(tg, outfile, format = 'long')
+def writeOutputs(outfile, alignment, json = True, textgrid = False, phonemes = False, formats = (), validate = True):
+    # every format is written in one pass over the words of the Alignment
+    alignment.write(output_paths(outfile, json, textgrid, formats), phonemes = phonemes, validate = validate)
 
 
-def prep_working_directory():
-    if not os.path.exists('tmp'):
-        os.mkdir('tmp')
+def prep_working_directory(work_dir = 'tmp'):
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
 
     # os.system("rm -r -f ./tmp")  # os.system("mkdir ./tmp")
 
 
-def prep_scp(wavfile, file_name):
-    fw = open('tmp/' + file_name + '_codetr.scp', 'w')
-    fw.write(wavfile + ' tmp/' + file_name + '_tmp.plp\n')
+def prep_scp(wavfile, file_name, work_dir = 'tmp'):
+    prep_batch_scp([(wavfile, file_name)], file_name, work_dir)
+
+
+def prep_batch_scp(wavfiles, batch_name, work_dir = 'tmp', have_features = ()):
+    # wavfiles is a list of (wavfile, file_name) for one HCopy/HVite run; HCopy
+    # leaves out the file_names in have_features, whose .plp is already there
+    fw = open(os.path.join(work_dir, batch_name + '_codetr.scp'), 'w')
+    for wavfile, file_name in wavfiles:
+        if file_name in have_features:
+            continue
+        fw.write(wavfile + ' ' + os.path.join(work_dir, file_name + '_tmp.plp') + '\n')
     fw.close()
-    fw = open('tmp/' + file_name + '_test.scp', 'w')
-    fw.write('tmp/' + file_name + '_tmp.plp\n')
+    fw = open(os.path.join(work_dir, batch_name + '_test.scp'), 'w')
+    for wavfile, file_name in wavfiles:
+        fw.write(os.path.join(work_dir, file_name + '_tmp.plp') + '\n')
     fw.close()
 
 
-def create_plp(hcopy_config, file_name):
-    command = '/home/wenhao/software/bin/HCopy -T 1 -C ' + hcopy_config + ' -S ' + 'tmp/' + file_name + '_codetr.scp ' \
-                                                                                                        '> /dev/null'
-    # print('/home/wenhao/software/bin/HCopy -T 1 -C ' + hcopy_config + ' -S ' + 'tmp/' + file_name + '_codetr.scp')
-    os.system(command)
+class HTKError(RuntimeError):
+    def __init__(self, tool, returncode, stderr):
+        RuntimeError.__init__(self, "%s exited with status %d: %s" % (tool, returncode, stderr.strip()[-2000:]))
+        self.tool = tool
+        self.returncode = returncode
+        self.stderr = stderr
 
 
-def viterbi(input_mlf, word_dictionary, output_mlf, phoneset, hmmdir, file_name):
-    command = '/home/wenhao/software/bin/HVite -T 1 -a -m -I ' + input_mlf + ' -H ' + hmmdir + '/macros -H ' + hmmdir + '/hmmdefs  -S tmp/' + file_name + '_test.scp -i ' + output_mlf + ' -p 0.0 -s 5.0 ' + word_dictionary + ' ' + phoneset + ' > tmp/' + file_name + '_aligned.results'
-    # print(command)
-    os.system(command)
+def run_htk(args, stdout = None, timeout = None, check = False):
+    # Run an HTK tool from HTK_BIN, sending its output to the file stdout (or nowhere).
+    # The tool (and anything it started) is killed if it is still running after
+    # timeout seconds, or if we are interrupted while waiting for it. With check,
+    # a non-zero exit raises HTKError with what the tool printed to stderr.
+    with open(stdout or os.devnull, 'w') as out, tempfile.TemporaryFile('w+') as err:
+        start = time.time()
+        proc = subprocess.Popen([os.path.join(HTK_BIN, args[0])] + args[1:], stdout = out,
+                                stderr = err if check else None, start_new_session = True)
+        try:
+            # the tool's resource usage goes to the metrics being recorded, if any
+            returncode, rusage = metrics.wait(proc, timeout)
+            metrics.child(args[0], time.time() - start, returncode, rusage)
+        except BaseException:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            proc.wait()
+            raise
+        if check and returncode != 0:
+            err.seek(0)
+            raise HTKError(args[0], returncode, err.read())
+        return returncode
+
+
+def create_plp(hcopy_config, file_name, work_dir = 'tmp', timeout = None):
+    # (plp.py isn't used here until its features are checked against HCopy's, see test/test_plp.py)
+    run_htk(['HCopy', '-T', '1', '-C', hcopy_config, '-S', os.path.join(work_dir, file_name + '_codetr.scp')],
+            timeout = timeout, check = True)
+
+
+def viterbi(input_mlf, word_dictionary, output_mlf, phoneset, hmmdir, file_name, work_dir = 'tmp', timeout = None,
+            beam = 0.0):
+    if DECODER == "native":
+        decoder.align_scp(input_mlf, word_dictionary, output_mlf, phoneset, hmmdir,
+                          os.path.join(work_dir, file_name + '_test.scp'),
+                          os.path.join(work_dir, file_name + '_aligned.results'), beam)
+        return
+    run_htk(['HVite', '-T', '1', '-a', '-m', '-I', input_mlf, '-H', hmmdir + '/macros', '-H', hmmdir + '/hmmdefs',
+             '-S', os.path.join(work_dir, file_name + '_test.scp'), '-i', output_mlf, '-p', '0.0', '-s', '5.0',
+             '-t', str(beam), word_dictionary, phoneset],
+            stdout = os.path.join(work_dir, file_name + '_aligned.results'), timeout = timeout)
+
+
+def viterbi_with_retry(input_mlf, word_dictionary, output_mlf, phoneset, hmmdir, file_name, work_dir = 'tmp',
+                       timeout = None, beams = None):
+    # Run viterbi with each beam of beams (default VITERBI_BEAMS) until every file in
+    # file_name's _test.scp has an alignment; HVite leaves a file out of the output MLF
+    # when no path survives the pruning. Returns {name: aligned MLF entry lines} for the
+    # files that aligned and {name: report} for all of them, and leaves the combined
+    # alignments in output_mlf and the combined HVite output in the .results file.
+    attempts = viterbi_attempts(output_mlf, file_name, work_dir, beams)
+    try:
+        attempt_mlf, attempt_name, beam = next(attempts)
+        while True:
+            start = time.time()
+            viterbi(input_mlf, word_dictionary, attempt_mlf, phoneset, hmmdir, attempt_name, work_dir, timeout, beam)
+            attempt_mlf, attempt_name, beam = attempts.send(round(time.time() - start, 3))
+    except StopIteration as done:
+        return done.value
+
+
+def viterbi_attempts(output_mlf, file_name, work_dir = 'tmp', beams = None):
+    # The retry loop of viterbi_with_retry without the runs themselves: yields
+    # (attempt_mlf, attempt_name, beam) for each viterbi run to make, is sent
+    # back how many seconds it took, and returns (entries, reports).
+    if beams is None:
+        beams = VITERBI_BEAMS
+    with open(os.path.join(work_dir, file_name + '_test.scp'), 'r') as f:
+        plps = [l.strip() for l in f if l.strip() != ""]
+    names = [os.path.basename(plp)[:-len("_tmp.plp")] for plp in plps]
+
+    entries = {}
+    reports = dict((name, {"attempts": [], "beam": None, "ac": None}) for name in names)
+    results = []
+    pending = list(zip(names, plps))
+    for k, beam in enumerate(beams):
+        if not pending:
+            break
+        attempt_name = file_name if k == 0 else "%s_t%d" % (file_name, k)
+        attempt_mlf = output_mlf if k == 0 else os.path.join(work_dir, attempt_name + '_aligned.mlf')
+        if k > 0:
+            with open(os.path.join(work_dir, attempt_name + '_test.scp'), 'w') as f:
+                f.writelines(plp + '\n' for name, plp in pending)
+
+        seconds = yield attempt_mlf, attempt_name, beam
+
+        found = {}
+        if os.path.exists(attempt_mlf):
+            found = splitAlignedMLF(attempt_mlf)
+        with open(os.path.join(work_dir, attempt_name + '_aligned.results'), 'r') as f:
+            results.append(f.read())
+        scores = readAcousticScores(results[-1])
+
+        still_pending = []
+        for name, plp in pending:
+            # an entry with no segments is a failure too
+            aligned = name in found and len(found[name]) > 1
+            reports[name]["attempts"].append({"beam": beam, "seconds": seconds, "aligned": aligned})
+            if aligned:
+                entries[name] = found[name]
+                reports[name]["beam"] = beam
+                reports[name]["ac"] = scores.get(name)
+            else:
+                still_pending.append((name, plp))
+        pending = still_pending
+
+    if len(results) > 1:
+        with open(output_mlf, 'w') as f:
+            f.write('#!MLF!#\n')
+            for name in names:
+                if name in entries:
+                    f.write('"%s/%s_tmp.rec"\n' % (work_dir, name))
+                    f.writelines(l + '\n' for l in entries[name])
+        with open(os.path.join(work_dir, file_name + '_aligned.results'), 'w') as f:
+            f.write("".join(results))
+
+    return entries, reports
+
+
+def parse_beams(beams):
+    if beams is None:
+        return None
+    return [float(b) for b in beams.split(",")]
 
 
 def getopt2(name, opts, default = None):
@@ -513,24 +613,90 @@ def getopt2(name, opts, default = None):
     return value[0]
 
 
-@click.command()
-@click.argument('wavfile')
-@click.argument('trsfile')
-@click.argument('outfile')
-@click.option('--json/--no-json', default = True, help = "Export json alignment")
-@click.option('--textgrid/--no-textgrid', default = False, help = "Export Praat TextGrid alignment")
-@click.option('--phonemes/--no-phonemes', default = False, help = "Add phoneme information to JSON output")
-@click.option('--breaths/--no-breaths', default = False, help = "Detect breaths in speech")
-def cli_do_alignment(wavfile, trsfile, outfile, json, textgrid, phonemes, breaths):
-    return do_alignment(wavfile, trsfile, outfile, json, textgrid, phonemes, breaths)
-
-
-def do_alignment(wavfile, trsfile, outfile, json = True, textgrid = False, phonemes = False, breaths = False):
-    global_map = GlobalMap()
-
+def make_cli():
+    # click is only imported when the command line is used
+    import click
+
+    @click.command()
+    @click.argument('wavfile')
+    @click.argument('trsfile')
+    @click.argument('outfile')
+    @click.option('--json/--no-json', default = True, help = "Export json alignment")
+    @click.option('--textgrid/--no-textgrid', default = False, help = "Export Praat TextGrid alignment")
+    @click.option('--phonemes/--no-phonemes', default = False, help = "Add phoneme information to JSON output")
+    @click.option('--breaths/--no-breaths', default = False, help = "Detect breaths in speech")
+    @click.option('--prune-dict/--no-prune-dict', default = False,
+                  help = "Give HVite a dictionary with only the words in the transcript")
+    @click.option('--beams', default = None, help = "Comma-separated HVite beam widths to try in turn (0 is no pruning)")
+    @click.option('--feature-cache/--no-feature-cache', default = None,
+                  help = "Reuse the prepared audio and features of audio aligned before (default: only when "
+                         "P2FA_FEATURE_CACHE is set)")
+    @click.option('--format', 'formats', multiple = True, type = click.Choice(["csv", "ndjson", "textgrid"]),
+                  help = "Also write this format, next to outfile with its extension (repeatable)")
+    @click.option('--validate/--no-validate', default = True, help = "Check the json output against the schema")
+    @click.option('--metrics/--no-metrics', 'metrics_file', default = False,
+                  help = "Write stage timings, HTK resource usage and cache hits to <outfile>.metrics.json")
+    @click.option('--prometheus', default = None, help = "Also write the metrics to this Prometheus textfile")
+    @click.option('--profile/--no-profile', default = False,
+                  help = "Profile the Python stages (stats in <outfile>.prof, the top functions in the metrics)")
+    def cli_do_alignment(wavfile, trsfile, outfile, json, textgrid, phonemes, breaths, prune_dict, beams, feature_cache,
+                         formats, validate, metrics_file, prometheus, profile):
+        with metrics.command_line(os.path.splitext(outfile)[0], metrics_file or profile, prometheus, profile):
+            do_alignment(wavfile, trsfile, outfile, json, textgrid, phonemes, breaths, prune_dict,
+                         beams = parse_beams(beams), feature_cache = default_feature_cache(feature_cache),
+                         formats = formats, validate = validate)
+
+    return cli_do_alignment
+
+
+def __getattr__(name):
+    # the schemas used to be loaded here at import; now they are loaded on first use
+    if name == 'TRANSCRIPT_SCHEMA':
+        return schemas.load_schema("transcript")
+    if name == 'ALIGNMENT_SCHEMA':
+        return schemas.load_schema("alignment")
+    if name == 'cli_do_alignment':
+        return make_cli()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+class PreparedAlignment:
+    def __init__(self, wavfile, work_dir, mypath, hmmdir, SR, wave_start):
+        # the files and settings of one alignment once prepare_alignment has
+        # made everything HCopy and HVite need
+        self.wavfile = wavfile
+        self.work_dir = work_dir
+        self.file_name = job_file_name(wavfile)
+        self.word_dictionary = os.path.join(work_dir, self.file_name + '.dict')
+        self.input_mlf = os.path.join(work_dir, self.file_name + '_tmp.mlf')
+        self.output_mlf = os.path.join(work_dir, self.file_name + '_aligned.mlf')
+        self.tmpwav = os.path.join(work_dir, self.file_name + '_sound.wav')
+        self.plpfile = os.path.join(work_dir, self.file_name + '_tmp.plp')
+        self.hmmdir = hmmdir
+        self.hcopy_config = hmmdir + '/config'
+        self.phoneset = phoneset_file(mypath)
+        self.SR = SR
+        self.wave_start = wave_start
+        self.global_map = GlobalMap()
+        self.feature_cache = False
+        self.cache_key = None
+        self.have_features = False
+
+    def cache_features(self):
+        # once HCopy has made the features
+        if self.cache_key is not None:
+            with metrics.stage("feature_cache"):
+                self.feature_cache.put(self.cache_key, self.tmpwav, self.plpfile)
+
+
+def prepare_alignment(wavfile, trsfile, prune_dict = False, work_dir = 'tmp', wave_start = "0.0", wave_end = None,
+                      feature_cache = None):
+    # everything of do_alignment before HCopy and HVite: the wav, the input MLF,
+    # the dictionary and the scp files in work_dir; returns a PreparedAlignment
     sr_override = None
-    wave_start = "0.0"
-    wave_end = None
+    wave_start = str(float(wave_start))
+    if wave_end is not None:
+        wave_end = str(float(wave_end))
     surround_token = "sp"
     between_token = ["sp"]
 
@@ -541,78 +707,103 @@ def do_alignment(wavfile, trsfile, outfile, json = True, textgrid = False, phone
     hmmsubdir = ""
     sr_models = None
     if mypath == None:
-        mypath = os.path.join(os.path.dirname(os.path.realpath(__file__)), "model")
+        mypath = MODEL_DIR
         hmmsubdir = "FROM-SR"
-        # sample rates for which there are acoustic models set up, otherwise
-        # the signal must be resampled to one of these rates.
-        sr_models = [8000, 11025, 16000]
+        sr_models = SR_MODELS
 
     if sr_override != None and sr_models != None and not sr_override in sr_models:
         raise ValueError("invalid sample rate: not an acoustic model available")
 
-    file_name = '_'.join('_'.join(wavfile.split('.')).split('/'))
-    word_dictionary = 'tmp/' + file_name + '.dict'
-    input_mlf = 'tmp/' + file_name + '_tmp.mlf'
-    output_mlf = 'tmp/' + file_name + '_aligned.mlf'
-
     # create working directory
-    prep_working_directory()
-
-    # create ./tmp/dict by concatening our dict with a local one
+    prep_working_directory(work_dir)
 
-    with open(word_dictionary, 'w') as wd_file:
-        with open(os.path.join(mypath, 'dict')) as dict_f:
-            wd_file.write(dict_f.read())
+    # compiled index of our dict and a local one (rebuilt only when they change)
+    with metrics.stage("dictionary"):
+        dictionary = load_dictionary(mypath)
 
-        if os.path.exists("dict.local"):
-            with open("dict.local") as local_dict_f:
-                wd_file.write(local_dict_f.read())
-
-    # prepare wavefile: do a resampling if necessary
-    tmpwav = 'tmp/' + file_name + '_sound.wav'
-    SR = prep_wav(wavfile, tmpwav, sr_override, sr_models, wave_start, wave_end)
+    SR, _ = target_sr(wavfile, sr_override, sr_models, wave_start, wave_end)
 
     if hmmsubdir == "FROM-SR":
         hmmsubdir = "/" + str(SR)
+    job = PreparedAlignment(wavfile, work_dir, mypath, mypath + hmmsubdir, SR, wave_start)
+
+    # the same audio aligned before (with another transcript) has its features cached
+    if feature_cache is None:
+        feature_cache = default_feature_cache()
+    job.feature_cache = feature_cache
+    if feature_cache is not False:
+        with metrics.stage("feature_cache"):
+            job.cache_key = feature_cache.key(wavfile, wave_start, wave_end, SR, job.hcopy_config)
+            job.have_features = feature_cache.get(job.cache_key, job.tmpwav, job.plpfile)
+
+    if not job.have_features:
+        # prepare wavefile: do a resampling if necessary
+        with metrics.stage("prep_wav"):
+            prep_wav(wavfile, job.tmpwav, sr_override, sr_models, wave_start, wave_end)
 
     # prepare mlfile
-    prep_mlf(trsfile, input_mlf, word_dictionary, surround_token, between_token, file_name, global_map,
-             dialog_file = True)
-
-    # (do this again because we update dict.local in prep_mlf)
-    with open(os.path.join(mypath, 'dict')) as dict_f:
-        dict_lines = [line for line in dict_f]
-    try:
-        with open("dict.tmp") as tmp_dict_f:
-            dict_lines.extend([line for line in tmp_dict_f])
-    except:
-        pass
-    sorted_dict_lines = sorted(dict_lines)
-    with open(word_dictionary, 'w') as wd_file:
-        for line in sorted_dict_lines:
-            wd_file.write(line)
+    with metrics.stage("prep_mlf"):
+        words, dict_tmp = prep_mlf(trsfile, job.input_mlf, dictionary, surround_token, between_token,
+                                   job.file_name, job.global_map, dialog_file = True,
+                                   dict_tmp_file = os.path.join(work_dir, "dict.tmp"))
+
+    # create ./tmp/dict from the index plus the pronunciations prep_mlf found
+    with metrics.stage("write_dict"):
+        if prune_dict:
+            # only the words HVite will actually see
+            dictionary.write_pruned_dict(job.word_dictionary, words, dictTmpLines(dict_tmp))
+        else:
+            dictionary.write_htk_dict(job.word_dictionary, dictTmpLines(dict_tmp))
 
     # prepare scp files
-    prep_scp(tmpwav, file_name)
+    prep_scp(job.tmpwav, job.file_name, work_dir)
+    return job
 
-    # generate the plp file using a given configuration file for HCopy
-    create_plp(mypath + hmmsubdir + '/config', file_name)
 
-    # run Verterbi decoding
-    # print "Running HVite..."
-    mpfile = mypath + '/monophones'
-    if not os.path.exists(mpfile):
-        mpfile = mypath + '/hmmnames'
-    viterbi(input_mlf, word_dictionary, output_mlf, mpfile, mypath + hmmsubdir, file_name)
+def finish_alignment(job, entries, reports, outfile, json = True, textgrid = False, phonemes = False, formats = (),
+                     validate = True):
+    # the Alignment from HVite's output, written to outfile unless that is None
+    if job.file_name not in entries:
+        raise ValueError("Alignment did not complete succesfully.")
 
-    if json:
-        # output as json
-        writeJSON(outfile, readAlignedMLF(output_mlf, SR, float(wave_start)), global_map, phonemes = phonemes)
+    with metrics.stage("read_mlf"):
+        alignment = makeAlignment(readAlignedMLF(job.output_mlf, job.SR, float(job.wave_start)), job.global_map,
+                                  reports[job.file_name])
+    if outfile is not None:
+        with metrics.stage("write_outputs"):
+            writeOutputs(outfile, alignment, json = json, textgrid = textgrid, phonemes = phonemes,
+                         formats = formats, validate = validate)
+    return alignment
+
+
+def do_alignment(wavfile, trsfile, outfile, json = True, textgrid = False, phonemes = False, breaths = False,
+                 prune_dict = False, work_dir = 'tmp', timeout = None, wave_start = "0.0", wave_end = None,
+                 beams = None, feature_cache = None, formats = (), validate = True):
+    # Everything for this alignment is written to work_dir (except outfile), so
+    # alignments with different work_dirs can run at the same time. Returns the
+    # Alignment; it is written to outfile (and the other formats) unless that is None.
+    # (async_align.async_do_alignment is the same on an asyncio event loop.)
+    job = prepare_alignment(wavfile, trsfile, prune_dict, work_dir, wave_start, wave_end, feature_cache)
+
+    if not job.have_features:
+        # generate the plp file using a given configuration file for HCopy
+        with metrics.stage("create_plp"):
+            create_plp(job.hcopy_config, job.file_name, work_dir, timeout)
+        job.cache_features()
 
-    if textgrid:
-        # output the alignment as a Praat TextGrid
-        writeTextGrid(outfile, readAlignedMLF(output_mlf, SR, float(wave_start)))
+    # run Verterbi decoding
+    # print "Running HVite..."
+    with metrics.stage("viterbi"):
+        entries, reports = viterbi_with_retry(job.input_mlf, job.word_dictionary, job.output_mlf, job.phoneset,
+                                              job.hmmdir, job.file_name, work_dir, timeout, beams)
+    return finish_alignment(job, entries, reports, outfile, json, textgrid, phonemes, formats, validate)
 
 
 if __name__ == '__main__':
-    cli_do_alignment()
+    import sys
+    if sys.argv[1:2] == ["serve"]:
+        # python -m p2fa_vislab.align serve [options]: the alignment server
+        from .server import make_cli as make_server_cli
+        make_server_cli()(sys.argv[2:])
+    else:
+        make_cli()()
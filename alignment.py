@@ -0,0 +1,238 @@
+"""
+Alignment results in memory.
+
+do_alignment and the batch/parallel APIs return an Alignment: the output
+words as columns (NumPy start/end times, word and alignedWord strings,
+line index) with speaker and emotion interned (a code per word into a
+list of the distinct values), and the phones as the mlf.PhoneAlignment
+columns they were parsed into, with the phone range of every word.
+Word and Phone records are made only when asked for, and the alignment
+is only turned into JSON, TextGrid, ... by to_dict() or write().
+
+An alignment that wasn't read from one MLF (e.g. longform.py's, stitched
+together from chunks) is made with Alignment.from_words from its word dicts.
+
+Usage: alignment = do_alignment(wavfile, trsfile, None)
+       alignment.word_at(12.5), alignment.words_between(10.0, 20.0)
+       alignment.write({"json": "out.json", "csv": "out.csv"})
+"""
+
+import bisect
+
+import numpy as np
+
+from .export import export_alignment
+from .mlf import PhoneAlignment
+
+PAUSE_WORDS = ("{p}", "{br}")
+# word times are rounded to 5 places
+TIME_TOLERANCE = 0.000005
+
+
+class Word(object):
+    __slots__ = ("index", "word", "alignedWord", "start", "end", "line_idx", "speaker", "emotion")
+
+    def __init__(self, index, word, alignedWord, start, end, line_idx = None, speaker = None, emotion = None):
+        self.index = index
+        self.word = word
+        self.alignedWord = alignedWord
+        self.start = start
+        self.end = end
+        self.line_idx = line_idx
+        self.speaker = speaker
+        self.emotion = emotion
+
+    def is_pause(self):
+        return self.word in PAUSE_WORDS
+
+    def __repr__(self):
+        return "Word(%r, %r, %r, %r)" % (self.word, self.alignedWord, self.start, self.end)
+
+
+class Phone(object):
+    __slots__ = ("phone", "start", "end")
+
+    def __init__(self, phone, start, end):
+        self.phone = phone
+        self.start = start
+        self.end = end
+
+    def __repr__(self):
+        return "Phone(%r, %r, %r)" % (self.phone, self.start, self.end)
+
+
+class Alignment(object):
+    def __init__(self, phones, words, viterbi_report = None):
+        # phones is the mlf.PhoneAlignment that words (align.alignedWords with
+        # phonemes=True) were made from
+        self.phones = phones
+        self.viterbi = viterbi_report
+
+        self.word = []
+        self.alignedWord = []
+        start = []
+        end = []
+        line_idx = []
+        self.speakers = []
+        self.emotions = []
+        speaker_codes = {}
+        emotion_codes = {}
+        speaker = []
+        emotion = []
+        phone_first = []
+        phone_last = []
+        unaligned = []
+        for w in words:
+            self.word.append(w["word"])
+            self.alignedWord.append(w["alignedWord"])
+            start.append(w["start"])
+            end.append(w["end"])
+            line_idx.append(w.get("line_idx", -1))
+            speaker.append(self._intern(w.get("speaker"), speaker_codes, self.speakers))
+            emotion.append(self._intern(w.get("emotion"), emotion_codes, self.emotions))
+            first, last = self._phone_range(w)
+            phone_first.append(first)
+            phone_last.append(last)
+            # words spread over their audio rather than aligned (see longform.py)
+            unaligned.append(bool(w.get("unaligned")))
+
+        self.start = np.array(start, dtype = np.float64)
+        self.end = np.array(end, dtype = np.float64)
+        self.line_idx = np.array(line_idx, dtype = np.int32)
+        self.speaker = np.array(speaker, dtype = np.int32)
+        self.emotion = np.array(emotion, dtype = np.int32)
+        self.phone_first = np.array(phone_first, dtype = np.int64)
+        self.phone_last = np.array(phone_last, dtype = np.int64)
+        self.unaligned = np.array(unaligned, dtype = bool)
+        self._starts = self.start.tolist()
+        self._ends = self.end.tolist()
+
+    @classmethod
+    def from_words(cls, words, viterbi_report = None):
+        # the phones are the words' phonemes; a pause is one phone, as in the MLF,
+        # and an unaligned word one unnamed phone, so it still has a word interval
+        names = {}
+        word_labels = []
+        counts = []
+        phone_ids = []
+        start = []
+        end = []
+        out = []
+        for w in words:
+            if w["word"] in PAUSE_WORDS:
+                phones = [[w["alignedWord"], w["start"], w["end"]]]
+            elif w.get("unaligned"):
+                phones = [["", w["start"], w["end"]]]
+            else:
+                phones = w.get("phonemes") or []
+            # (empty phones are left out, as read_aligned_mlf leaves them out)
+            phones = [p for p in phones if p[1] < p[2]]
+            if "phonemes" in w:
+                w = dict(w, phonemes = phones)
+            for p, st, en in phones:
+                phone_ids.append(names.setdefault(p, len(names)))
+                start.append(st)
+                end.append(en)
+            word_labels.append(w["alignedWord"])
+            counts.append(len(phones))
+            out.append(w)
+
+        phone_names = sorted(names, key = names.get)
+        word_first = np.concatenate([[0], np.cumsum(counts, dtype = np.int64)]).astype(np.int64)
+        phones = PhoneAlignment(word_labels, word_first, phone_names, np.array(phone_ids, dtype = np.int32),
+                                np.array(start, dtype = np.float64), np.array(end, dtype = np.float64))
+        return cls(phones, out, viterbi_report)
+
+    @staticmethod
+    def _intern(value, codes, values):
+        if value is None:
+            return -1
+        if value not in codes:
+            codes[value] = len(values)
+            values.append(value)
+        return codes[value]
+
+    def _phone_range(self, w):
+        # [first, last) indices of the word's phones
+        if "phonemes" in w and w["phonemes"]:
+            first = int(np.searchsorted(self.phones.start, w["phonemes"][0][1]))
+            return first, first + len(w["phonemes"])
+        first = int(np.searchsorted(self.phones.start, w["start"] - TIME_TOLERANCE))
+        last = int(np.searchsorted(self.phones.end, w["end"] + TIME_TOLERANCE, side = 'right'))
+        return first, max(first, last)
+
+    def __len__(self):
+        return len(self.word)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("word index out of range")
+        line_idx = int(self.line_idx[i])
+        speaker = int(self.speaker[i])
+        emotion = int(self.emotion[i])
+        return Word(i, self.word[i], self.alignedWord[i], self._starts[i], self._ends[i],
+                    None if line_idx < 0 else line_idx, None if speaker < 0 else self.speakers[speaker],
+                    None if emotion < 0 else self.emotions[emotion])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def word_index_at(self, t):
+        """Index of the word at time t, or None"""
+        i = bisect.bisect_right(self._starts, t) - 1
+        if i >= 0 and t <= self._ends[i]:
+            return i
+        return None
+
+    def word_at(self, t):
+        i = self.word_index_at(t)
+        return None if i is None else self[i]
+
+    def words_between(self, a, b):
+        """The words that overlap [a, b]"""
+        # word ends are in order as well as their starts
+        first = bisect.bisect_left(self._ends, a)
+        last = bisect.bisect_right(self._starts, b)
+        return [self[i] for i in range(first, last)]
+
+    def word_phones(self, i):
+        first, last = int(self.phone_first[i]), int(self.phone_last[i])
+        names = self.phones.phone_names
+        return [Phone(names[p], st, en) for p, st, en in
+                zip(self.phones.phone_ids[first:last].tolist(), self.phones.start[first:last].tolist(),
+                    self.phones.end[first:last].tolist())]
+
+    def word_dicts(self, phonemes = False):
+        """The words as the dicts of the JSON output, one at a time"""
+        for i in range(len(self)):
+            word = self[i]
+            d = {"alignedWord": word.alignedWord, "start": word.start, "end": word.end, "word": word.word}
+            if not word.is_pause():
+                # the last word has its phonemes after the rest, as the JSON output always had
+                last = i == len(self) - 1
+                if phonemes and not self.unaligned[i] and not last:
+                    d["phonemes"] = [[p.phone, p.start, p.end] for p in self.word_phones(i)]
+                d["line_idx"] = word.line_idx
+                if word.speaker is not None:
+                    d["speaker"] = word.speaker
+                if word.emotion is not None:
+                    d["emotion"] = word.emotion
+                if phonemes and not self.unaligned[i] and last:
+                    d["phonemes"] = [[p.phone, p.start, p.end] for p in self.word_phones(i)]
+                if self.unaligned[i]:
+                    d["unaligned"] = True
+            yield d
+
+    def to_dict(self, phonemes = False):
+        out_dict = {"words": list(self.word_dicts(phonemes))}
+        if self.viterbi is not None:
+            out_dict["viterbi"] = self.viterbi
+        return out_dict
+
+    def write(self, outputs, phonemes = False, validate = False):
+        """Write the alignment to {format: path} (see export.py)"""
+        export_alignment(outputs, self.phones, self.word_dicts(phonemes), viterbi_report = self.viterbi,
+                         validate = validate)
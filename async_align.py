@@ -0,0 +1,176 @@
+"""
+Alignment on an asyncio event loop.
+
+async_do_alignment does what do_alignment does and gives the same
+outputs, but HCopy and HVite run as asyncio subprocesses, so one event
+loop (e.g. an asyncio web service) can run many alignments at once
+without a thread per job. Each HTK run:
+
+  - holds a slot of a semaphore, so at most P2FA_MAX_HTK (default: the
+    number of CPUs) of them run at a time per event loop, or as many as
+    the semaphore passed as limit allows;
+  - is killed (with anything it started) after timeout seconds, raising
+    asyncio.TimeoutError, or when the task running it is cancelled;
+  - has its stderr captured: an HCopy that exits with an error raises
+    HTKError with its exit status and what it printed, as create_plp
+    does (HVite failures are retried with wider beams, as in viterbi).
+
+The Python parts of an alignment (resampling, the transcript, the
+dictionary, the native decoder) run in the loop's default
+executor so they don't block the loop.
+
+Usage: alignment = await async_do_alignment(wavfile, trsfile, outfile, work_dir = "tmp/job1")
+       results = await async_align_many(manifest, work_root = "tmp")
+"""
+
+import asyncio
+import contextvars
+import os
+import resource
+import signal
+import time
+import weakref
+
+from . import align, metrics
+from .align import HTKError, prepare_alignment, finish_alignment, viterbi_attempts
+from .batch import read_manifest
+
+MAX_HTK = int(os.environ.get("P2FA_MAX_HTK", os.cpu_count() or 4))
+
+# the default limit of each event loop
+_limits = weakref.WeakKeyDictionary()
+
+
+def htk_limit():
+    # the semaphore HTK runs share when no limit is given
+    loop = asyncio.get_running_loop()
+    if loop not in _limits:
+        _limits[loop] = asyncio.Semaphore(MAX_HTK)
+    return _limits[loop]
+
+
+async def run_htk_async(args, stdout = None, timeout = None, limit = None, check = False):
+    # run_htk as a subprocess of the event loop; returns the tool's stderr
+    if limit is None:
+        limit = htk_limit()
+    async with limit:
+        with open(stdout or os.devnull, 'w') as out:
+            start = time.time()
+            before = resource.getrusage(resource.RUSAGE_CHILDREN)
+            proc = await asyncio.create_subprocess_exec(os.path.join(align.HTK_BIN, args[0]), *args[1:],
+                                                        stdout = out, stderr = asyncio.subprocess.PIPE,
+                                                        start_new_session = True)
+            try:
+                _, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+            except BaseException:
+                # timed out or cancelled: the tool and anything it started go
+                try:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                except OSError:
+                    pass
+                await proc.wait()
+                raise
+    # the event loop reaps the tool, so its usage is what the process's children
+    # used meanwhile (also counting other tools that finished at the same time)
+    metrics.child(args[0], time.time() - start, proc.returncode,
+                  metrics.usage_since(before, resource.getrusage(resource.RUSAGE_CHILDREN)))
+    stderr = stderr.decode("utf-8", "replace")
+    if check and proc.returncode != 0:
+        raise HTKError(args[0], proc.returncode, stderr)
+    return stderr
+
+
+def _executor(function, *args):
+    # function(*args) in the loop's default executor, with the metrics being recorded
+    context = contextvars.copy_context()
+    return asyncio.get_running_loop().run_in_executor(None, lambda: context.run(function, *args))
+
+
+async def _in_executor(limit, function, *args):
+    # the native decoder takes an HTK slot like the HVite it replaces
+    async with limit:
+        return await _executor(function, *args)
+
+
+async def create_plp_async(hcopy_config, file_name, work_dir = 'tmp', timeout = None, limit = None):
+    await run_htk_async(['HCopy', '-T', '1', '-C', hcopy_config, '-S',
+                         os.path.join(work_dir, file_name + '_codetr.scp')], timeout = timeout, limit = limit,
+                        check = True)
+
+
+async def viterbi_async(input_mlf, word_dictionary, output_mlf, phoneset, hmmdir, file_name, work_dir = 'tmp',
+                        timeout = None, beam = 0.0, limit = None):
+    if limit is None:
+        limit = htk_limit()
+    if align.DECODER == "native":
+        await _in_executor(limit, align.viterbi, input_mlf, word_dictionary, output_mlf, phoneset, hmmdir,
+                           file_name, work_dir, None, beam)
+        return
+    await run_htk_async(['HVite', '-T', '1', '-a', '-m', '-I', input_mlf, '-H', hmmdir + '/macros', '-H',
+                         hmmdir + '/hmmdefs', '-S', os.path.join(work_dir, file_name + '_test.scp'), '-i',
+                         output_mlf, '-p', '0.0', '-s', '5.0', '-t', str(beam), word_dictionary, phoneset],
+                        stdout = os.path.join(work_dir, file_name + '_aligned.results'), timeout = timeout,
+                        limit = limit)
+
+
+async def viterbi_with_retry_async(input_mlf, word_dictionary, output_mlf, phoneset, hmmdir, file_name,
+                                   work_dir = 'tmp', timeout = None, beams = None, limit = None):
+    # align.viterbi_with_retry with the viterbi runs on the event loop
+    attempts = viterbi_attempts(output_mlf, file_name, work_dir, beams)
+    try:
+        attempt_mlf, attempt_name, beam = next(attempts)
+        while True:
+            start = time.time()
+            await viterbi_async(input_mlf, word_dictionary, attempt_mlf, phoneset, hmmdir, attempt_name, work_dir,
+                                timeout, beam, limit)
+            attempt_mlf, attempt_name, beam = attempts.send(round(time.time() - start, 3))
+    except StopIteration as done:
+        return done.value
+
+
+async def async_do_alignment(wavfile, trsfile, outfile, json = True, textgrid = False, phonemes = False,
+                             prune_dict = False, work_dir = 'tmp', timeout = None, wave_start = "0.0",
+                             wave_end = None, beams = None, feature_cache = None, formats = (), validate = True,
+                             limit = None):
+    # align.do_alignment on the event loop; alignments running at the same
+    # time need different work_dirs, as with do_alignment
+    job = await _executor(prepare_alignment, wavfile, trsfile, prune_dict, work_dir, wave_start, wave_end,
+                          feature_cache)
+
+    if not job.have_features:
+        with metrics.stage("create_plp"):
+            await create_plp_async(job.hcopy_config, job.file_name, work_dir, timeout, limit)
+        job.cache_features()
+
+    with metrics.stage("viterbi"):
+        entries, reports = await viterbi_with_retry_async(job.input_mlf, job.word_dictionary, job.output_mlf,
+                                                          job.phoneset, job.hmmdir, job.file_name, work_dir,
+                                                          timeout, beams, limit)
+    return await _executor(finish_alignment, job, entries, reports, outfile, json, textgrid, phonemes, formats,
+                           validate)
+
+
+async def async_align_many(manifest, json = True, textgrid = False, phonemes = False, prune_dict = False,
+                           work_root = 'tmp', timeout = None, beams = None, feature_cache = None, formats = (),
+                           validate = True, limit = None):
+    # Align every job of manifest (as for batch.align_batch) concurrently, each
+    # in its own work_dir under work_root. Returns the results in manifest order,
+    # with a job's exception as its error; cancelling this cancels every job.
+    jobs = read_manifest(manifest)
+
+    async def run(i, job):
+        options = dict((k, v) for k, v in job.options.items() if k in ("wave_start", "wave_end"))
+        try:
+            job.alignment = await async_do_alignment(job.wavfile, job.trsfile, job.outfile, json, textgrid, phonemes,
+                                                     prune_dict, os.path.join(work_root, "job%d" % i), timeout,
+                                                     beams = beams, feature_cache = feature_cache, formats = formats,
+                                                     validate = validate, limit = limit, **options)
+            job.report = job.alignment.viterbi
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            job.error = "%s: %s" % (type(e).__name__, e)
+
+    await asyncio.gather(*[run(i, job) for i, job in enumerate(jobs)])
+    return [job.result() for job in jobs]
+
@@ -0,0 +1,196 @@
+"""
+Prepare wav files for HCopy without sox.
+
+The input is read in blocks, trimmed to the requested stretch to the
+sample, and resampled with a polyphase windowed-sinc filter in NumPy.
+Output is 16-bit PCM with the input's channels, like sox wrote it. When
+no conversion is needed the original file is hard linked (or symlinked)
+into the working directory instead of copied.
+
+Usage: prepare_wav("in.wav", "tmp/in_sound.wav", 11025, 12.5, 60.0)
+"""
+
+import os
+import shutil
+import wave
+from fractions import Fraction
+
+import numpy as np
+
+BLOCK_FRAMES = 1 << 16
+HALF_TAPS = 16          # filter taps either side of an output sample, at the lower rate
+KAISER_BETA = 8.6
+
+
+def wav_info(wavfile):
+    """(sample rate, number of frames) of a wav file"""
+    f = wave.open(wavfile, 'r')
+    info = (f.getframerate(), f.getnframes())
+    f.close()
+    return info
+
+
+def link_or_copy(src, dst):
+    # the working copy is only read, so the original file will do
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    try:
+        os.symlink(os.path.abspath(src), dst)
+        return
+    except OSError:
+        pass
+    shutil.copy(src, dst)
+
+
+def _to_float(data, sampwidth, channels):
+    if sampwidth == 1:
+        x = np.frombuffer(data, dtype=np.uint8).astype(np.float64) - 128.0
+        scale = 128.0
+    elif sampwidth == 2:
+        x = np.frombuffer(data, dtype='<i2').astype(np.float64)
+        scale = 32768.0
+    elif sampwidth == 3:
+        b = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        x = (b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)).astype(np.float64)
+        x[x >= 1 << 23] -= 1 << 24
+        scale = float(1 << 23)
+    elif sampwidth == 4:
+        x = np.frombuffer(data, dtype='<i4').astype(np.float64)
+        scale = float(1 << 31)
+    else:
+        raise ValueError("unsupported sample width: %d bytes" % sampwidth)
+    return (x / scale).reshape(-1, channels)
+
+
+def _to_int16(x):
+    return np.clip(np.round(x * 32768.0), -32768, 32767).astype('<i2').tobytes()
+
+
+def read_wav(wavfile):
+    """(samples as a (frames, channels) float array in [-1, 1), sample rate) of a wav file"""
+    f = wave.open(wavfile, 'r')
+    try:
+        SR = f.getframerate()
+        x = _to_float(f.readframes(f.getnframes()), f.getsampwidth(), f.getnchannels())
+    finally:
+        f.close()
+    return x, SR
+
+
+def write_wav(wavfile, x, SR):
+    """Write (frames, channels) or (frames,) float samples to wavfile as 16-bit PCM"""
+    x = np.asarray(x)
+    if x.ndim == 1:
+        x = x[:, None]
+    if os.path.lexists(wavfile):
+        os.remove(wavfile)
+    out = wave.open(wavfile, 'w')
+    try:
+        out.setnchannels(x.shape[1])
+        out.setsampwidth(2)
+        out.setframerate(SR)
+        out.writeframes(_to_int16(x))
+    finally:
+        out.close()
+
+
+class Resampler(object):
+    """Streaming resampler from sr_in to sr_out: feed() blocks of (frames, channels)
+    samples and get back the output samples that are complete, then flush()."""
+
+    def __init__(self, sr_in, sr_out, channels = 1, half_taps = HALF_TAPS):
+        ratio = Fraction(int(sr_out), int(sr_in))
+        self.up = ratio.numerator
+        self.down = ratio.denominator
+        self.channels = channels
+
+        # cutoff at the lower of the two Nyquist frequencies, in input samples
+        cutoff = min(1.0, float(self.up) / self.down)
+        self.half = int(np.ceil(half_taps / cutoff))
+        # table[p, j]: weight of input sample base + j - half + 1 for an output
+        # at input position base + p / up
+        offsets = np.arange(-self.half + 1, self.half + 1)
+        tau = np.arange(self.up)[:, None] / float(self.up) - offsets[None, :]
+        window = np.kaiser(2 * self.half + 1, KAISER_BETA)
+        window = np.interp(tau, np.arange(-self.half, self.half + 1), window, left=0.0, right=0.0)
+        self.table = cutoff * np.sinc(cutoff * tau) * window
+
+        self.buf = np.zeros((self.half - 1, channels))   # zeros before the start of the signal
+        self.buf_start = -(self.half - 1)
+        self.n_in = 0
+        self.n_out = 0
+
+    def _run(self, last):
+        # outputs whose taps all lie within the buffer
+        n = np.arange(self.n_out, last)
+        if len(n) == 0:
+            return np.zeros((0, self.channels))
+        pos = n * self.down
+        base = pos // self.up
+        phase = pos % self.up
+        idx = (base - self.buf_start - self.half + 1)[:, None] + np.arange(2 * self.half)[None, :]
+        out = np.einsum('nk,nkc->nc', self.table[phase], self.buf[idx])
+        self.n_out = last
+
+        keep = (self.n_out * self.down) // self.up - self.half + 1 - self.buf_start
+        if keep > 0:
+            self.buf = self.buf[keep:]
+            self.buf_start += keep
+        return out
+
+    def feed(self, x):
+        self.buf = np.concatenate([self.buf, x])
+        self.n_in += len(x)
+        buf_end = self.buf_start + len(self.buf)
+        # an output at base needs input up to base + half
+        last = max(((buf_end - self.half) * self.up - 1) // self.down + 1, self.n_out)
+        return self._run(last)
+
+    def flush(self):
+        total = -(-self.n_in * self.up // self.down)
+        self.buf = np.concatenate([self.buf, np.zeros((2 * self.half, self.channels))])
+        return self._run(total)
+
+
+def prepare_wav(orig_wav, out_wav, new_sr, wave_start = 0.0, wave_end = None):
+    """Write the [wave_start, wave_end) seconds of orig_wav to out_wav at new_sr as 16-bit PCM"""
+    f = wave.open(orig_wav, 'r')
+    SR = f.getframerate()
+    channels = f.getnchannels()
+    sampwidth = f.getsampwidth()
+    nframes = f.getnframes()
+
+    first = min(int(round(float(wave_start) * SR)), nframes)
+    last = nframes if wave_end is None else min(int(round(float(wave_end) * SR)), nframes)
+    f.setpos(first)
+
+    resampler = Resampler(SR, new_sr, channels) if new_sr != SR else None
+
+    # out_wav may be a link to an original left by link_or_copy
+    if os.path.lexists(out_wav):
+        os.remove(out_wav)
+    out = wave.open(out_wav, 'w')
+    out.setnchannels(channels)
+    out.setsampwidth(2)
+    out.setframerate(new_sr)
+    try:
+        remaining = max(last - first, 0)
+        while remaining > 0:
+            data = f.readframes(min(BLOCK_FRAMES, remaining))
+            if not data:
+                break
+            x = _to_float(data, sampwidth, channels)
+            remaining -= len(x)
+            if resampler is not None:
+                x = resampler.feed(x)
+            out.writeframes(_to_int16(x))
+        if resampler is not None:
+            out.writeframes(_to_int16(resampler.flush()))
+    finally:
+        out.close()
+        f.close()
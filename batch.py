@@ -0,0 +1,269 @@
+"""
+Align many wav/transcript pairs at once.
+
+Every utterance is prepared as in do_alignment (resampled wav, input MLF
+entry, new pronunciations), then all utterances with the same sample rate
+share one .scp, one MLF and one dictionary, so HCopy and HVite start and
+load the models once per sample rate rather than once per file. The batch
+output MLF is split back into per-file JSON/TextGrid outputs.
+
+The manifest is a list of {"wavfile": ..., "trsfile": ..., "outfile": ...}
+(or (wavfile, trsfile, outfile) tuples), or the path of a JSON file with
+such a list or of a tab-separated file with those three columns. A dict
+entry may also set wave_start/wave_end (the part of the wav to align) and
+json, textgrid, phonemes, formats or validate (its outputs) for that file;
+a job with any other key fails rather than have it ignored. Each result
+has the file's Alignment (alignment.py); a job with no outfile is kept in
+memory only.
+
+Command line: python -m p2fa_vislab.batch [options] manifest
+"""
+
+import os
+import zlib
+
+try:
+    import simplejson as json
+except:
+    import json
+
+
+from .align import GlobalMap, MODEL_DIR, SR_MODELS, target_sr, prep_wav, prep_mlf, \
+    prep_working_directory, prep_batch_scp, create_plp, viterbi_with_retry, parseAlignedMLFEntry, writeOutputs, \
+    makeAlignment, dictTmpLines, job_file_name, phoneset_file, parse_beams, HTKError
+from . import metrics
+from .dictionary import load_dictionary
+from .features import default_feature_cache
+
+# the manifest keys align_batch honours per job, besides wavfile, trsfile and outfile
+JOB_OPTIONS = ("wave_start", "wave_end", "json", "textgrid", "phonemes", "formats", "validate")
+
+
+class BatchJob:
+    def __init__(self, wavfile, trsfile, outfile, options = None):
+        self.wavfile = wavfile
+        self.trsfile = trsfile
+        self.outfile = outfile
+        # any other keys of the manifest entry, e.g. wave_start/wave_end for parallel jobs
+        self.options = options or {}
+        self.file_name = None
+        self.global_map = GlobalMap()
+        self.SR = None
+        self.wave_start = "0.0"
+        self.wave_end = None
+        self.outputs = {}
+        self.cache_key = None
+        self.have_features = False
+        self.words = []
+        self.dict_tmp = {}
+        self.report = None
+        self.alignment = None
+        self.error = None
+
+    def result(self):
+        return {"wavfile": self.wavfile, "trsfile": self.trsfile, "outfile": self.outfile, "error": self.error,
+                "viterbi": self.report, "alignment": self.alignment}
+
+
+def read_manifest(manifest):
+    # a malformed entry raises ValueError naming it
+    if isinstance(manifest, str) and not manifest.endswith(".json"):
+        return read_tsv_manifest(manifest)
+    if isinstance(manifest, str):
+        with open(manifest, 'r') as f:
+            manifest = json.load(f)
+
+    jobs = []
+    for i, entry in enumerate(manifest, 1):
+        if isinstance(entry, dict):
+            if "wavfile" not in entry or "trsfile" not in entry:
+                raise ValueError("Manifest entry %d has no wavfile or no trsfile" % i)
+            options = dict((k, v) for k, v in entry.items() if k not in ("wavfile", "trsfile", "outfile"))
+            jobs.append(BatchJob(entry["wavfile"], entry["trsfile"], entry.get("outfile"), options))
+        elif not 3 <= len(entry) <= 4:
+            raise ValueError("Manifest entry %d has %d fields, not (wavfile, trsfile, outfile)" % (i, len(entry)))
+        else:
+            jobs.append(BatchJob(*entry))
+    return jobs
+
+
+def read_tsv_manifest(path):
+    jobs = []
+    with open(path, 'r') as f:
+        for i, line in enumerate(f, 1):
+            if line.strip() == "" or line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) != 3:
+                raise ValueError("%s line %d has %d columns, not wavfile, trsfile and outfile" %
+                                 (path, i, len(fields)))
+            jobs.append(BatchJob(*fields))
+    return jobs
+
+
+def writeBatchMLF(mlffile, input_mlfs):
+    # concatenate the entries of several single-file MLFs
+    with open(mlffile, 'w') as fw:
+        fw.write('#!MLF!#\n')
+        for input_mlf in input_mlfs:
+            with open(input_mlf, 'r') as f:
+                lines = f.readlines()
+            fw.writelines(lines[1:])
+
+
+def align_batch(manifest, json = True, textgrid = False, phonemes = False, prune_dict = False, work_dir = 'tmp',
+                timeout = None, beams = None, feature_cache = None, formats = (), validate = True):
+    jobs = read_manifest(manifest)
+    surround_token = "sp"
+    between_token = ["sp"]
+    outputs = {"json": json, "textgrid": textgrid, "phonemes": phonemes, "formats": formats, "validate": validate}
+
+    prep_working_directory(work_dir)
+    with metrics.stage("dictionary"):
+        dictionary = load_dictionary(MODEL_DIR)
+    if feature_cache is None:
+        feature_cache = default_feature_cache()
+
+    names = set()
+    groups = {}
+    for job in jobs:
+        file_name = job_file_name(job.wavfile)
+        unique_name = file_name
+        n = 0
+        while unique_name in names:
+            n += 1
+            unique_name = "%s_%d" % (file_name, n)
+        names.add(unique_name)
+        job.file_name = file_name = unique_name
+
+        try:
+            unknown = sorted(k for k in job.options if k not in JOB_OPTIONS)
+            if unknown:
+                raise ValueError("Options not supported in a batch: %s" % ", ".join(unknown))
+            job.wave_start = str(float(job.options.get("wave_start", "0.0")))
+            job.wave_end = job.options.get("wave_end")
+            if job.wave_end is not None:
+                job.wave_end = str(float(job.wave_end))
+            job.outputs = dict(outputs)
+            job.outputs.update((k, v) for k, v in job.options.items() if k in outputs)
+
+            tmpwav = os.path.join(work_dir, file_name + '_sound.wav')
+            job.SR, _ = target_sr(job.wavfile, None, SR_MODELS, job.wave_start, job.wave_end)
+            if feature_cache is not False:
+                with metrics.stage("feature_cache"):
+                    job.cache_key = feature_cache.key(job.wavfile, job.wave_start, job.wave_end, job.SR,
+                                                      MODEL_DIR + "/" + str(job.SR) + '/config')
+                    job.have_features = feature_cache.get(job.cache_key, tmpwav,
+                                                          os.path.join(work_dir, file_name + '_tmp.plp'))
+            if not job.have_features:
+                with metrics.stage("prep_wav"):
+                    prep_wav(job.wavfile, tmpwav, None, SR_MODELS, job.wave_start, job.wave_end)
+            # each job's new pronunciations stay in memory until its group's dictionary is written
+            with metrics.stage("prep_mlf"):
+                job.words, job.dict_tmp = prep_mlf(job.trsfile, os.path.join(work_dir, file_name + '_tmp.mlf'),
+                                                   dictionary, surround_token, between_token, file_name,
+                                                   job.global_map, dialog_file = True, dict_tmp_file = None)
+        except Exception as e:
+            job.error = "%s: %s" % (type(e).__name__, e)
+            continue
+        groups.setdefault(job.SR, []).append(job)
+
+    for SR, group in sorted(groups.items()):
+        batch_name = "batch_%d_%08x" % (SR, zlib.crc32(" ".join(j.file_name for j in group).encode("utf-8")))
+        word_dictionary = os.path.join(work_dir, batch_name + '.dict')
+        input_mlf = os.path.join(work_dir, batch_name + '_tmp.mlf')
+        output_mlf = os.path.join(work_dir, batch_name + '_aligned.mlf')
+
+        writeBatchMLF(input_mlf, [os.path.join(work_dir, j.file_name + '_tmp.mlf') for j in group])
+
+        dict_tmp = {}
+        words = []
+        for job in group:
+            dict_tmp.update(job.dict_tmp)
+            words.extend(job.words)
+        with metrics.stage("write_dict"):
+            if prune_dict:
+                dictionary.write_pruned_dict(word_dictionary, set(words), dictTmpLines(dict_tmp))
+            else:
+                dictionary.write_htk_dict(word_dictionary, dictTmpLines(dict_tmp))
+
+        hmmdir = MODEL_DIR + "/" + str(SR)
+        prep_batch_scp([(os.path.join(work_dir, j.file_name + '_sound.wav'), j.file_name) for j in group],
+                       batch_name, work_dir, set(j.file_name for j in group if j.have_features))
+        to_extract = [j for j in group if not j.have_features]
+        if to_extract:
+            try:
+                with metrics.stage("create_plp"):
+                    create_plp(hmmdir + '/config', batch_name, work_dir, timeout)
+            except HTKError as e:
+                # the group's HCopy run failed, so none of its files can be aligned
+                for job in group:
+                    job.error = "%s: %s" % (type(e).__name__, e)
+                continue
+            for job in to_extract:
+                if job.cache_key is not None:
+                    with metrics.stage("feature_cache"):
+                        feature_cache.put(job.cache_key, os.path.join(work_dir, job.file_name + '_sound.wav'),
+                                          os.path.join(work_dir, job.file_name + '_tmp.plp'))
+        # files that fail with a tight beam are retried on their own with wider ones
+        with metrics.stage("viterbi"):
+            entries, reports = viterbi_with_retry(input_mlf, word_dictionary, output_mlf, phoneset_file(MODEL_DIR),
+                                                  hmmdir, batch_name, work_dir, timeout, beams)
+
+        for job in group:
+            job.report = reports[job.file_name]
+            if job.file_name not in entries:
+                job.error = "Alignment did not complete succesfully."
+                continue
+            try:
+                with metrics.stage("read_mlf"):
+                    job.alignment = makeAlignment(parseAlignedMLFEntry(entries[job.file_name], SR,
+                                                                       float(job.wave_start)),
+                                                  job.global_map, reports[job.file_name])
+                if job.outfile is not None:
+                    with metrics.stage("write_outputs"):
+                        writeOutputs(job.outfile, job.alignment, **job.outputs)
+            except Exception as e:
+                job.error = "%s: %s" % (type(e).__name__, e)
+
+    return [job.result() for job in jobs]
+
+
+def make_cli():
+    # click is only imported when the command line is used
+    import click
+
+    @click.command()
+    @click.argument('manifest')
+    @click.option('--json/--no-json', default = True, help = "Export json alignment")
+    @click.option('--textgrid/--no-textgrid', default = False, help = "Export Praat TextGrid alignment")
+    @click.option('--phonemes/--no-phonemes', default = False, help = "Add phoneme information to JSON output")
+    @click.option('--prune-dict/--no-prune-dict', default = False,
+                  help = "Give HVite a dictionary with only the words in the transcripts")
+    @click.option('--beams', default = None, help = "Comma-separated HVite beam widths to try in turn (0 is no pruning)")
+    @click.option('--feature-cache/--no-feature-cache', default = None,
+                  help = "Reuse the prepared audio and features of audio aligned before (default: only when "
+                         "P2FA_FEATURE_CACHE is set)")
+    @click.option('--format', 'formats', multiple = True, type = click.Choice(["csv", "ndjson", "textgrid"]),
+                  help = "Also write this format, next to each outfile with its extension (repeatable)")
+    @click.option('--validate/--no-validate', default = True, help = "Check the json output against the schema")
+    def cli_align_batch(manifest, json, textgrid, phonemes, prune_dict, beams, feature_cache, formats, validate):
+        results = align_batch(manifest, json, textgrid, phonemes, prune_dict, beams = parse_beams(beams),
+                              feature_cache = default_feature_cache(feature_cache), formats = formats,
+                              validate = validate)
+        failed = [r for r in results if r["error"] is not None]
+        for r in failed:
+            print("%s: %s" % (r["wavfile"], r["error"]))
+        print("Aligned %d of %d files" % (len(results) - len(failed), len(results)))
+
+    return cli_align_batch
+
+
+def __getattr__(name):
+    if name == 'cli_align_batch':
+        return make_cli()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+if __name__ == '__main__':
+    make_cli()()
@@ -0,0 +1 @@
+# Benchmarks for p2fa_vislab; each module runs with python -m p2fa_vislab.benchmarks.<name>
@@ -0,0 +1,154 @@
+"""
+Deterministic stand-ins for HCopy and HVite, so the pipeline runs (and
+can be benchmarked) without HTK.
+
+HCopy writes, for every wav of its -S script, a .plp with a real HTK
+header (10 ms frames of 39 PLP coefficients) and all-zero features.
+HVite aligns every .plp of its -S script to its entry of the -I MLF:
+each word gets its first pronunciation from the dictionary, every phone
+lasts PHONE_FRAMES frames, and every PAUSE_EVERY-th sp is a pause of
+PAUSE_FRAMES frames (the others are empty). It prints the "Aligning
+File:" and "[Ac=...]" lines HVite does, and a file with no pronunciation
+for one of its words is left out of the output MLF, as HVite leaves out
+a file it can't align. The same inputs always give the same outputs.
+
+Usage: bin_dir = install(work_dir); align.HTK_BIN = bin_dir
+Command line: python -m p2fa_vislab.benchmarks.fake_htk HVite [HVite arguments]
+"""
+
+import os
+import stat
+import struct
+import sys
+import wave
+
+PACKAGE = __package__.rsplit(".", 1)[0]
+
+FRAME = 100000
+PHONE_FRAMES = 3
+PAUSE_EVERY = 7
+PAUSE_FRAMES = 20
+PLP_COEFFICIENTS = 39
+# PLP_0_D_A_Z
+PLP_KIND = 11 | 0o20000 | 0o400 | 0o1000 | 0o4000
+
+
+def options(args, flags_with_values):
+    # ({flag: [values]}, positional arguments) of an HTK command line
+    opts = {}
+    rest = []
+    i = 0
+    while i < len(args):
+        if args[i] in flags_with_values:
+            opts.setdefault(args[i], []).append(args[i + 1])
+            i += 2
+        elif args[i].startswith("-") and len(args[i]) == 2:
+            i += 1
+        else:
+            rest.append(args[i])
+            i += 1
+    return opts, rest
+
+
+def hcopy(args):
+    opts, _ = options(args, ("-C", "-S", "-T"))
+    with open(opts["-S"][0], 'r') as f:
+        pairs = [line.split() for line in f if line.strip()]
+    for wav, plp in pairs:
+        w = wave.open(wav, 'rb')
+        frames = int(w.getnframes() * 10000000 // (w.getframerate() * FRAME))
+        w.close()
+        with open(plp, 'wb') as f:
+            f.write(struct.pack(">iihh", frames, FRAME, PLP_COEFFICIENTS * 4, PLP_KIND))
+            f.write(b"\0" * (frames * PLP_COEFFICIENTS * 4))
+    return 0
+
+
+def read_mlf(path):
+    # {name: [labels]} of a label MLF ("*/name_tmp.lab" entries)
+    entries = {}
+    name = None
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line.startswith('"') and line.endswith('.lab"'):
+                name = os.path.basename(line.strip('"'))
+                name = name[:-len("_tmp.lab")] if name.endswith("_tmp.lab") else os.path.splitext(name)[0]
+                entries[name] = []
+            elif line == "." or line.startswith("#!MLF!#"):
+                name = None
+            elif name is not None:
+                if line.startswith('"') and line.endswith('"'):
+                    line = line[1:-1]
+                entries[name].append(line[1:] if line.startswith("\\") else line)
+    return entries
+
+
+def read_dict(path):
+    # the first pronunciation of every word
+    prons = {}
+    with open(path, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if fields and fields[0] not in prons:
+                prons[fields[0]] = fields[1:]
+    return prons
+
+
+def hvite(args):
+    opts, rest = options(args, ("-T", "-I", "-H", "-S", "-i", "-p", "-s", "-t"))
+    dictionary = read_dict(rest[0])
+    labels = read_mlf(opts["-I"][0])
+    with open(opts["-S"][0], 'r') as f:
+        plps = [line.strip() for line in f if line.strip()]
+
+    out = open(opts["-i"][0], 'w')
+    out.write("#!MLF!#\n")
+    for plp in plps:
+        name = os.path.basename(plp)[:-len("_tmp.plp")]
+        print("Aligning File: %s" % plp)
+        words = labels.get(name, [])
+        if any(w not in dictionary for w in words):
+            print(" No tokens survived to final node of network at beam %s" % opts["-t"][0])
+            continue
+
+        lines = []
+        t = 0
+        pauses = 0
+        for w in words:
+            for k, ph in enumerate(dictionary[w]):
+                if ph == "sp":
+                    pauses += 1
+                    frames = PAUSE_FRAMES if pauses % PAUSE_EVERY == 0 else 0
+                else:
+                    frames = PHONE_FRAMES
+                lines.append("%d %d %s %.6f%s\n" % (t, t + frames * FRAME, ph, -1.5 * frames,
+                                                      " " + w if k == 0 else ""))
+                t += frames * FRAME
+        out.write('"%s/%s_tmp.rec"\n' % (os.path.dirname(plp), name))
+        out.writelines(lines)
+        out.write(".\n")
+        print(" ==  [%d frames] -1.5000 [Ac=%.1f LM=0.0] (Act=1.0)" % (t // FRAME, -1.5 * (t // FRAME)))
+    out.close()
+    return 0
+
+
+TOOLS = {"HCopy": hcopy, "HVite": hvite}
+
+
+def install(bin_dir):
+    """Write HCopy and HVite scripts running the stand-ins into bin_dir, returns bin_dir"""
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    if not os.path.exists(bin_dir):
+        os.makedirs(bin_dir)
+    for tool in TOOLS:
+        path = os.path.join(bin_dir, tool)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nPYTHONPATH="%s${PYTHONPATH:+:$PYTHONPATH}" '
+                    'exec "%s" -m %s.benchmarks.fake_htk %s "$@"\n' % (root, sys.executable, PACKAGE, tool))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return bin_dir
+
+
+if __name__ == '__main__':
+    sys.exit(TOOLS[sys.argv[1]](sys.argv[2:]))
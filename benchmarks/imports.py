@@ -0,0 +1,104 @@
+"""
+Import time and memory of the aligner and each of its dependencies.
+
+Every entry is imported (or run) in a fresh interpreter, repeat times,
+and the fastest run is reported with the growth in peak RSS it caused.
+The lazy entries measure what is deferred to first use: the schemas and
+their compiled validators, and inflect.
+
+Command line: python -m p2fa_vislab.benchmarks.imports [--repeat 5] [--out imports.json]
+"""
+
+import os
+import subprocess
+import sys
+
+try:
+    import simplejson as json
+except:
+    import json
+
+PACKAGE = __package__.rsplit(".", 1)[0]
+
+# (name, statement run in a fresh interpreter)
+ENTRIES = [
+    ("numpy", "import numpy"),
+    ("simplejson", "import simplejson"),
+    ("click", "import click"),
+    ("jsonschema", "import jsonschema"),
+    ("tgt", "import tgt"),
+    ("inflect", "import inflect"),
+    ("requests", "import requests"),
+    (PACKAGE + ".align", "import %s.align" % PACKAGE),
+    (PACKAGE + ".batch", "import %s.batch" % PACKAGE),
+    (PACKAGE + ".detect_breaths", "import %s.detect_breaths" % PACKAGE),
+    ("lazy: schemas and validators",
+     "import %s.schemas as s; s.validator('transcript'); s.validator('word')" % PACKAGE),
+    ("lazy: number pronunciation", "import %s.numerals as n; n.engine()" % PACKAGE),
+]
+
+CHILD = """
+import resource, time, sys
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+exec(sys.argv[1])
+seconds = time.perf_counter() - start
+after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print("%r %d" % (seconds, after - before))
+"""
+
+
+def measure(statement, repeat = 5):
+    # (fastest seconds, peak RSS growth in KiB) of statement in fresh interpreters
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    env["PYTHONPATH"] = root + os.pathsep + env.get("PYTHONPATH", "")
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", CHILD, statement], env = env, stdout = subprocess.PIPE,
+                             stderr = subprocess.PIPE, universal_newlines = True)
+        if out.returncode != 0:
+            return None, None, out.stderr.strip().splitlines()[-1]
+        seconds, kib = out.stdout.split()
+        runs.append((float(seconds), int(kib)))
+    seconds, kib = min(runs)
+    return seconds, kib, None
+
+
+def run(repeat = 5, entries = None):
+    results = []
+    for name, statement in entries or ENTRIES:
+        seconds, kib, error = measure(statement, repeat)
+        results.append({"name": name, "seconds": seconds, "rss_kib": kib, "error": error})
+    return results
+
+
+def make_cli():
+    # click is only imported when the command line is used
+    import click
+
+    @click.command()
+    @click.option('--repeat', default = 5, help = "Fresh interpreters per entry; the fastest is reported")
+    @click.option('--out', default = None, help = "Also write the results to this JSON file")
+    def cli_import_benchmark(repeat, out):
+        results = run(repeat)
+        for r in results:
+            if r["error"] is not None:
+                print("%-40s  failed: %s" % (r["name"], r["error"]))
+            else:
+                print("%-40s %8.1f ms %8d KiB" % (r["name"], r["seconds"] * 1000, r["rss_kib"]))
+        if out is not None:
+            with open(out, 'w') as f:
+                json.dump(results, f, indent = 4)
+
+    return cli_import_benchmark
+
+
+def __getattr__(name):
+    if name == 'cli_import_benchmark':
+        return make_cli()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+if __name__ == '__main__':
+    make_cli()()
@@ -0,0 +1,162 @@
+"""
+The stages of stages.py run by the aligner as it was before the
+performance work (commit 2937741), for a baseline that shows what that
+work changed. The inputs are the same synthetic ones; only the code being
+timed is the old tree's, imported from a checkout of it:
+
+  git worktree add /tmp/p2fa-pre 2937741
+  cp -r alignment-schemas /tmp/p2fa-pre/
+  python -m p2fa_vislab.benchmarks.stages --tree /tmp/p2fa-pre --out pre.json
+
+Stages the old code has no counterpart for, or can't run here, are
+skipped with the reason: there was no dictionary index (its prep_mlf read
+model/dict on every call, which its prep_mlf times include), prep_wav
+needs sox, and do_alignment runs HCopy and HVite from a fixed path. Its
+lextool is lextool_stub.py, its resolve_oov is Pronounce().p(), and its
+writeJSON always validates the output.
+
+Usage: tree = load_tree("/tmp/p2fa-pre"); run, units = stage("prep_mlf", tree, inputs, scratch)
+"""
+
+import importlib
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+
+from ..lextool_stub import start_stub
+
+TREE_PACKAGE = "p2fa_pre_series"
+
+
+class Unavailable(Exception):
+    # the stage can't be timed on this tree
+    pass
+
+
+def load_tree(path):
+    """The package checked out at path, imported as p2fa_pre_series"""
+    path = os.path.realpath(path)
+    if os.path.exists(os.path.join(path, "benchmarks", "stages.py")):
+        raise ValueError("%s has stage benchmarks of its own; run those" % path)
+    if not os.path.exists(os.path.join(path, "alignment-schemas", "transcript_schema.json")):
+        raise ValueError("%s has no alignment-schemas (copy them in, it is a submodule)" % path)
+    spec = importlib.util.spec_from_file_location(TREE_PACKAGE, os.path.join(path, "__init__.py"),
+                                                  submodule_search_locations = [path])
+    package = importlib.util.module_from_spec(spec)
+    sys.modules[TREE_PACKAGE] = package
+    spec.loader.exec_module(package)
+    package.path = path
+    # (recorded with the results)
+    git = subprocess.run(["git", "-C", path, "rev-parse", "--short", "HEAD"], stdout = subprocess.PIPE,
+                         stderr = subprocess.DEVNULL, universal_newlines = True)
+    package.commit = git.stdout.strip() if git.returncode == 0 else None
+    return package
+
+
+def module(tree, name):
+    return importlib.import_module(tree.__name__ + "." + name)
+
+
+def old_prep_mlf(tree, trsfile, mlffile, global_map):
+    # prep_mlf read the dictionary and wrote dict.tmp (in the working directory) every time
+    align = module(tree, "align")
+    align.prep_mlf(trsfile, mlffile, os.path.join(tree.path, "model", "dict"), "sp", ["sp"], "bench", global_map,
+                   dialog_file = True)
+
+
+def stage_prep_mlf(tree, inputs, scratch):
+    align = module(tree, "align")
+    trsfile = inputs.transcript()
+
+    def run():
+        old_prep_mlf(tree, trsfile, os.path.join(scratch, "bench_tmp.mlf"), align.GlobalMap())
+    return run, "transcript words"
+
+
+def stage_resolve_oov(tree, inputs, scratch):
+    from .stages import OOV_FRACTION, make_oov_words
+    from .. import align, dictionary
+    pronunciation = module(tree, "pronunciation")
+    idx = dictionary.load_dictionary(align.MODEL_DIR, local_dict = None)
+    words = make_oov_words(max(inputs.size // OOV_FRACTION, 1), idx)
+
+    def run():
+        pronunciation.Pronounce(words).p(add_fake_stress = True)
+    return run, "out-of-dictionary words (size / %d)" % OOV_FRACTION
+
+
+def stage_prep_wav(tree, inputs, scratch):
+    if shutil.which("sox") is None:
+        raise Unavailable("its prep_wav runs sox, which isn't installed")
+    from .stages import WORD_SECONDS
+    align = module(tree, "align")
+    wavfile = inputs.wav()
+
+    def run():
+        align.prep_wav(wavfile, os.path.join(scratch, "bench_sound.wav"), None, [8000, 11025, 16000], "0.0", None)
+    return run, "words of audio (%g s each)" % WORD_SECONDS
+
+
+def stage_readAlignedMLF(tree, inputs, scratch):
+    align = module(tree, "align")
+    mlffile, _ = inputs.aligned()
+
+    def run():
+        align.readAlignedMLF(mlffile, 11025, 0.0)
+    return run, "transcript words"
+
+
+def stage_writeJSON(tree, inputs, scratch):
+    align = module(tree, "align")
+    mlffile, _ = inputs.aligned()
+    word_alignments = align.readAlignedMLF(mlffile, 11025, 0.0)
+    # the old tree's own word map of the transcript
+    global_map = align.GlobalMap()
+    old_prep_mlf(tree, inputs.transcript(), os.path.join(scratch, "bench_tmp.mlf"), global_map)
+
+    def run():
+        align.writeJSON(os.path.join(scratch, "out.json"), word_alignments, global_map, phonemes = True)
+    return run, "transcript words"
+
+
+def stage_writeTextGrid(tree, inputs, scratch):
+    align = module(tree, "align")
+    mlffile, _ = inputs.aligned()
+    word_alignments = align.readAlignedMLF(mlffile, 11025, 0.0)
+
+    def run():
+        align.writeTextGrid(os.path.join(scratch, "out.TextGrid"), word_alignments)
+    return run, "transcript words"
+
+
+UNAVAILABLE = {
+    "dictionary_compile": "there was no dictionary index (prep_mlf read model/dict every time)",
+    "dictionary_load": "there was no dictionary index (prep_mlf read model/dict every time)",
+    "do_alignment": "its do_alignment runs sox and HTK from /home/wenhao/software/bin",
+}
+
+
+def stage(name, tree, inputs, scratch):
+    """(run, units) of the old tree's stage name, as the stage functions of stages.py"""
+    if name in UNAVAILABLE:
+        raise Unavailable(UNAVAILABLE[name])
+    # whatever the old code asks the lextool (its prep_mlf asks about words it
+    # can't pronounce itself) goes to the stand-in
+    pronunciation = module(tree, "pronunciation")
+    server, url = start_stub()
+    saved = pronunciation.Pronounce.url
+    pronunciation.Pronounce.url = url
+
+    def cleanup():
+        server.shutdown()
+        server.server_close()
+        pronunciation.Pronounce.url = saved
+    try:
+        run, units = globals()["stage_" + name](tree, inputs, scratch)
+    except BaseException:
+        cleanup()
+        raise
+    run.cleanup = cleanup
+    return run, units
@@ -0,0 +1,461 @@
+"""
+Time each stage of an alignment on its own, at several input sizes.
+
+Every input is synthetic and made from a fixed seed: transcripts of size
+words drawn from model/dict (with punctuation, hyphenated words and
+numbers), a local dictionary of size words, size // 20 out-of-dictionary
+words, WORD_SECONDS of 44.1 kHz audio per word (resampled by prep_wav)
+and the aligned MLF the stand-in HVite of fake_htk.py makes for the
+transcript. The stages:
+
+  dictionary_compile  compile model/dict and the local dictionary into an index
+  dictionary_load     open that index (cold, in a fresh DictionaryIndex cache)
+  prep_mlf            transcript to input MLF (no OOV words)
+  resolve_oov         pronunciations of the OOV words from lextool_stub.py
+  prep_wav            resample the audio to 11025 Hz
+  readAlignedMLF      parse the aligned MLF
+  writeJSON           write the alignment json (with phonemes, not validated)
+  writeTextGrid       write the TextGrid
+  do_alignment        all of it, with fake_htk.py's HCopy and HVite
+
+Each stage runs once to warm up (imports, the OS file cache) and then
+repeat times per size, and the fastest and median times are kept. The
+results go to a JSON file, and are compared with a baseline
+(benchmarks/baseline.json unless another is given): a stage more than
+threshold (and more than NOISE_SECONDS) slower than its baseline is a
+regression, and the command exits with status 1. With --tree the stages
+are timed on a checkout of the aligner from before the performance work
+instead (see pre_series.py); benchmarks/baseline-2937741.json holds
+those times.
+
+Command line: python -m p2fa_vislab.benchmarks.stages [--sizes 1000,5000] [--stage prep_mlf]
+                  [--repeat 3] [--out stages.json] [--baseline file] [--save-baseline] [--tree dir]
+"""
+
+import contextlib
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import wave
+
+try:
+    import simplejson as json
+except:
+    import json
+
+import numpy as np
+
+from .. import align, dictionary, pronunciation
+from ..lextool_stub import start_stub
+from . import fake_htk, pre_series
+
+this_dir = os.path.dirname(os.path.realpath(__file__))
+BASELINE = os.path.join(this_dir, "baseline.json")
+
+SIZES = [1000, 5000, 20000]
+SEED = 1234
+WORDS_PER_LINE = 12
+WORD_SECONDS = 0.05
+AUDIO_SR = 44100
+OOV_FRACTION = 20
+# slowdowns smaller than this are timer noise, whatever the ratio
+NOISE_SECONDS = 0.002
+
+STAGES = ["dictionary_compile", "dictionary_load", "prep_mlf", "resolve_oov", "prep_wav", "readAlignedMLF",
+          "writeJSON", "writeTextGrid", "do_alignment"]
+
+
+def dictionary_words():
+    # the plain words of model/dict, in file order
+    words = []
+    with open(os.path.join(align.MODEL_DIR, "dict"), 'r') as f:
+        for line in f:
+            word = line.split(None, 1)[0]
+            if word.isalpha() and word.isupper() and (not words or words[-1] != word):
+                words.append(word)
+    return words
+
+
+def make_transcript(path, size, vocabulary, seed = SEED):
+    # a dialog of size words: punctuation, some hyphenated words and numbers
+    rng = random.Random(seed)
+    lines = []
+    words = []
+    for i in range(size):
+        r = rng.random()
+        if r < 0.02:
+            word = str(rng.randint(1, 2020))
+        elif r < 0.04:
+            word = "%s-%s" % (rng.choice(vocabulary), rng.choice(vocabulary))
+        else:
+            word = rng.choice(vocabulary)
+        word = word.lower() if rng.random() < 0.8 else word
+        if rng.random() < 0.1:
+            word += rng.choice([",", ".", "?", "!", ";"])
+        words.append(word)
+        if len(words) == WORDS_PER_LINE or i == size - 1:
+            lines.append({"speaker": "Speaker %d" % (len(lines) % 3), "line": " ".join(words)})
+            words = []
+    with open(path, 'w') as f:
+        json.dump(lines, f)
+
+
+def make_local_dict(path, size, seed = SEED):
+    # size made-up words with made-up pronunciations
+    rng = random.Random(seed)
+    phones = ["AA1", "AE1", "AH0", "B", "D", "EH1", "F", "G", "IY1", "K", "L", "M", "N", "P", "R", "S", "T", "UW1"]
+    with open(path, 'w') as f:
+        for i in range(size):
+            f.write("LOCALWORD%06d  %s\n" % (i, " ".join(rng.choice(phones) for _ in range(rng.randint(2, 8)))))
+
+
+def make_oov_words(size, known, seed = SEED):
+    rng = random.Random(seed)
+    words = []
+    while len(words) < size:
+        word = "".join(rng.choice("BCDFGKLMNPRSTVZ") + rng.choice("AEIOU") for _ in range(rng.randint(2, 5)))
+        if word not in known and word not in words:
+            words.append(word)
+    return words
+
+
+def make_wav(path, seconds, SR = AUDIO_SR, seed = SEED):
+    # low-level noise, written a block at a time
+    rng = np.random.RandomState(seed)
+    w = wave.open(path, 'wb')
+    w.setnchannels(1)
+    w.setsampwidth(2)
+    w.setframerate(SR)
+    remaining = int(seconds * SR)
+    while remaining > 0:
+        n = min(remaining, SR * 10)
+        w.writeframes((rng.randn(n) * 1000).astype("<i2").tobytes())
+        remaining -= n
+    w.close()
+
+
+def run_fake_hvite(work_dir, file_name, input_mlf, word_dictionary, output_mlf):
+    # the aligned MLF HVite would make, made in process
+    with open(os.path.join(work_dir, file_name + '_aligned.results'), 'w') as out, contextlib.redirect_stdout(out):
+        fake_htk.hvite(['-T', '1', '-a', '-m', '-I', input_mlf, '-S', os.path.join(work_dir, file_name + '_test.scp'),
+                        '-i', output_mlf, '-t', '0.0', word_dictionary, 'monophones'])
+
+
+class Inputs(object):
+    # the synthetic inputs of one size, made on first use
+    def __init__(self, size, tmp, vocabulary):
+        self.size = size
+        self.dir = os.path.join(tmp, "size%d" % size)
+        self.vocabulary = vocabulary
+        os.makedirs(self.dir)
+        self._made = set()
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def transcript(self):
+        if "transcript" not in self._made:
+            make_transcript(self.path("transcript.json"), self.size, self.vocabulary)
+            self._made.add("transcript")
+        return self.path("transcript.json")
+
+    def wav(self):
+        if "wav" not in self._made:
+            make_wav(self.path("audio.wav"), self.size * WORD_SECONDS)
+            self._made.add("wav")
+        return self.path("audio.wav")
+
+    def aligned(self):
+        # (aligned MLF, global map) of the transcript
+        if "aligned" not in self._made:
+            idx = dictionary.load_dictionary(align.MODEL_DIR, local_dict = None)
+            work_dir = self.path("aligned")
+            os.makedirs(work_dir)
+            self.global_map = align.GlobalMap()
+            input_mlf = os.path.join(work_dir, "bench_tmp.mlf")
+            _, dict_tmp = align.prep_mlf(self.transcript(), input_mlf, idx, "sp", ["sp"], "bench", self.global_map,
+                                         dialog_file = True, dict_tmp_file = os.path.join(work_dir, "dict.tmp"))
+            idx.write_htk_dict(os.path.join(work_dir, "bench.dict"), align.dictTmpLines(dict_tmp))
+            align.prep_scp(os.path.join(work_dir, "bench_sound.wav"), "bench", work_dir)
+            run_fake_hvite(work_dir, "bench", input_mlf, os.path.join(work_dir, "bench.dict"),
+                           self.path("aligned.mlf"))
+            self._made.add("aligned")
+        return self.path("aligned.mlf"), self.global_map
+
+
+# Every stage is a function (inputs, scratch directory) -> (run, units): run()
+# is what is timed, once per repeat, and units says what the size counts.
+
+def stage_dictionary_compile(inputs, scratch):
+    local = inputs.path("dict.local")
+    if not os.path.exists(local):
+        make_local_dict(local, inputs.size)
+    sources = [os.path.join(align.MODEL_DIR, "dict"), local]
+    index_path = os.path.join(scratch, "dict.idx")
+
+    def run():
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        dictionary._loaded.pop(index_path, None)
+        dictionary.DictionaryIndex.load(sources, index_path)
+    return run, "local dictionary words"
+
+
+def stage_dictionary_load(inputs, scratch):
+    compile_dict, units = stage_dictionary_compile(inputs, scratch)
+    compile_dict()
+    local = inputs.path("dict.local")
+    sources = [os.path.join(align.MODEL_DIR, "dict"), local]
+    index_path = os.path.join(scratch, "dict.idx")
+
+    def run():
+        dictionary._loaded.pop(index_path, None)
+        idx = dictionary.DictionaryIndex.load(sources, index_path)
+        "LOCALWORD000000" in idx
+    return run, units
+
+
+def stage_prep_mlf(inputs, scratch):
+    trsfile = inputs.transcript()
+    idx = dictionary.load_dictionary(align.MODEL_DIR, local_dict = None)
+    # the numbers are warmed up, so the first run doesn't pay for inflect
+    align.resolve_oov(["1984"], idx)
+
+    def run():
+        align.prep_mlf(trsfile, os.path.join(scratch, "bench_tmp.mlf"), idx, "sp", ["sp"], "bench",
+                       align.GlobalMap(), dialog_file = True, dict_tmp_file = os.path.join(scratch, "dict.tmp"))
+    return run, "transcript words"
+
+
+def stage_resolve_oov(inputs, scratch):
+    idx = dictionary.load_dictionary(align.MODEL_DIR, local_dict = None)
+    words = make_oov_words(max(inputs.size // OOV_FRACTION, 1), idx)
+    server, url = start_stub()
+    saved = pronunciation._default_cache
+
+    def run():
+        # nothing is cached between runs
+        pronunciation._default_cache = pronunciation.PronunciationCache(":memory:")
+        with environment(P2FA_LEXTOOL_URL = url, P2FA_OFFLINE = "0"):
+            align.resolve_oov(words, idx)
+
+    def cleanup():
+        server.shutdown()
+        server.server_close()
+        pronunciation._default_cache = saved
+    run.cleanup = cleanup
+    return run, "out-of-dictionary words (size / %d)" % OOV_FRACTION
+
+
+def stage_prep_wav(inputs, scratch):
+    wavfile = inputs.wav()
+
+    def run():
+        align.prep_wav(wavfile, os.path.join(scratch, "bench_sound.wav"), None, align.SR_MODELS, "0.0", None)
+    return run, "words of audio (%g s each)" % WORD_SECONDS
+
+
+def stage_readAlignedMLF(inputs, scratch):
+    mlffile, _ = inputs.aligned()
+
+    def run():
+        align.readAlignedMLF(mlffile, 11025, 0.0)
+    return run, "transcript words"
+
+
+def stage_writeJSON(inputs, scratch):
+    mlffile, global_map = inputs.aligned()
+    word_alignments = align.readAlignedMLF(mlffile, 11025, 0.0)
+
+    def run():
+        align.writeJSON(os.path.join(scratch, "out.json"), word_alignments, global_map, phonemes = True,
+                        validate = False)
+    return run, "transcript words"
+
+
+def stage_writeTextGrid(inputs, scratch):
+    mlffile, _ = inputs.aligned()
+    word_alignments = align.readAlignedMLF(mlffile, 11025, 0.0)
+
+    def run():
+        align.writeTextGrid(os.path.join(scratch, "out.TextGrid"), word_alignments)
+    return run, "transcript words"
+
+
+def stage_do_alignment(inputs, scratch):
+    trsfile = inputs.transcript()
+    wavfile = inputs.wav()
+    bin_dir = fake_htk.install(os.path.join(scratch, "bin"))
+    align.resolve_oov(["1984"], dictionary.load_dictionary(align.MODEL_DIR, local_dict = None))
+
+    def run():
+        with fake_tools(bin_dir):
+            align.do_alignment(wavfile, trsfile, os.path.join(scratch, "out.json"), phonemes = True,
+                               work_dir = os.path.join(scratch, "work"), feature_cache = False, validate = False)
+    return run, "transcript words"
+
+
+@contextlib.contextmanager
+def environment(**values):
+    saved = dict((k, os.environ.get(k)) for k in values)
+    os.environ.update(values)
+    try:
+        yield
+    finally:
+        for k, v in saved.items():
+            if v is None:
+                os.environ.pop(k, None)
+            else:
+                os.environ[k] = v
+
+
+@contextlib.contextmanager
+def fake_tools(bin_dir):
+    # HCopy and HVite from fake_htk.py, whatever the environment says
+    saved = align.HTK_BIN, align.DECODER
+    align.HTK_BIN, align.DECODER = bin_dir, "hvite"
+    try:
+        yield
+    finally:
+        align.HTK_BIN, align.DECODER = saved
+
+
+def time_stage(name, inputs, tmp, repeat, tree = None):
+    scratch = tempfile.mkdtemp(prefix = name + "-", dir = tmp)
+    try:
+        if tree is None:
+            run, units = globals()["stage_" + name](inputs, scratch)
+        else:
+            run, units = pre_series.stage(name, tree, inputs, scratch)
+    except pre_series.Unavailable as e:
+        shutil.rmtree(scratch, ignore_errors = True)
+        return {"stage": name, "size": inputs.size, "skipped": str(e)}
+    times = []
+    try:
+        # the first run pays for what only happens once, and isn't counted
+        run()
+        for _ in range(repeat):
+            start = time.perf_counter()
+            run()
+            times.append(time.perf_counter() - start)
+    finally:
+        if hasattr(run, "cleanup"):
+            run.cleanup()
+        shutil.rmtree(scratch, ignore_errors = True)
+    return {"stage": name, "size": inputs.size, "units": units, "repeat": repeat, "min": min(times),
+            "median": statistics.median(times)}
+
+
+def run_benchmarks(sizes = None, stages = None, repeat = 3, progress = None, tree = None):
+    # tree is a checkout of the aligner from before the performance work, to time instead
+    sizes = sizes or SIZES
+    stages = stages or STAGES
+    tmp = tempfile.mkdtemp(prefix = "p2fa-bench-")
+    # nothing of the user's dict.local or caches is used, and only
+    # resolve_oov asks the (stand-in) lextool
+    cwd = os.getcwd()
+    os.chdir(tmp)
+    results = []
+    try:
+        if tree is not None:
+            tree = pre_series.load_tree(os.path.join(cwd, tree))
+        vocabulary = dictionary_words()
+        for size in sizes:
+            inputs = Inputs(size, tmp, vocabulary)
+            for name in stages:
+                with contextlib.redirect_stdout(sys.stderr), environment(P2FA_OFFLINE = "1"):
+                    result = time_stage(name, inputs, tmp, repeat, tree)
+                results.append(result)
+                if progress is not None:
+                    progress(result)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp, ignore_errors = True)
+    return {"meta": {"python": platform.python_version(), "platform": platform.platform(),
+                     "machine": platform.node(), "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "seed": SEED,
+                     "tree": None if tree is None else tree.commit or tree.path},
+            "results": results}
+
+
+def compare(results, baseline, threshold = 0.25):
+    """(stage, size, baseline seconds, seconds, ratio) of every result also in baseline, slowest first"""
+    before = dict(((r["stage"], r["size"]), r["min"]) for r in baseline["results"] if "min" in r)
+    rows = []
+    for r in results["results"]:
+        key = (r["stage"], r["size"])
+        if "min" not in r:
+            continue
+        if key in before and before[key] > 0:
+            rows.append((r["stage"], r["size"], before[key], r["min"], r["min"] / before[key]))
+    return sorted(rows, key = lambda row: -row[4])
+
+
+def is_regression(row, threshold):
+    stage, size, before, now, ratio = row
+    return ratio > 1 + threshold and now - before > NOISE_SECONDS
+
+
+def make_cli():
+    # click is only imported when the command line is used
+    import click
+
+    @click.command()
+    @click.option('--sizes', default = ",".join(str(s) for s in SIZES), help = "Comma-separated input sizes (words)")
+    @click.option('--stage', 'stages', multiple = True, type = click.Choice(STAGES),
+                  help = "Only this stage (repeatable)")
+    @click.option('--repeat', default = 3, help = "Runs per stage and size; the fastest is compared")
+    @click.option('--out', default = None, help = "Write the results to this JSON file")
+    @click.option('--baseline', default = BASELINE, help = "Compare with the results in this JSON file")
+    @click.option('--threshold', default = 0.25, help = "Slowdown over the baseline that counts as a regression")
+    @click.option('--save-baseline/--no-save-baseline', default = False, help = "Write the results as the baseline")
+    @click.option('--tree', default = None,
+                  help = "Time the stages on this checkout of the aligner from before the performance work")
+    def cli_stage_benchmark(sizes, stages, repeat, out, baseline, threshold, save_baseline, tree):
+        def progress(r):
+            if "skipped" in r:
+                print("%-20s %7d  skipped: %s" % (r["stage"], r["size"], r["skipped"]))
+                return
+            print("%-20s %7d %10.2f ms %10.2f ms  (%s)" % (r["stage"], r["size"], r["min"] * 1000, r["median"] * 1000,
+                                                           r["units"]))
+
+        print("%-20s %7s %13s %13s" % ("stage", "size", "min", "median"))
+        results = run_benchmarks([int(s) for s in sizes.split(",")], list(stages), repeat, progress, tree)
+        if out is not None:
+            with open(out, 'w') as f:
+                json.dump(results, f, indent = 4)
+
+        if save_baseline:
+            with open(baseline, 'w') as f:
+                json.dump(results, f, indent = 4)
+            return
+        if not os.path.exists(baseline):
+            return
+
+        with open(baseline, 'r') as f:
+            rows = compare(results, json.load(f), threshold)
+        regressions = [row for row in rows if is_regression(row, threshold)]
+        print("\nCompared with %s:" % baseline)
+        for row in rows:
+            stage, size, before, now, ratio = row
+            flag = "REGRESSION" if is_regression(row, threshold) else ""
+            print("%-20s %7d %10.2f ms -> %10.2f ms  x%.2f %s" % (stage, size, before * 1000, now * 1000, ratio, flag))
+        if regressions:
+            print("%d regression(s) over %d%%" % (len(regressions), threshold * 100))
+            sys.exit(1)
+
+    return cli_stage_benchmark
+
+
+def __getattr__(name):
+    if name == 'cli_stage_benchmark':
+        return make_cli()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+if __name__ == '__main__':
+    make_cli()()
@@ -0,0 +1,621 @@
+"""
+Forced alignment in NumPy with the HTK models, in place of HVite.
+
+The models (model/<sr>/macros and hmmdefs, text MMF format) are parsed
+once per process. For each utterance the words of the input MLF are
+expanded through the dictionary into a network of phone models, with
+alternative pronunciations as parallel branches and tee models (sp) that
+may be skipped, and compiled into a graph of emitting states in which
+every state has a short list of predecessors. Viterbi then runs over the
+feature frames a band of states at a time: only the span of states the
+survivors of the previous frame lead to (backwards too, through loops
+like sil's and sp's) is scored, with HVite's -t beam pruning and the
+states that could no longer reach the end in time dropped. Gaussian mixture scores
+are computed for blocks of frames with matrix products.
+
+The output is an MLF in HVite's -a -m format (and a .results file with
+the [Ac=...] scores), so readAlignedMLF and everything after it are
+unchanged. Set P2FA_DECODER=native to use it from align.py (HCopy still
+makes the features).
+
+Usage: Decoder.load("model/11025", "model/monophones").align(features, words, prons)
+       align_scp(input_mlf, dictfile, output_mlf, phoneset, hmmdir, scpfile, resultsfile, beam)
+"""
+
+import math
+import os
+import re
+
+import numpy as np
+
+from .plp import read_htk
+
+LOG_ZERO = -np.inf
+SCORE_BLOCK = 1024
+
+_token_re = re.compile(r'<[^>]*>|~[a-zA-Z]|"[^"]*"|[^\s<>"]+')
+
+_decoders = {}
+
+
+class Gaussians(object):
+    """A state's output distribution: a mixture of diagonal Gaussians"""
+
+    def __init__(self, weights, means, variances, gconsts):
+        self.weights = np.asarray(weights, dtype=np.float64)
+        self.means = np.asarray(means, dtype=np.float64)
+        self.variances = np.asarray(variances, dtype=np.float64)
+        self.gconsts = np.asarray(gconsts, dtype=np.float64)
+
+
+class HMM(object):
+    def __init__(self, name, states, transp):
+        self.name = name
+        self.states = states          # Gaussians of the emitting states 2 .. N-1
+        with np.errstate(divide='ignore'):
+            self.log_transp = np.log(np.asarray(transp, dtype=np.float64))
+
+    @property
+    def n_emitting(self):
+        return len(self.states)
+
+    @property
+    def is_tee(self):
+        # can go from entry to exit without emitting anything, like sp
+        return np.isfinite(self.log_transp[0, -1])
+
+
+class MMFParser(object):
+    def __init__(self):
+        self.macros = {}
+        self.hmms = {}
+
+    def parse_file(self, path):
+        with open(path, 'r') as f:
+            text = f.read()
+        if '\0' in text[:4096]:
+            raise ValueError("%s is a binary MMF, only text MMFs are supported" % path)
+        self.tokens = _token_re.findall(text)
+        self.pos = 0
+        while self.pos < len(self.tokens):
+            tok = self.next()
+            if tok[0] != '~':
+                continue
+            kind = tok[1].lower()
+            if kind == 'o':
+                # global options: nothing here matters for decoding
+                while self.pos < len(self.tokens) and self.peek()[0] != '~':
+                    self.pos += 1
+                continue
+            name = self.next().strip('"')
+            if kind == 'h':
+                self.hmms[name] = self.hmm(name)
+            elif kind == 's':
+                self.macros[('s', name)] = self.state()
+            elif kind == 'm':
+                self.macros[('m', name)] = self.gaussian()
+            elif kind == 'u':
+                self.macros[('u', name)] = self.vector('<MEAN>')
+            elif kind == 'v':
+                self.macros[('v', name)] = self.vector('<VARIANCE>')
+            elif kind == 't':
+                self.macros[('t', name)] = self.transp()
+            else:
+                # regression trees, linear transforms, ...: skip to the next macro
+                while self.pos < len(self.tokens) and self.peek()[0] != '~':
+                    self.pos += 1
+
+    def next(self):
+        tok = self.tokens[self.pos]
+        self.pos += 1
+        return tok
+
+    def peek(self):
+        return self.tokens[self.pos]
+
+    def keyword(self):
+        tok = self.peek()
+        return tok.upper() if tok.startswith('<') else tok
+
+    def expect(self, keyword):
+        tok = self.next().upper()
+        if tok != keyword:
+            raise ValueError("expected %s in MMF, found %s" % (keyword, tok))
+
+    def numbers(self, n):
+        values = [float(x) for x in self.tokens[self.pos:self.pos + n]]
+        self.pos += n
+        return values
+
+    def macro_ref(self, kind):
+        tok = self.next()
+        if tok.lower() != '~' + kind:
+            raise ValueError("expected ~%s macro in MMF, found %s" % (kind, tok))
+        return self.macros[(kind, self.next().strip('"'))]
+
+    def vector(self, keyword):
+        if self.peek().startswith('~'):
+            return self.macro_ref(self.peek()[1].lower())
+        self.expect(keyword)
+        n = int(self.next())
+        return np.array(self.numbers(n))
+
+    def gaussian(self):
+        # (mean, variance, gconst) of one mixture component
+        if self.peek().lower() == '~m':
+            return self.macro_ref('m')
+        mean = self.vector('<MEAN>')
+        if self.keyword() not in ('<VARIANCE>', '~v'):
+            raise ValueError("only diagonal covariances are supported, found %s" % self.peek())
+        variance = self.vector('<VARIANCE>')
+        if self.keyword() == '<GCONST>':
+            self.next()
+            gconst = float(self.next())
+        else:
+            gconst = len(mean) * math.log(2 * math.pi) + float(np.sum(np.log(variance)))
+        return (mean, variance, gconst)
+
+    def state(self):
+        if self.peek().lower() == '~s':
+            return self.macro_ref('s')
+        n_mixes = 1
+        if self.keyword() == '<NUMMIXES>':
+            self.next()
+            n_mixes = int(self.next())
+        if self.keyword() == '<SWEIGHTS>':
+            self.next()
+            self.numbers(int(self.next()))
+        if self.keyword() == '<STREAM>':
+            self.next()
+            self.next()
+
+        weights, components = [], []
+        if self.keyword() != '<MIXTURE>':
+            weights.append(1.0)
+            components.append(self.gaussian())
+        else:
+            while self.keyword() == '<MIXTURE>':
+                self.next()
+                self.next()     # component number
+                weights.append(float(self.next()))
+                components.append(self.gaussian())
+        if len(components) > n_mixes:
+            raise ValueError("more mixture components than <NUMMIXES>")
+        return Gaussians(weights, [c[0] for c in components], [c[1] for c in components],
+                         [c[2] for c in components])
+
+    def transp(self):
+        if self.peek().lower() == '~t':
+            return self.macro_ref('t')
+        self.expect('<TRANSP>')
+        n = int(self.next())
+        return np.array(self.numbers(n * n)).reshape(n, n)
+
+    def hmm(self, name):
+        self.expect('<BEGINHMM>')
+        while self.keyword() != '<NUMSTATES>':
+            self.next()
+        self.next()
+        n = int(self.next())
+        states = [None] * (n - 2)
+        while self.keyword() == '<STATE>':
+            self.next()
+            i = int(self.next())
+            states[i - 2] = self.state()
+        transp = self.transp()
+        self.expect('<ENDHMM>')
+        if None in states:
+            raise ValueError("HMM %s is missing a state" % name)
+        return HMM(name, states, transp)
+
+
+def read_dictionary(path):
+    """{word: [[phone, ...], ...]} from an HTK dictionary"""
+    prons = {}
+    with open(path, 'r') as f:
+        for line in f:
+            parts = line.split()
+            if not parts:
+                continue
+            word = unescape(parts[0])
+            phones = parts[1:]
+            if phones and phones[0].startswith('['):
+                # output symbol
+                while phones and not phones[0].endswith(']'):
+                    phones = phones[1:]
+                phones = phones[1:]
+            if phones:
+                try:
+                    float(phones[0])
+                    phones = phones[1:]
+                except ValueError:
+                    pass
+            prons.setdefault(word, []).append(phones)
+    return prons
+
+
+def unescape(word):
+    if len(word) > 1 and word[0] == word[-1] == '"':
+        word = word[1:-1]
+    return re.sub(r'\\(.)', r'\1', word)
+
+
+def read_input_mlf(path):
+    """{label name (without extension): [word, ...]} from a word-level MLF"""
+    entries = {}
+    name = None
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line == '#!MLF!#' or line == '':
+                continue
+            if line.startswith('"') and name is None:
+                name = os.path.splitext(os.path.basename(line.strip('"')))[0]
+                entries[name] = []
+            elif line == '.':
+                name = None
+            elif name is not None:
+                entries[name].append(unescape(line))
+    return entries
+
+
+START = -1
+
+
+class Network(object):
+    """The emitting states of an utterance's phone network, in order, with
+    a fixed number of (predecessor, log probability) pairs per state"""
+
+    def __init__(self, decoder, words, prons):
+        self.decoder = decoder
+        self.words = words
+        self.phones = []        # (model name, word index, first phone of its word?)
+        self.starts = []        # phone instances that can begin the utterance
+        succ = []               # phone instances that can follow each phone instance
+        frontier = [START]      # what the next word follows
+        for w, word in enumerate(words):
+            if word not in prons:
+                raise KeyError("%s is not in the dictionary" % word)
+            ends = []
+            for pron in prons[word]:
+                prev = frontier
+                for i, phone in enumerate(pron):
+                    if phone not in decoder.hmms:
+                        raise KeyError("no model for phone %s" % phone)
+                    p = len(self.phones)
+                    self.phones.append((phone, w, i == 0))
+                    succ.append([])
+                    for q in prev:
+                        if q == START:
+                            self.starts.append(p)
+                        else:
+                            succ[q].append(p)
+                    prev = [p]
+                ends.extend(q for q in prev if q not in ends)
+            frontier = ends
+        self.ends = set(frontier)
+        self._compile(succ)
+
+    def _reach(self, succ, p):
+        # where the path can go after phone instance p (or START): (next emitting phone
+        # instance or None for the end, log probability of skipping the tee phones in
+        # between, the skipped phones)
+        out = []
+        stack = [(q, 0.0, ()) for q in (self.starts if p == START else succ[p])]
+        if p in self.ends:
+            stack.append((None, 0.0, ()))
+        while stack:
+            q, cost, skipped = stack.pop()
+            out.append((q, cost, skipped))
+            if q is not None and self.decoder.hmms[self.phones[q][0]].is_tee:
+                skip = cost + self.decoder.hmms[self.phones[q][0]].log_transp[0, -1]
+                for r in succ[q]:
+                    stack.append((r, skip, skipped + (q,)))
+                if q in self.ends:
+                    stack.append((None, skip, skipped + (q,)))
+        return out
+
+    def _compile(self, succ):
+        hmms = [self.decoder.hmms[name] for name, w, first in self.phones]
+        base = np.cumsum([0] + [h.n_emitting for h in hmms])
+        S = int(base[-1])
+        self.n_states = S
+        self.state_phone = np.repeat(np.arange(len(hmms)), [h.n_emitting for h in hmms])
+        self.state_dist = np.array([self.decoder.dist_id[id(g)] for h in hmms for g in h.states], dtype=np.int64)
+
+        preds = [[] for s in range(S)]
+        self.initial = np.full(S, LOG_ZERO)
+        self.final = np.full(S, LOG_ZERO)
+        # tee phones skipped between two phone instances (None: start or end) on the best path
+        self.skipped = {}
+        skip_cost = {}
+
+        for p, h in enumerate(hmms):
+            A = h.log_transp
+            n = h.n_emitting
+            for i in range(n):
+                for j in range(n):
+                    if np.isfinite(A[i + 1, j + 1]):
+                        preds[base[p] + j].append((base[p] + i, A[i + 1, j + 1]))
+
+        for p in [START] + list(range(len(hmms))):
+            if p == START:
+                exits = [(None, 0.0)]
+            else:
+                A = hmms[p].log_transp
+                exits = [(base[p] + i, A[i + 1, -1]) for i in range(hmms[p].n_emitting) if np.isfinite(A[i + 1, -1])]
+            for q, cost, skipped in self._reach(succ, p):
+                pair = (None if p == START else p, q)
+                if cost > skip_cost.get(pair, LOG_ZERO):
+                    skip_cost[pair] = cost
+                    self.skipped[pair] = skipped
+                if q is None:
+                    for s, lp in exits:
+                        if s is not None:
+                            self.final[s] = max(self.final[s], lp + cost)
+                    continue
+                A = hmms[q].log_transp
+                for j in range(hmms[q].n_emitting):
+                    if not np.isfinite(A[0, j + 1]):
+                        continue
+                    for s, lp in exits:
+                        if s is None:
+                            self.initial[base[q] + j] = max(self.initial[base[q] + j], cost + A[0, j + 1])
+                        else:
+                            preds[base[q] + j].append((s, lp + cost + A[0, j + 1]))
+
+        K = max(len(ps) for ps in preds) if S else 1
+        self.pred = np.zeros((S, K), dtype=np.int64)
+        self.pred_logp = np.full((S, K), LOG_ZERO)
+        # the lowest and highest state each state leads to, for the band of the next frame
+        self.succ_lo = np.full(S, S, dtype=np.int64)
+        self.succ_hi = np.full(S, -1, dtype=np.int64)
+        for s, ps in enumerate(preds):
+            # the best of parallel paths between the same two states
+            best = {}
+            for src, lp in ps:
+                if lp > best.get(src, LOG_ZERO):
+                    best[src] = lp
+            for k, (src, lp) in enumerate(sorted(best.items())):
+                self.pred[s, k] = src
+                self.pred_logp[s, k] = lp
+                if np.isfinite(lp):
+                    self.succ_lo[src] = min(self.succ_lo[src], s)
+                    self.succ_hi[src] = max(self.succ_hi[src], s)
+            for k in range(len(best), K):
+                self.pred[s, k] = s
+
+        # fewest frames still needed after being in each state, to drop states
+        # that can no longer reach the end of the utterance in time
+        self.min_remaining = np.full(S, np.iinfo(np.int64).max // 2, dtype=np.int64)
+        self.min_remaining[np.isfinite(self.final)] = 0
+        for s in range(S - 1, -1, -1):
+            for k in range(K):
+                src = self.pred[s, k]
+                if src < s and np.isfinite(self.pred_logp[s, k]):
+                    self.min_remaining[src] = min(self.min_remaining[src], self.min_remaining[s] + 1)
+        self.first_state = int(np.flatnonzero(np.isfinite(self.initial)).min()) if S else 0
+        self.last_init = int(np.flatnonzero(np.isfinite(self.initial)).max()) if S else 0
+
+
+class Decoder(object):
+    def __init__(self, hmms):
+        self.hmms = hmms
+        self.dists = []
+        self.dist_id = {}
+        for name in sorted(hmms):
+            for g in hmms[name].states:
+                if id(g) not in self.dist_id:
+                    self.dist_id[id(g)] = len(self.dists)
+                    self.dists.append(g)
+
+        # all mixture components, padded to the largest mixture
+        M = max(len(g.weights) for g in self.dists)
+        D = self.dists[0].means.shape[1]
+        U = len(self.dists)
+        self.n_mix = M
+        self.log_weights = np.full((U, M), LOG_ZERO)
+        means = np.zeros((U, M, D))
+        inv_vars = np.ones((U, M, D))
+        gconsts = np.zeros((U, M))
+        for u, g in enumerate(self.dists):
+            m = len(g.weights)
+            with np.errstate(divide='ignore'):
+                self.log_weights[u, :m] = np.log(g.weights)
+            means[u, :m] = g.means
+            inv_vars[u, :m] = 1.0 / g.variances
+            gconsts[u, :m] = g.gconsts
+        self.inv_vars = inv_vars.reshape(U * M, D)
+        self.scaled_means = (means * inv_vars).reshape(U * M, D)
+        self.consts = (-0.5 * (gconsts + np.sum(means * means * inv_vars, axis=2))).reshape(U * M)
+
+    @classmethod
+    def load(cls, hmmdir, phoneset=None):
+        """Models in hmmdir/macros and hmmdir/hmmdefs, loaded once per process"""
+        paths = [os.path.join(hmmdir, 'macros'), os.path.join(hmmdir, 'hmmdefs')]
+        stamp = tuple((p, os.path.getmtime(p)) for p in paths if os.path.exists(p))
+        if _decoders.get(hmmdir, (None,))[0] != stamp:
+            parser = MMFParser()
+            for p in paths:
+                if os.path.exists(p):
+                    parser.parse_file(p)
+            hmms = parser.hmms
+            if phoneset is not None:
+                with open(phoneset, 'r') as f:
+                    names = [l.strip() for l in f if l.strip()]
+                missing = [n for n in names if n not in hmms]
+                if missing:
+                    raise ValueError("no models for %s in %s" % (" ".join(missing), hmmdir))
+                hmms = dict((n, hmms[n]) for n in names)
+            _decoders[hmmdir] = (stamp, cls(hmms))
+        return _decoders[hmmdir][1]
+
+    def scores(self, feats, dists):
+        """Log likelihoods (frames, len(dists)) of a block of frames for some of the distributions"""
+        M = self.n_mix
+        cols = (dists[:, None] * M + np.arange(M)[None, :]).ravel()
+        x = np.asarray(feats, dtype=np.float64)
+        ll = -0.5 * ((x * x) @ self.inv_vars[cols].T) + x @ self.scaled_means[cols].T + self.consts[cols]
+        ll = ll.reshape(len(x), len(dists), M) + self.log_weights[dists][None, :, :]
+        top = ll.max(axis=2)
+        with np.errstate(invalid='ignore'):
+            return top + np.log(np.exp(ll - top[:, :, None]).sum(axis=2))
+
+    def path_scores(self, feats, dists):
+        """Log likelihood of each frame for its own distribution"""
+        M = self.n_mix
+        cols = dists[:, None] * M + np.arange(M)[None, :]
+        x = np.asarray(feats, dtype=np.float64)
+        ll = -0.5 * np.einsum('bd,bmd->bm', x * x, self.inv_vars[cols]) \
+            + np.einsum('bd,bmd->bm', x, self.scaled_means[cols]) + self.consts[cols] + self.log_weights[dists]
+        top = ll.max(axis=1)
+        return top + np.log(np.exp(ll - top[:, None]).sum(axis=1))
+
+    def viterbi(self, net, feats, beam=0.0):
+        """Best state of net for every frame, and the emission score of each frame, or None
+        if no path survives"""
+        T = len(feats)
+        S = net.n_states
+        if T == 0 or S == 0:
+            return None
+
+        dists, local = np.unique(net.state_dist, return_inverse=True)
+        block_start = -SCORE_BLOCK
+        block = None
+
+        prev = np.full(S, LOG_ZERO)
+        cur = np.full(S, LOG_ZERO)
+        prev_band = cur_band = (0, 0)
+        lo, hi = net.first_state, net.last_init
+        back = []
+
+        for t in range(T):
+            if t >= block_start + SCORE_BLOCK:
+                block_start = t
+                block = self.scores(feats[t:t + SCORE_BLOCK], dists)
+            b = block[t - block_start]
+
+            new_lo, new_hi = lo, hi
+            if t == 0:
+                vals = net.initial[lo:hi + 1] + b[local[lo:hi + 1]]
+                args = None
+            else:
+                cand = prev[net.pred[new_lo:new_hi + 1]] + net.pred_logp[new_lo:new_hi + 1]
+                args = cand.argmax(axis=1)
+                vals = cand[np.arange(len(cand)), args] + b[local[new_lo:new_hi + 1]]
+
+            vals[net.min_remaining[new_lo:new_hi + 1] > T - 1 - t] = LOG_ZERO
+            best = vals.max()
+            if not np.isfinite(best):
+                return None
+            if beam > 0:
+                vals[vals < best - beam] = LOG_ZERO
+            alive = np.flatnonzero(np.isfinite(vals))
+
+            cur[cur_band[0]:cur_band[1]] = LOG_ZERO
+            cur[new_lo:new_hi + 1] = vals
+            cur_band = (new_lo, new_hi + 1)
+            back.append((new_lo, args))
+            prev, cur = cur, prev
+            prev_band, cur_band = cur_band, prev_band
+            # the next band is every state the survivors lead to
+            alive += new_lo
+            lo, hi = int(net.succ_lo[alive].min()), int(net.succ_hi[alive].max())
+            if lo > hi and t < T - 1:
+                return None
+
+        total = prev + net.final
+        s = int(total.argmax())
+        if not np.isfinite(total[s]):
+            return None
+        path = np.zeros(T, dtype=np.int64)
+        for t in range(T - 1, -1, -1):
+            path[t] = s
+            start, args = back[t]
+            if args is not None:
+                s = int(net.pred[s, args[s - start]])
+
+        emit = np.concatenate([self.path_scores(feats[i:i + SCORE_BLOCK], net.state_dist[path[i:i + SCORE_BLOCK]])
+                               for i in range(0, T, SCORE_BLOCK)])
+        return path, emit, float(total.max())
+
+    def align(self, feats, words, prons, beam=0.0):
+        """Force-align the words (with prons from read_dictionary) to the feature frames.
+        Returns [(word, [(phone, first frame, end frame, score), ...]), ...] as HVite
+        would print it (skipped tee phones have first == end), and the total score;
+        or None if no path survives the beam."""
+        net = Network(self, words, prons)
+        result = self.viterbi(net, feats, beam)
+        if result is None:
+            return None
+        path, emit, total = result
+
+        # runs of frames in the same phone instance, with skipped tee phones between them
+        phone_of = net.state_phone[path]
+        changes = np.flatnonzero(np.diff(phone_of)) + 1
+        starts = np.concatenate([[0], changes])
+        ends = np.concatenate([changes, [len(path)]])
+        cumulative = np.concatenate([[0.0], np.cumsum(emit)])
+
+        segments = []
+        prev_phone = None
+        for st, en in zip(starts, ends):
+            p = int(phone_of[st])
+            for q in net.skipped.get((prev_phone, p), ()):
+                segments.append((q, int(st), int(st), 0.0))
+            segments.append((p, int(st), int(en), float(cumulative[en] - cumulative[st])))
+            prev_phone = p
+        for q in net.skipped.get((prev_phone, None), ()):
+            segments.append((q, len(path), len(path), 0.0))
+
+        out = []
+        for p, st, en, score in segments:
+            name, w, first = net.phones[p]
+            if first or not out or out[-1][2] != w:
+                out.append((words[w], [], w))
+            out[-1][1].append((name, st, en, score))
+        return [(word, phones) for word, phones, w in out], total
+
+
+def mlf_word(word):
+    # as HVite writes labels that would not parse as words
+    if word[:1].isdigit() or word[:1] in ("'", '"'):
+        return '"%s"' % word.replace('"', '\\"')
+    return word
+
+
+def align_scp(input_mlf, dictfile, output_mlf, phoneset, hmmdir, scpfile, resultsfile, beam=0.0):
+    """What HVite -a -m -I input_mlf -S scpfile -i output_mlf -t beam dictfile phoneset does,
+    with the log written to resultsfile; files that can't be aligned are left out"""
+    decoder = Decoder.load(hmmdir, phoneset)
+    prons = read_dictionary(dictfile)
+    labels = read_input_mlf(input_mlf)
+    with open(scpfile, 'r') as f:
+        plps = [l.strip() for l in f if l.strip() != ""]
+
+    with open(output_mlf, 'w') as out, open(resultsfile, 'w') as log:
+        out.write('#!MLF!#\n')
+        for plp in plps:
+            name = os.path.splitext(os.path.basename(plp))[0]
+            log.write("Aligning File: %s\n" % plp)
+            if name not in labels:
+                log.write(" No transcription for %s\n" % name)
+                continue
+            feats, samp_period, kind = read_htk(plp)
+            words = labels[name]
+            result = decoder.align(feats, words, prons, beam)
+            if result is None:
+                log.write(" No tokens survived to final node of network at beam %g\n" % beam)
+                continue
+            aligned, total = result
+
+            out.write('"%s"\n' % (os.path.splitext(plp)[0] + ".rec"))
+            for word, phones in aligned:
+                for i, (phone, st, en, score) in enumerate(phones):
+                    line = "%d %d %s %f" % (st * samp_period, en * samp_period, phone, score)
+                    if i == 0:
+                        line += " " + mlf_word(word)
+                    out.write(line + "\n")
+            out.write(".\n")
+            log.write("%s  ==  [%d frames] %.4f [Ac=%.1f LM=0.0] (Act=%.1f)\n"
+                      % (" ".join(words), len(feats), total / max(len(feats), 1), total, 0.0))
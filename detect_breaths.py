@@ -1,139 +1,315 @@
+"""
+Mark the breaths in the pauses of an alignment.
+
+Every pause longer than MIN_PAUSE_DUR is cut from the speech in memory
+and aligned to a one-word {BR} transcript. All of the pauses go through
+one batch alignment (one HCopy/HVite run, see batch.py), and a pause
+whose acoustic score is above MIN_AC and whose {BR} lasts longer than
+MIN_BREATH_DUR is replaced by its sp/{BR} alignment.
+
+Before that, prefilter_pauses drops the pauses that are plainly not
+breaths from frame energies and spectral flatness computed in NumPy:
+pauses with too little sound above the silence floor (SILENCE_DB below
+the recording's RMS level) and pauses whose sound is tonal rather than
+noise-like (MIN_FLATNESS). The thresholds are untested on real
+recordings, so the pre-filter is off unless asked for; evaluate_prefilter
+reports the precision and recall of the gate against the full classifier.
+
+Command line: python -m p2fa_vislab.detect_breaths [options] wavfile alignment_json
+"""
+
 try:
     import simplejson as json
 except:
     import json
 import os
-import re
-import subprocess
+import shutil
+import sys
+import tempfile
 
-import click
-from radiotool.composer import Speech, Segment, Composition
+import numpy as np
 
-from align import do_alignment
+from . import metrics
+from .audio import read_wav, write_wav
+from .batch import align_batch
 
-ac_re = re.compile(r"\[Ac=(-?\d+)")
+# shorter pauses are never breaths
+MIN_PAUSE_DUR = 0.05
+MIN_BREATH_DUR = 0.1
+MIN_AC = 500
 
-def alignment_with_breaths(speech_file, alignment_file, out_alignment_file=None):
-    pause_idx = 0
-    subprocess.call('rm tmpaudio/*.wav', shell=True)
+# pre-filter frames, in seconds
+FRAME_DUR = 0.025
+FRAME_STEP = 0.01
+# frames quieter than this, in dB from the RMS level of the whole recording, are silence
+SILENCE_DB = -40.0
+# a breath needs at least this many seconds of frames above the silence floor
+MIN_ACTIVE_DUR = 0.05
+# breaths are noise-like; mean spectral flatness of the sounding frames
+MIN_FLATNESS = 0.05
+# band the flatness is measured over, in Hz
+FLATNESS_BAND = (300.0, 6000.0)
+# frames analysed at a time
+PREFILTER_BLOCK = 4096
 
-    with open(alignment_file, 'r') as af:
-        alignment = json.load(af)["words"]
 
+def alignment_with_breaths(speech_file, alignment_file, out_alignment_file=None, work_dir=None, prefilter=False,
+                           silence_db=SILENCE_DB, min_flatness=MIN_FLATNESS):
+    with metrics.stage("read_alignment"):
+        with open(alignment_file, 'r') as af:
+            alignment = json.load(af)["words"]
+
+    # ignore super-short pauses
+    pause_idx = candidate_pauses(alignment)
+    metrics.count("pauses", len(pause_idx))
+    with metrics.stage("read_audio"):
+        audio = read_mono(speech_file)
+    if prefilter:
+        with metrics.stage("prefilter"):
+            keep = prefilter_pauses(audio, [(alignment[i]["start"], alignment[i]["end"]) for i in pause_idx],
+                                    silence_db, min_flatness)
+        print("# pre-filter kept %d of %d pauses" % (int(keep.sum()), len(pause_idx)), file=sys.stderr)
+        pause_idx = [i for i, k in zip(pause_idx, keep) if k]
+    metrics.count("pauses_classified", len(pause_idx))
+    with metrics.stage("classify_pauses"):
+        classes = classify_pauses(speech_file, [(alignment[i]["start"], alignment[i]["end"]) for i in pause_idx],
+                                  work_dir, audio=audio)
+    metrics.count("breaths", sum(len(cls) > 1 for cls in classes))
+    print("# %d of %d pauses are breaths" % (sum(len(cls) > 1 for cls in classes), len(classes)), file=sys.stderr)
+
+    breaths = dict(zip(pause_idx, classes))
     new_alignment = []
-    for x in alignment:
-        if x["alignedWord"] == "sp":
-            comp = Composition(channels=1)
-            speech = Speech(speech_file, "p")
-            comp.add_track(speech)
-            start = x["start"]
-            end = x["end"]
-            # ignore super-short pauses
-            if end - start <= .05:
-                new_alignment.append(x)
-                pause_idx += 1
-                continue
-            # print "pause", pause_idx-1, "start:", start, "end", end
-            # print "len", end - start
-            print "Creating pause", start, end - start
-            seg = Segment(speech, 0.0, start, end - start)
-            comp.add_segment(seg)
-            comp.export(
-                adjust_dynamics=False,
-                filename="tmpaudio/p%06d" % pause_idx,
-                channels=1,
-                filetype='wav',
-                samplerate=speech.samplerate,
-                separate_tracks=False)
-            print "# classifying p%06d.wav" % pause_idx
-            print "# segment length:", x["end"] - x["start"]
-            
-            cls = classify_htk(
-                'tmpaudio/p%06d.wav' % pause_idx)
-            
-            # cls = breath_classifier.classify(
-            #     'tmp/pauses/p%06d.wav' % pause_idx)
-
-            for word in cls:
-                word["start"] = round(word["start"] + x["start"], 5)
-                word["end"] = round(word["end"] + x["start"], 5)
-            cls[-1]["end"] = x["end"]
-            new_alignment.extend(cls)
-            pause_idx += 1
-        else:
+    for i, x in enumerate(alignment):
+        if i not in breaths:
             new_alignment.append(x)
-
+            continue
+        cls = breaths[i]
+        for word in cls:
+            word["start"] = round(word["start"] + x["start"], 5)
+            word["end"] = round(word["end"] + x["start"], 5)
+        cls[-1]["end"] = x["end"]
+        new_alignment.extend(cls)
 
     if out_alignment_file is None:
         out_alignment_file = os.path.splitext(alignment_file)[0] + "-breaths.json"
 
-    with open(out_alignment_file, 'w') as new_af:
-        json.dump({"words": new_alignment}, new_af, indent=4)
+    with metrics.stage("write_alignment"):
+        with open(out_alignment_file, 'w') as new_af:
+            json.dump({"words": new_alignment}, new_af, indent=4)
 
     return 0
 
 
-def classify_htk(audio_file):
-    MIN_BREATH_DUR = 0.1
-    MIN_AC = 500
+def candidate_pauses(alignment):
+    # indices of the pauses of alignment long enough to hold a breath
+    return [i for i, x in enumerate(alignment)
+            if x["alignedWord"] == "sp" and x["end"] - x["start"] > MIN_PAUSE_DUR]
+
+
+def read_mono(speech_file):
+    # (mono samples, sample rate) of speech_file, as the pauses are aligned
+    samples, SR = read_wav(speech_file)
+    return samples.mean(axis=1), SR
+
+
+def pause_features(audio, pauses):
+    # Frame features of all of the (start, end) pauses of audio at once:
+    # (energy in dB from the recording's RMS level, spectral flatness, index
+    # of the pause), one entry per frame.
+    samples, SR = audio
+    frame_size = int(round(FRAME_DUR * SR))
+    step = int(round(FRAME_STEP * SR))
+
+    starts = []
+    owner = []
+    for k, (start, end) in enumerate(pauses):
+        first = int(round(start * SR))
+        last = min(int(round(end * SR)), len(samples))
+        n = max((last - first - frame_size) // step + 1, 0)
+        starts.append(first + step * np.arange(n))
+        owner.append(np.full(n, k))
+    starts = np.concatenate(starts) if starts else np.zeros(0, dtype=int)
+    owner = np.concatenate(owner) if owner else np.zeros(0, dtype=int)
+
+    ref = np.mean(samples ** 2) + 1e-12
+    window = np.hanning(frame_size)
+    freqs = np.fft.rfftfreq(frame_size, 1.0 / SR)
+    band = (freqs >= FLATNESS_BAND[0]) & (freqs <= min(FLATNESS_BAND[1], SR / 2.0))
+    offsets = np.arange(frame_size)
+
+    energy = np.zeros(len(starts))
+    flatness = np.zeros(len(starts))
+    for b in range(0, len(starts), PREFILTER_BLOCK):
+        frames = samples[starts[b:b + PREFILTER_BLOCK, None] + offsets[None, :]]
+        energy[b:b + PREFILTER_BLOCK] = 10 * np.log10(np.mean(frames ** 2, axis=1) / ref + 1e-12)
+        power = np.abs(np.fft.rfft(frames * window, axis=1)[:, band]) ** 2 + 1e-12
+        flatness[b:b + PREFILTER_BLOCK] = np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1)
+    return energy, flatness, owner
+
+
+def prefilter_pauses(audio, pauses, silence_db=SILENCE_DB, min_flatness=MIN_FLATNESS):
+    # Boolean array, True for each (start, end) pause of audio (mono samples,
+    # sample rate) that may be a breath and should go to the full classifier
+    if not pauses:
+        return np.zeros(0, dtype=bool)
+    energy, flatness, owner = pause_features(audio, pauses)
+    active = energy > silence_db
+    active_frames = np.bincount(owner, weights=active, minlength=len(pauses))
+    active_flatness = np.bincount(owner, weights=flatness * active, minlength=len(pauses))
+    mean_flatness = active_flatness / np.maximum(active_frames, 1)
+    return (active_frames * FRAME_STEP >= MIN_ACTIVE_DUR) & (mean_flatness >= min_flatness)
+
+
+def evaluate_prefilter(speech_file, alignment_file, silence_db=SILENCE_DB, min_flatness=MIN_FLATNESS,
+                       work_dir=None):
+    # Precision and recall of prefilter_pauses against the full classifier,
+    # which is run on every candidate pause of the alignment
+    with open(alignment_file, 'r') as af:
+        alignment = json.load(af)["words"]
+
+    pauses = [(alignment[i]["start"], alignment[i]["end"]) for i in candidate_pauses(alignment)]
+    audio = read_mono(speech_file)
+    keep = prefilter_pauses(audio, pauses, silence_db, min_flatness)
+    breath = np.array([len(cls) > 1 for cls in classify_pauses(speech_file, pauses, work_dir, audio=audio)],
+                      dtype=bool)
+
+    true_positives = int(np.sum(keep & breath))
+    return {"pauses": len(pauses), "kept": int(keep.sum()), "breaths": int(breath.sum()),
+            "true_positives": true_positives,
+            "precision": float(true_positives) / keep.sum() if keep.sum() else 1.0,
+            "recall": float(true_positives) / breath.sum() if breath.sum() else 1.0,
+            "silence_db": silence_db, "min_flatness": min_flatness}
+
+
+def classify_pauses(speech_file, pauses, work_dir=None, beams=None, audio=None):
+    # The alignment of each (start, end) pause of speech_file, with times from
+    # the start of the pause (see breath_words). The pauses are cut from the
+    # audio (read_mono of speech_file unless given) in memory and aligned
+    # together in one batch.
+    if not pauses:
+        return []
+
+    # all of the files for the pauses go in a scratch directory of their own,
+    # so nothing depends on (or changes) the current directory
+    made_work_dir = work_dir is None
+    if made_work_dir:
+        work_dir = tempfile.mkdtemp(prefix="p2fa-breath-")
+    elif not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+
+    try:
+        samples, SR = audio if audio is not None else read_mono(speech_file)
+
+        manifest = []
+        for k, (start, end) in enumerate(pauses):
+            pause_wav = os.path.join(work_dir, "p%06d.wav" % k)
+            write_wav(pause_wav, samples[int(round(start * SR)):int(round(end * SR))], SR)
+            manifest.append({"wavfile": pause_wav, "trsfile": breath_transcript(work_dir), "outfile": None})
+
+        return classify_manifest(manifest, work_dir, beams)
+    finally:
+        if made_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def classify_htk(audio_file, work_dir=None):
+    # the alignment of a single pause already in its own wav file
+    made_work_dir = work_dir is None
+    if made_work_dir:
+        work_dir = tempfile.mkdtemp(prefix="p2fa-breath-")
+
+    try:
+        manifest = [{"wavfile": audio_file, "trsfile": breath_transcript(work_dir), "outfile": None}]
+        return classify_manifest(manifest, work_dir)[0]
+    finally:
+        if made_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
 
-    cwd = os.getcwd()
-    os.chdir(os.path.dirname(os.path.realpath(__file__)))
-    
-    transcript = "breath.transcript"
-    output = "breath-classify-output.json"
-    results = "tmp/aligned.results"
 
-    with open(transcript, 'w') as f:
-        f.write("""[{"speaker": "speaker", "line": "{BR}"}]""")
+def breath_transcript(work_dir):
+    transcript = os.path.join(work_dir, "breath.transcript")
+    if not os.path.exists(transcript):
+        with open(transcript, 'w') as f:
+            f.write("""[{"speaker": "speaker", "line": "{BR}"}]""")
+    return transcript
 
-    do_alignment(audio_file, transcript, output, json=True, textgrid=False)
 
-    os.remove(transcript)
+def classify_manifest(manifest, work_dir, beams=None):
+    # breath_words for each {BR} alignment of a batch manifest, in its order
+    # the alignments are only needed in memory
+    results = align_batch(manifest, work_dir=work_dir, beams=beams, feature_cache=False)
 
-    # subprocess.call('python ../p2fa/align.py ../%s %s %s' %
-    #     (audio_file, transcript, output), shell=True)
-    
+    classes = []
+    for result in results:
+        words = None
+        ac = None
+        if result["error"] is None:
+            words = result["alignment"].to_dict()["words"]
+            ac = result["viterbi"]["ac"]
+        classes.append(breath_words(words, ac))
+    return classes
+
+
+def breath_words(words, ac):
+    # words (the {BR} alignment of a pause) if they are likely a breath, given
+    # the total acoustic score ac, and otherwise the pause on its own
     final_words = [{
         "start": 0.0,
         "end": 0.0,
         "alignedWord": "sp",
         "word": "{p}"
     }]
-    
-    with open(results, 'r') as res:
-        match = ac_re.search(res.read())
-        if match:
-            ac = int(match.group(1))
-            print "Ac:", ac
-            if ac > MIN_AC:
-                print "Breath!"
-    
-                with open(output, 'r') as out:
-                    words = json.load(out)["words"]
-                    breath = filter(
-                        lambda x: x["alignedWord"] == "{BR}",
-                        words)[0]
-                    breath_dur = breath["end"] - breath["start"]
-                    print "breath len", breath_dur
-                    if breath_dur > MIN_BREATH_DUR:
-                        final_words = words
-                        final_words[0]["start"] = 0.0
-                        for word in final_words:
-                            if word["alignedWord"] == "{BR}":
-                                word["likelihood"] = ac
-
-    os.chdir(cwd)
-
-    return final_words
-
-
-@click.command()
-@click.argument("wavfile")
-@click.argument("alignment_json")
-def do_detect_breaths(wavfile, alignment_json):
-    return alignment_with_breaths(wavfile, alignment_json)
+
+    if words is None or ac is None or ac <= MIN_AC:
+        return final_words
+
+    breath = [x for x in words if x["alignedWord"] == "{BR}"]
+    if not breath or breath[0]["end"] - breath[0]["start"] <= MIN_BREATH_DUR:
+        return final_words
+
+    words[0]["start"] = 0.0
+    for word in words:
+        if word["alignedWord"] == "{BR}":
+            word["likelihood"] = int(ac)
+    return words
+
+
+def make_cli():
+    # click is only imported when the command line is used
+    import click
+
+    @click.command()
+    @click.argument("wavfile")
+    @click.argument("alignment_json")
+    @click.option("--prefilter/--no-prefilter", default=False,
+                  help="Skip the pauses that are plainly silence or not breaths before aligning (untested thresholds)")
+    @click.option("--silence-db", default=SILENCE_DB, help="Pre-filter silence floor, in dB from the RMS level")
+    @click.option("--min-flatness", default=MIN_FLATNESS, help="Pre-filter minimum spectral flatness")
+    @click.option("--evaluate", is_flag=True,
+                  help="Report the pre-filter's precision and recall against the full classifier instead")
+    @click.option("--metrics/--no-metrics", "metrics_file", default=False,
+                  help="Write stage timings, HTK resource usage and counts to <output>.metrics.json")
+    @click.option("--prometheus", default=None, help="Also write the metrics to this Prometheus textfile")
+    @click.option("--profile/--no-profile", default=False,
+                  help="Profile the Python stages (stats in <output>.prof, the top functions in the metrics)")
+    def do_detect_breaths(wavfile, alignment_json, prefilter, silence_db, min_flatness, evaluate, metrics_file,
+                          prometheus, profile):
+        if evaluate:
+            print(json.dumps(evaluate_prefilter(wavfile, alignment_json, silence_db, min_flatness), indent=4))
+            return 0
+        base = os.path.splitext(alignment_json)[0] + "-breaths"
+        with metrics.command_line(base, metrics_file or profile, prometheus, profile):
+            return alignment_with_breaths(wavfile, alignment_json, prefilter=prefilter, silence_db=silence_db,
+                                          min_flatness=min_flatness)
+
+    return do_detect_breaths
+
+
+def __getattr__(name):
+    if name == 'do_detect_breaths':
+        return make_cli()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 
 if __name__ == '__main__':
-    do_detect_breaths()
\ No newline at end of file
+    make_cli()()
@@ -0,0 +1,251 @@
+"""
+Compiled, memory-mapped index of the HTK pronunciation dictionary.
+
+The text dictionary (model/dict, plus an optional dict.local) is compiled
+once into a binary hash table that is stored next to it and memory-mapped
+when it is loaded, so checking or fetching a word does not read or parse
+the 127k-line text file. The index remembers the size and modification
+time of its sources and is rebuilt automatically when any of them change.
+
+Usage: idx = load_dictionary("model")
+       "HELLO" in idx
+       idx.get("HELLO")  # -> ['HH AH0 L OW1', 'HH EH0 L OW1']
+       idx.write_htk_dict("tmp/foo.dict", extra_lines)
+       idx.write_pruned_dict("tmp/foo.dict", words, extra_lines)
+
+Layout of the compiled file (all integers little-endian):
+    header     magic, number of slots, number of words, signature length
+    signature  json list of [path, size, mtime_ns] for every source
+    slots      n_slots x (crc32 of word, record offset, record length)
+    records    the dictionary lines grouped by word, words in sorted order
+               and each word's pronunciations in the order of the source files
+"""
+
+import heapq
+import mmap
+import os
+import struct
+import zlib
+
+from . import metrics
+
+try:
+    import simplejson as json
+except:
+    import json
+
+MAGIC = b"P2FADIX2"
+HEADER = struct.Struct("<8sIII")
+SLOT = struct.Struct("<III")
+
+# non-speech entries HVite may need even if the transcript doesn't mention them
+FILLER_WORDS = ["sp", "sil", "{SL}", "{BR}", "{NS}", "{LG}", "{CG}", "{LS}"]
+
+# dictionaries keep the mmap open for the life of the process
+_loaded = {}
+
+
+def _signature(sources):
+    sig = []
+    for path in sources:
+        try:
+            st = os.stat(path)
+            sig.append([os.path.abspath(path), st.st_size, st.st_mtime_ns])
+        except OSError:
+            sig.append([os.path.abspath(path), -1, -1])
+    return sig
+
+
+def _read_lines(sources):
+    lines = []
+    for path in sources:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            for line in f:
+                line = line.rstrip(b"\r\n")
+                if line.strip() != b"":
+                    lines.append(line + b"\n")
+    return lines
+
+
+def _word(line):
+    return line.split(None, 1)[0]
+
+
+def _compile(sources, sig):
+    # sorted by word for HVite, but a word's pronunciations keep their order
+    # so the first one is still the main pronunciation
+    lines = sorted(_read_lines(sources), key=_word)
+
+    records = {}
+    for line in lines:
+        word = _word(line)
+        if word in records:
+            records[word].append(line)
+        else:
+            records[word] = [line]
+
+    n_slots = 1
+    while n_slots < 2 * len(records) + 1:
+        n_slots *= 2
+
+    sig_bytes = json.dumps(sig).encode("utf-8")
+    records_start = HEADER.size + len(sig_bytes) + n_slots * SLOT.size
+
+    slots = bytearray(n_slots * SLOT.size)
+    blob = []
+    offset = records_start
+    for word, word_lines in records.items():
+        record = b"".join(word_lines)
+        h = zlib.crc32(word)
+        i = h & (n_slots - 1)
+        while SLOT.unpack_from(slots, i * SLOT.size)[2] != 0:
+            i = (i + 1) & (n_slots - 1)
+        SLOT.pack_into(slots, i * SLOT.size, h, offset, len(record))
+        blob.append(record)
+        offset += len(record)
+
+    header = HEADER.pack(MAGIC, n_slots, len(records), len(sig_bytes))
+    return b"".join([header, sig_bytes, bytes(slots)] + blob)
+
+
+class DictionaryIndex(object):
+    def __init__(self, buf, sources, path=None):
+        magic, n_slots, n_words, sig_len = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a compiled dictionary index: %s" % path)
+
+        self.buf = buf
+        self.sources = sources
+        self.path = path
+        self.n_slots = n_slots
+        self.n_words = n_words
+        sig_start = HEADER.size
+        self.signature = json.loads(bytes(buf[sig_start:sig_start + sig_len]).decode("utf-8"))
+        self.slots_start = sig_start + sig_len
+        self.records_start = self.slots_start + n_slots * SLOT.size
+
+    @staticmethod
+    def index_path(sources):
+        # one index per combination of sources, next to the main dictionary
+        base = os.path.dirname(os.path.abspath(sources[0]))
+        name = os.path.basename(sources[0])
+        if len(sources) == 1:
+            return os.path.join(base, name + ".idx")
+        key = zlib.crc32("\n".join(os.path.abspath(s) for s in sources).encode("utf-8"))
+        return os.path.join(base, "%s-%08x.idx" % (name, key))
+
+    @classmethod
+    def load(cls, sources, index_path=None):
+        sources = list(sources)
+        if index_path is None:
+            index_path = cls.index_path(sources)
+        sig = _signature(sources)
+
+        cached = _loaded.get(index_path)
+        if cached is not None and cached.signature == sig:
+            metrics.count("dictionary_cache_hits")
+            return cached
+        metrics.count("dictionary_cache_misses")
+
+        idx = None
+        try:
+            idx = cls._open(index_path, sources)
+            if idx.signature != sig:
+                idx = None
+        except (OSError, ValueError, struct.error):
+            idx = None
+
+        if idx is None:
+            metrics.count("dictionary_compiles")
+            data = _compile(sources, sig)
+            try:
+                # write-then-rename so concurrent readers never see half an index
+                tmp_path = "%s.%d.tmp" % (index_path, os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, index_path)
+                idx = cls._open(index_path, sources)
+            except OSError:
+                # read-only model directory: keep the compiled index in memory
+                idx = cls(data, sources)
+
+        _loaded[index_path] = idx
+        return idx
+
+    @classmethod
+    def _open(cls, index_path, sources):
+        with open(index_path, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buf, sources, index_path)
+
+    def _record(self, word):
+        if not isinstance(word, bytes):
+            word = word.encode("utf-8")
+        h = zlib.crc32(word)
+        mask = self.n_slots - 1
+        i = h & mask
+        n = len(word)
+        while True:
+            slot_h, offset, length = SLOT.unpack_from(self.buf, self.slots_start + i * SLOT.size)
+            if length == 0:
+                return None
+            if slot_h == h and self.buf[offset:offset + n] == word and self.buf[offset + n:offset + n + 1].isspace():
+                return bytes(self.buf[offset:offset + length])
+            i = (i + 1) & mask
+
+    def __contains__(self, word):
+        return self._record(word) is not None
+
+    def __len__(self):
+        return self.n_words
+
+    def lines(self, word):
+        """Dictionary lines for word (as in the text file), or []"""
+        record = self._record(word)
+        if record is None:
+            return []
+        return record.decode("utf-8").splitlines(True)
+
+    def get(self, word, default=None):
+        """List of pronunciations of word, or default if it is not in the dictionary"""
+        record = self._record(word)
+        if record is None:
+            return default
+        return [line.split(None, 1)[1].strip() for line in record.decode("utf-8").splitlines()
+                if len(line.split(None, 1)) > 1]
+
+    def records(self):
+        return self.buf[self.records_start:]
+
+    def write_htk_dict(self, path, extra_lines=None):
+        """Write the whole dictionary, merged with extra_lines, in sorted order for HVite"""
+        with open(path, 'wb') as f:
+            if not extra_lines:
+                f.write(self.records())
+                return
+            extra = sorted((line.rstrip("\n").encode("utf-8") + b"\n" for line in extra_lines), key=_word)
+            f.writelines(heapq.merge(bytes(self.records()).splitlines(True), extra, key=_word))
+
+    def write_pruned_dict(self, path, words, extra_lines=None):
+        """Write a dictionary for HVite with only the given words (plus fillers and extra_lines)"""
+        lines = []
+        seen = set()
+        for word in list(words) + FILLER_WORDS:
+            if word in seen:
+                continue
+            seen.add(word)
+            lines.extend(self.lines(word))
+        if extra_lines:
+            lines.extend(line.rstrip("\n") + "\n" for line in extra_lines)
+
+        with open(path, 'w') as f:
+            f.writelines(sorted(lines, key=_word))
+
+
+def load_dictionary(model_dir, local_dict="dict.local"):
+    sources = [os.path.join(model_dir, "dict")]
+    if local_dict is not None and os.path.exists(local_dict):
+        sources.append(local_dict)
+    return DictionaryIndex.load(sources)
@@ -0,0 +1,148 @@
+"""
+Write an alignment in any combination of formats in one pass.
+
+The words of the alignment (dicts like align.alignedWords makes) are
+produced once and handed to a streaming writer per format as they come,
+so nothing holds the whole output in memory:
+
+  json      {"words": [...], "viterbi": {...}}, as json.dump(..., indent=4) wrote it
+  ndjson    one word per line
+  csv       start, end, word, alignedWord, line_idx, speaker, emotion per word
+  textgrid  Praat long TextGrid with phone and word tiers, as tgt wrote it
+
+Each format goes to its own path. With validate, each word is checked
+against the alignment schema's word item as it is written.
+
+Usage: export_alignment({"json": "a.json", "csv": "a.csv"}, word_alignments, words)
+"""
+
+import csv
+
+try:
+    import simplejson as json
+except:
+    import json
+
+from . import schemas
+
+FORMATS = ("json", "textgrid", "csv", "ndjson")
+EXTENSIONS = {"json": ".json", "textgrid": ".TextGrid", "csv": ".csv", "ndjson": ".ndjson"}
+
+CSV_COLUMNS = ["start", "end", "word", "alignedWord", "line_idx", "speaker", "emotion"]
+
+# tgt treats times closer than this as the same
+TIME_PRECISION = 0.0001
+
+
+class JSONWriter(object):
+    def __init__(self, path):
+        self.f = open(path, 'w')
+        self.n = 0
+        self.f.write('{\n    "words": [')
+
+    def write(self, word):
+        self.f.write(",\n" if self.n else "\n")
+        self.f.write("\n".join("        " + line for line in json.dumps(word, indent = 4).split("\n")))
+        self.n += 1
+
+    def close(self, viterbi_report = None):
+        self.f.write("\n    ]" if self.n else "]")
+        if viterbi_report is not None:
+            # the HVite beams tried and how long each took
+            report = json.dumps(viterbi_report, indent = 4).replace("\n", "\n    ")
+            self.f.write(',\n    "viterbi": ' + report)
+        self.f.write("\n}")
+        self.f.close()
+
+
+class NDJSONWriter(object):
+    def __init__(self, path):
+        self.f = open(path, 'w')
+
+    def write(self, word):
+        self.f.write(json.dumps(word) + "\n")
+
+    def close(self, viterbi_report = None):
+        self.f.close()
+
+
+class CSVWriter(object):
+    def __init__(self, path):
+        self.f = open(path, 'w', newline = '')
+        self.writer = csv.DictWriter(self.f, CSV_COLUMNS, extrasaction = 'ignore')
+        self.writer.writeheader()
+
+    def write(self, word):
+        self.writer.writerow(word)
+
+    def close(self, viterbi_report = None):
+        self.f.close()
+
+
+WRITERS = {"json": JSONWriter, "ndjson": NDJSONWriter, "csv": CSVWriter}
+
+
+def export_alignment(outputs, word_alignments, words, viterbi_report = None, validate = False):
+    # outputs is {format: path}, word_alignments the mlf.PhoneAlignment the
+    # words (an iterable of word dicts) were made from
+    unknown = set(outputs) - set(FORMATS)
+    if unknown:
+        raise ValueError("unknown output formats: %s" % ", ".join(sorted(unknown)))
+
+    if "textgrid" in outputs:
+        writeLongTextGrid(outputs["textgrid"], word_alignments)
+
+    writers = [WRITERS[fmt](path) for fmt, path in outputs.items() if fmt in WRITERS]
+    if not writers:
+        return
+
+    try:
+        for word in words:
+            if validate:
+                error = schemas.first_error("word", word)
+                if error is not None:
+                    print("Output is not a valid Alignment according to alignment-schemas/alignment_schema.json")
+                    print(error)
+                    validate = False
+            for writer in writers:
+                writer.write(word)
+    finally:
+        for writer in writers:
+            writer.close(viterbi_report)
+
+
+def _tier_intervals(starts, ends, labels, xmax):
+    # the intervals of a tier with the gaps (from 0 to xmax) filled with empty ones
+    intervals = []
+    last = 0.0
+    for st, en, text in zip(starts, ends, labels):
+        if st - last >= TIME_PRECISION:
+            intervals.append((last, st, ""))
+        intervals.append((st, en, text.strip()))
+        last = en
+    if xmax - last >= TIME_PRECISION or not intervals:
+        intervals.append((last, xmax, ""))
+    return intervals
+
+
+def writeLongTextGrid(outfile, word_alignments):
+    starts = word_alignments.start.tolist()
+    ends = word_alignments.end.tolist()
+    first = word_alignments.word_first.tolist()
+    spoken = word_alignments.spoken_words().tolist()
+
+    xmax = max(ends) if ends else 0.0
+    tiers = [("phone", _tier_intervals(starts, ends, (word_alignments.phone_names[p] for p in
+                                                      word_alignments.phone_ids.tolist()), xmax)),
+             ("word", _tier_intervals([starts[first[i]] for i in spoken], [ends[first[i + 1] - 1] for i in spoken],
+                                      [word_alignments.word_labels[i] for i in spoken], xmax))]
+
+    with open(outfile, 'w', encoding = 'utf-8') as f:
+        f.write('File type = "ooTextFile"\nObject class = "TextGrid"\n\n')
+        f.write('xmin = 0.0\nxmax = %r\ntiers? <exists>\nsize = %d\nitem []:' % (xmax, len(tiers)))
+        for k, (name, intervals) in enumerate(tiers):
+            f.write('\n\titem [%d]:\n\t\tclass = "IntervalTier"\n\t\tname = "%s"\n\t\txmin = 0.0\n\t\txmax = %r'
+                    '\n\t\tintervals: size = %d' % (k + 1, name, xmax, len(intervals)))
+            for j, (st, en, text) in enumerate(intervals):
+                f.write('\n\t\tintervals [%d]:\n\t\t\txmin = %r\n\t\t\txmax = %r\n\t\t\ttext = "%s"'
+                        % (j + 1, float(st), float(en), text.replace('"', '""')))
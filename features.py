@@ -0,0 +1,228 @@
+"""
+Cache of prepared audio and PLP features, so realigning a recording after
+a transcript edit skips resampling and feature extraction.
+
+Entries are keyed by a hash of the audio's contents, the trim range, the
+sample rate, the contents of the HCopy config and the front end (HCopy or
+plp.py), and hold the prepared wav and the .plp file. They live in
+~/.cache/p2fa/features (or P2FA_FEATURE_CACHE) and the least recently
+used are removed once the cache holds more than max_bytes.
+
+The cache is off unless asked for: the alignments use it when
+P2FA_FEATURE_CACHE names its directory or when given --feature-cache
+(or a FeatureCache).
+
+Usage: cache = default_feature_cache(True)
+       key = cache.key(wavfile, wave_start, wave_end, SR, config)
+       if not cache.get(key, tmpwav, plpfile): ... cache.put(key, tmpwav, plpfile)
+Command line: python -m p2fa_vislab.features [--clear]
+"""
+
+import hashlib
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+try:
+    import simplejson as json
+except:
+    import json
+
+
+from . import metrics
+from .audio import link_or_copy
+
+# bump when the prepared audio or features change for the same inputs
+CACHE_VERSION = 1
+
+_audio_hashes = {}
+
+
+def audio_hash(wavfile):
+    # content hash, remembered while the file's size and mtime stay the same
+    st = os.stat(wavfile)
+    stamp = (os.path.realpath(wavfile), st.st_size, st.st_mtime_ns)
+    if stamp not in _audio_hashes:
+        h = hashlib.sha1()
+        with open(wavfile, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        _audio_hashes[stamp] = h.hexdigest()
+    return _audio_hashes[stamp]
+
+
+class FeatureCache(object):
+    default_path = os.path.join(os.path.expanduser("~"), ".cache", "p2fa", "features")
+
+    def __init__(self, path=None, max_bytes=2 * 1024 ** 3):
+        if path is None:
+            path = os.environ.get("P2FA_FEATURE_CACHE", FeatureCache.default_path)
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+        # one connection shared by the threads using the cache, used by one of
+        # them at a time, as are the counters
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(os.path.join(path, "index.sqlite"), timeout=30, check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS entries ("
+                            "key TEXT PRIMARY KEY, bytes INTEGER NOT NULL, last_used REAL NOT NULL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+
+    def key(self, wavfile, wave_start, wave_end, SR, hcopy_config, front_end="hcopy"):
+        with open(hcopy_config, 'rb') as f:
+            config = hashlib.sha1(f.read()).hexdigest()
+        parts = [CACHE_VERSION, audio_hash(wavfile), float(wave_start),
+                 None if wave_end is None else float(wave_end), int(SR), config, front_end]
+        return hashlib.sha1(json.dumps(parts).encode("utf-8")).hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key, out_wav, out_plp):
+        """Put the cached wav and features for key at out_wav and out_plp; False on a miss"""
+        with self.lock:
+            found = self.db.execute("SELECT 1 FROM entries WHERE key = ?", (key,)).fetchone() is not None
+        if found:
+            entry = self.entry_dir(key)
+            try:
+                link_or_copy(os.path.join(entry, "sound.wav"), out_wav)
+                # HCopy may later write over the work dir's .plp in place, so never link it
+                shutil.copy(os.path.join(entry, "features.plp"), out_plp)
+            except (IOError, OSError):
+                # evicted (or deleted) in the meantime, so the entry is gone
+                found = False
+                with self.lock, self.db:
+                    self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                shutil.rmtree(entry, ignore_errors=True)
+
+        metrics.count("feature_cache_hits" if found else "feature_cache_misses")
+        with self.lock, self.db:
+            if found:
+                self.hits += 1
+                self.db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time(), key))
+                self._count("hits")
+            else:
+                self.misses += 1
+                self._count("misses")
+        return found
+
+    def put(self, key, wav, plp):
+        entry = self.entry_dir(key)
+        if os.path.exists(entry):
+            return
+        if not os.path.exists(os.path.dirname(entry)):
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+
+        # copied (the work dir's wav may be a link to the original) into place atomically
+        tmp = tempfile.mkdtemp(prefix=".tmp-", dir=os.path.dirname(entry))
+        shutil.copy(wav, os.path.join(tmp, "sound.wav"))
+        shutil.copy(plp, os.path.join(tmp, "features.plp"))
+        size = os.path.getsize(os.path.join(tmp, "sound.wav")) + os.path.getsize(os.path.join(tmp, "features.plp"))
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # another process stored it first
+            shutil.rmtree(tmp, ignore_errors=True)
+            return
+
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (key, size, time.time()))
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            total = self.size()
+            if total <= self.max_bytes:
+                return
+            for key, size in self.db.execute("SELECT key, bytes FROM entries ORDER BY last_used").fetchall():
+                if total <= self.max_bytes:
+                    break
+                self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+                shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+                total -= size
+
+    def clear(self):
+        with self.lock, self.db:
+            for (key,) in self.db.execute("SELECT key FROM entries").fetchall():
+                shutil.rmtree(self.entry_dir(key), ignore_errors=True)
+            self.db.execute("DELETE FROM entries")
+            self.db.execute("DELETE FROM counters")
+
+    def _count(self, name):
+        self.db.execute("INSERT OR IGNORE INTO counters VALUES (?, 0)", (name,))
+        self.db.execute("UPDATE counters SET value = value + 1 WHERE name = ?", (name,))
+
+    def size(self):
+        with self.lock:
+            return self.db.execute("SELECT COALESCE(SUM(bytes), 0) FROM entries").fetchone()[0]
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def stats(self):
+        """Hits and misses in this process, and since the cache was created (total_*)"""
+        with self.lock:
+            counters = dict(self.db.execute("SELECT name, value FROM counters").fetchall())
+            hits, misses = self.hits, self.misses
+            entries, size = len(self), self.size()
+        total = hits + misses
+        all_total = counters.get("hits", 0) + counters.get("misses", 0)
+        return {"hits": hits, "misses": misses,
+                "hit_rate": float(hits) / total if total else 0.0,
+                "total_hits": counters.get("hits", 0), "total_misses": counters.get("misses", 0),
+                "total_hit_rate": float(counters.get("hits", 0)) / all_total if all_total else 0.0,
+                "entries": entries, "bytes": size, "max_bytes": self.max_bytes}
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def default_feature_cache(enabled=None):
+    # the shared FeatureCache, or False when it is off; enabled None leaves
+    # that to P2FA_FEATURE_CACHE
+    global _default_cache
+    if enabled is None:
+        enabled = bool(os.environ.get("P2FA_FEATURE_CACHE"))
+    if not enabled:
+        return False
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = FeatureCache()
+    return _default_cache
+
+
+def make_cli():
+    # click is only imported when the command line is used
+    import click
+
+    @click.command()
+    @click.option('--clear', is_flag = True, help = "Remove every cached entry")
+    def cli_feature_cache(clear):
+        cache = default_feature_cache(True)
+        if clear:
+            cache.clear()
+        print(json.dumps(cache.stats(), indent = 4))
+
+    return cli_feature_cache
+
+
+def __getattr__(name):
+    if name == 'cli_feature_cache':
+        return make_cli()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+if __name__ == '__main__':
+    make_cli()()
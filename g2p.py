@@ -0,0 +1,306 @@
+"""
+Offline grapheme-to-phoneme conversion, trained from model/dict itself.
+
+Each dictionary word is first aligned letter by letter to its pronunciation
+(every letter produces zero, one or two phones) with a few rounds of hard
+EM. The aligned data then gives, for every window of surrounding letters,
+the phones the middle letter most often produces. A new word is pronounced
+by looking up each of its letters with the widest window that was seen in
+training and backing off to narrower ones. Both training and prediction
+work on whole batches of words at once with NumPy.
+
+The trained tables are saved next to the dictionary (model/g2p.npz) and
+retrained automatically when the dictionary changes.
+
+Usage: G2P.load().pronounce(["ZYXQA", "BLORPTASTIC"])
+       LocalPronounce(words).p(add_fake_stress=True)  # same interface as Pronounce
+
+Command line: python -m p2fa_vislab.g2p list of words to pronounce
+"""
+
+import os
+import re
+import sys
+
+import numpy as np
+
+try:
+    import simplejson as json
+except:
+    import json
+
+from .dictionary import DictionaryIndex
+
+this_dir = os.path.dirname(os.path.realpath(__file__))
+
+LETTERS = "'ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+N_SYMBOLS = len(LETTERS) + 1  # 0 pads either end of a word
+WINDOWS = [4, 3, 2, 1, 0]
+EM_ITERATIONS = 4
+
+word_re = re.compile(r"^[A-Z']+$")
+stress_re = re.compile(r"\d")
+
+
+def _encode(word):
+    return [LETTERS.index(c) + 1 for c in word if c in LETTERS]
+
+
+def _contexts(letters, lengths, w):
+    """Integer key of the letters within w of every position, for all words at once"""
+    padded = np.zeros((len(lengths), letters.shape[1] + 2 * w), dtype=np.int64)
+    padded[:, w:w + letters.shape[1]] = letters
+    keys = np.zeros(letters.shape, dtype=np.int64)
+    for offset in range(2 * w + 1):
+        keys = keys * N_SYMBOLS + padded[:, offset:offset + letters.shape[1]]
+    mask = np.arange(letters.shape[1])[None, :] < lengths[:, None]
+    return keys[mask]
+
+
+def _pad(seqs):
+    lengths = np.array([len(s) for s in seqs], dtype=np.int64)
+    out = np.zeros((len(seqs), max(lengths.max(), 1)), dtype=np.int64)
+    for i, s in enumerate(seqs):
+        out[i, :len(s)] = s
+    return out, lengths
+
+
+def _align_group(L, P, T0, T1, T2):
+    """Best letter-to-phone alignment for words with the same number of letters and phones.
+    Returns the number of phones (0, 1 or 2) each letter produces, and which words could be aligned."""
+    G, n = L.shape
+    m = P.shape[1]
+    S0 = T0[L]
+    S1 = T1[L[:, :, None], P[:, None, :]]
+    S2 = T2[L[:, :, None], P[:, None, :-1], P[:, None, 1:]] if m > 1 else None
+
+    D = np.full((G, m + 1), -np.inf)
+    D[:, 0] = 0.0
+    back = np.zeros((G, n, m + 1), dtype=np.int8)
+    for i in range(n):
+        cand = np.full((3, G, m + 1), -np.inf)
+        cand[0] = D + S0[:, i, None]
+        cand[1, :, 1:] = D[:, :-1] + S1[:, i, :]
+        if S2 is not None:
+            cand[2, :, 2:] = D[:, :-2] + S2[:, i, :]
+        back[:, i, :] = cand.argmax(axis=0)
+        D = cand.max(axis=0)
+
+    ok = np.isfinite(D[:, m])
+    counts = np.zeros((G, n), dtype=np.int64)
+    j = np.full(G, m)
+    rows = np.arange(G)
+    for i in range(n - 1, -1, -1):
+        k = back[rows, i, j]
+        counts[:, i] = k
+        j = j - k
+    return counts, ok
+
+
+class G2P(object):
+    def __init__(self, phones, tables, signature=None):
+        self.phones = list(phones)
+        self.tables = tables
+        self.signature = signature
+
+        # label 0 is no phone, 1..F one phone, then all pairs of phones
+        F = len(self.phones)
+        self.label_strings = [""] + self.phones
+        self.n_labels = 1 + F + F * F
+
+    def label_string(self, label):
+        F = len(self.phones)
+        if label <= F:
+            return self.label_strings[label]
+        a, b = divmod(label - 1 - F, F)
+        return self.phones[a] + " " + self.phones[b]
+
+    @classmethod
+    def train(cls, entries, signature=None):
+        """Train from (word, pronunciation) pairs"""
+        entries = [(w, pr.split()) for w, pr in entries if word_re.match(w) and len(pr.split()) > 0]
+        phones = sorted(set(p for w, pr in entries for p in pr))
+        phone_ids = dict((p, i) for i, p in enumerate(phones))
+        bases = sorted(set(stress_re.sub("", p) for p in phones))
+        base_ids = dict((p, i) for i, p in enumerate(bases))
+        F = len(phones)
+        B = len(bases)
+
+        groups = {}
+        for w, pr in entries:
+            key = (len(w), len(pr))
+            if key[1] > 2 * key[0]:
+                continue
+            if key not in groups:
+                groups[key] = ([], [], [])
+            groups[key][0].append(_encode(w))
+            groups[key][1].append([base_ids[stress_re.sub("", p)] for p in pr])
+            groups[key][2].append([phone_ids[p] for p in pr])
+        groups = dict((k, tuple(np.array(a, dtype=np.int64) for a in g)) for k, g in groups.items())
+
+        # start out preferring one phone per letter
+        C0 = np.ones(N_SYMBOLS)
+        C1 = np.ones((N_SYMBOLS, B))
+        C2 = np.full((N_SYMBOLS, B, B), 0.01)
+        for it in range(EM_ITERATIONS):
+            total = C0 + C1.sum(axis=1) + C2.sum(axis=(1, 2))
+            T0 = np.log(C0 / total)
+            T1 = np.log(C1 / total[:, None])
+            T2 = np.log(C2 / total[:, None, None])
+            C0 = np.full(N_SYMBOLS, 0.01)
+            C1 = np.full((N_SYMBOLS, B), 0.01)
+            C2 = np.full((N_SYMBOLS, B, B), 0.01)
+
+            aligned = {}
+            for key, (L, P, FP) in groups.items():
+                k, ok = _align_group(L, P, T0, T1, T2)
+                L, P, FP, k = L[ok], P[ok], FP[ok], k[ok]
+                if len(L) == 0:
+                    continue
+                start = np.cumsum(k, axis=1) - k
+                first = np.take_along_axis(P, np.minimum(start, P.shape[1] - 1), axis=1)
+                second = np.take_along_axis(P, np.minimum(start + 1, P.shape[1] - 1), axis=1)
+                np.add.at(C0, L[k == 0], 1)
+                np.add.at(C1, (L[k == 1], first[k == 1]), 1)
+                np.add.at(C2, (L[k == 2], first[k == 2], second[k == 2]), 1)
+                aligned[key] = (L, FP, k, start)
+
+        # the phones (with stress) each letter produced in the final alignment
+        letters, labels, lengths = [], [], []
+        for key, (L, FP, k, start) in aligned.items():
+            first = np.take_along_axis(FP, np.minimum(start, FP.shape[1] - 1), axis=1)
+            second = np.take_along_axis(FP, np.minimum(start + 1, FP.shape[1] - 1), axis=1)
+            letters.append(L)
+            labels.append(np.where(k == 0, 0, np.where(k == 1, 1 + first, 1 + F + first * F + second)))
+            lengths.append(np.full(len(L), key[0]))
+        max_len = max(a.shape[1] for a in letters)
+        letters = np.concatenate([np.pad(a, ((0, 0), (0, max_len - a.shape[1]))) for a in letters])
+        labels = np.concatenate([np.pad(a, ((0, 0), (0, max_len - a.shape[1]))) for a in labels])
+        lengths = np.concatenate(lengths)
+        labels = labels[np.arange(max_len)[None, :] < lengths[:, None]]
+
+        n_labels = 1 + F + F * F
+        tables = {}
+        for w in WINDOWS:
+            keys = _contexts(letters, lengths, w)
+            combined, counts = np.unique(keys * n_labels + labels, return_counts=True)
+            ckeys = combined // n_labels
+            clabels = combined % n_labels
+            # most frequent label for every context
+            order = np.lexsort((-counts, ckeys))
+            ukeys, first = np.unique(ckeys[order], return_index=True)
+            tables[w] = (ukeys, clabels[order][first])
+
+        return cls(phones, tables, signature)
+
+    def predict_labels(self, words):
+        seqs = [_encode(w.upper()) for w in words]
+        letters, lengths = _pad(seqs)
+        n = int(lengths.sum())
+        labels = np.zeros(n, dtype=np.int64)
+        done = np.zeros(n, dtype=bool)
+        for w in WINDOWS:
+            keys, table_labels = self.tables[w]
+            ctx = _contexts(letters, lengths, w)
+            idx = np.minimum(np.searchsorted(keys, ctx), len(keys) - 1)
+            hit = (keys[idx] == ctx) & ~done
+            labels[hit] = table_labels[idx[hit]]
+            done |= hit
+        return np.split(labels, np.cumsum(lengths)[:-1])
+
+    def pronounce(self, words):
+        """Pronunciations (ARPAbet with stress, as in model/dict) for a batch of words"""
+        if len(words) == 0:
+            return []
+        strings = {}
+        out = []
+        for labels in self.predict_labels(words):
+            parts = []
+            for label in labels:
+                if label not in strings:
+                    strings[label] = self.label_string(label)
+                if strings[label]:
+                    parts.append(strings[label])
+            out.append(" ".join(parts) if parts else "AH0")
+        return out
+
+    @staticmethod
+    def model_path(dict_path):
+        return os.path.join(os.path.dirname(os.path.abspath(dict_path)), "g2p.npz")
+
+    @classmethod
+    def load(cls, dict_path=None):
+        """Trained model for dict_path (default model/dict), retraining if the dictionary changed"""
+        if dict_path is None:
+            dict_path = os.path.join(this_dir, "model", "dict")
+        dictionary = DictionaryIndex.load([dict_path])
+        signature = json.dumps(dictionary.signature)
+
+        cached = _models.get(dict_path)
+        if cached is not None and cached.signature == signature:
+            return cached
+
+        path = cls.model_path(dict_path)
+        model = None
+        try:
+            with np.load(path) as data:
+                if str(data["signature"]) == signature:
+                    tables = dict((w, (data["keys_%d" % w], data["labels_%d" % w])) for w in WINDOWS)
+                    model = cls(list(data["phones"]), tables, signature)
+        except (OSError, KeyError, ValueError):
+            model = None
+
+        if model is None:
+            entries = []
+            for line in bytes(dictionary.records()).decode("utf-8").splitlines():
+                parts = line.split(None, 1)
+                if len(parts) == 2:
+                    entries.append((parts[0], parts[1]))
+            model = cls.train(entries, signature)
+            arrays = {"signature": np.array(signature), "phones": np.array(model.phones)}
+            for w in WINDOWS:
+                arrays["keys_%d" % w], arrays["labels_%d" % w] = model.tables[w]
+            try:
+                tmp_path = "%s.%d.tmp.npz" % (path, os.getpid())
+                np.savez(tmp_path, **arrays)
+                os.replace(tmp_path, path)
+            except OSError:
+                pass
+
+        _models[dict_path] = model
+        return model
+
+
+_models = {}
+
+
+class LocalPronounce(object):
+    """Drop-in replacement for pronunciation.Pronounce that never leaves the machine"""
+
+    def __init__(self, words=None, dict_path=None):
+        if words:
+            self.words = words
+        else:
+            self.words = []
+        self.dict_path = dict_path
+
+    def add(self, word):
+        self.words.append(word)
+
+    def p(self, add_fake_stress=False):
+        # The lextool gives no stress, so p(add_fake_stress=True) marks every vowel 0.
+        # G2P predicts real stress, which is kept in that case and dropped otherwise.
+        w_upper = [str(w).upper() for w in self.words]
+        prs = G2P.load(self.dict_path).pronounce(w_upper)
+
+        pronunciations = {}
+        for orig, upword, pr in zip(self.words, w_upper, prs):
+            if not add_fake_stress:
+                pr = stress_re.sub("", pr)
+            if orig not in pronunciations:
+                pronunciations[orig] = [upword, pr]
+        return pronunciations
+
+
+if __name__ == '__main__':
+    print(LocalPronounce(sys.argv[1:]).p())
@@ -0,0 +1,136 @@
+"""
+A local stand-in for the CMU lextool, so the pronunciation stage can be
+tested and benchmarked without the network.
+
+It speaks just enough of the lextool protocol for Pronounce: a POST with
+a 'wordfile' upload answers with a page linking to a numbered .dict file,
+and a GET of that file returns "WORD<tab>PRONUNCIATION" lines without
+stress marks. Words come from model/dict when possible, and are otherwise
+spelled out letter by letter.
+
+Command line: python -m p2fa_vislab.lextool_stub [--port 8123] [--delay 0.1]
+              then run the aligner with P2FA_LEXTOOL_URL=http://127.0.0.1:8123/lextool.pl
+"""
+
+import itertools
+import os
+import re
+import threading
+import time
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .dictionary import load_dictionary
+
+this_dir = os.path.dirname(os.path.realpath(__file__))
+
+stress_re = re.compile(r"(\D)\d")
+
+LETTERS = {
+    "A": "AE", "B": "B", "C": "K", "D": "D", "E": "EH", "F": "F", "G": "G", "H": "HH", "I": "IH",
+    "J": "JH", "K": "K", "L": "L", "M": "M", "N": "N", "O": "AA", "P": "P", "Q": "K", "R": "R",
+    "S": "S", "T": "T", "U": "AH", "V": "V", "W": "W", "X": "K S", "Y": "Y", "Z": "Z",
+    "0": "Z IH R OW", "1": "W AH N", "2": "T UW", "3": "TH R IY", "4": "F AO R", "5": "F AY V",
+    "6": "S IH K S", "7": "S EH V AH N", "8": "EY T", "9": "N AY N",
+}
+
+
+def stub_pronunciations(dictionary, word):
+    prs = dictionary.get(word)
+    if prs:
+        return [stress_re.sub(r"\1", pr) for pr in prs]
+    spelled = " ".join(LETTERS[c] for c in word if c in LETTERS)
+    return [spelled or "AH"]
+
+
+class LextoolStubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        msg = BytesParser(policy=HTTP).parsebytes(
+            b"Content-Type: " + self.headers["Content-Type"].encode("latin-1") + b"\r\n\r\n" + body)
+
+        words = []
+        for part in msg.iter_parts():
+            if part.get_param("name", header="content-disposition") == "wordfile":
+                words = part.get_content().split()
+                if isinstance(words[0] if words else "", bytes):
+                    words = [w.decode("utf-8") for w in words]
+
+        lines = []
+        for word in words:
+            for i, pr in enumerate(stub_pronunciations(self.server.dictionary, word.upper())):
+                name = word.upper() if i == 0 else "%s(%d)" % (word.upper(), i + 1)
+                lines.append("%s\t%s\n" % (name, pr))
+
+        job = next(self.server.job_ids)
+        self.server.results[job] = "".join(lines)
+        self.respond("<html><body><a href=\"http://%s:%d/tmp/%d.dict\">Pronunciation dictionary</a>"
+                     "</body></html>" % (self.server.server_address[0], self.server.server_address[1], job),
+                     "text/html")
+
+    def do_GET(self):
+        match = re.match(r"/tmp/(\d+)\.dict$", self.path)
+        if match is None or int(match.group(1)) not in self.server.results:
+            self.send_error(404)
+            return
+        self.respond(self.server.results.pop(int(match.group(1))), "text/plain")
+
+    def respond(self, text, content_type):
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        data = text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(host="127.0.0.1", port=0, delay=0.0, model_dir=None):
+    if model_dir is None:
+        model_dir = os.path.join(this_dir, "model")
+    server = ThreadingHTTPServer((host, port), LextoolStubHandler)
+    server.dictionary = load_dictionary(model_dir, local_dict=None)
+    server.delay = delay
+    server.results = {}
+    server.job_ids = itertools.count(1)
+    return server
+
+
+def start_stub(delay=0.0, model_dir=None):
+    """Serve the stand-in on a free port in a background thread, returns (server, url)"""
+    server = make_server(delay=delay, model_dir=model_dir)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, "http://%s:%d/lextool.pl" % server.server_address
+
+
+def make_cli():
+    # click is only imported when the command line is used
+    import click
+
+    @click.command()
+    @click.option('--port', default = 8123, help = "Port to listen on")
+    @click.option('--delay', default = 0.0, help = "Seconds of simulated latency per request")
+    def cli_lextool_stub(port, delay):
+        server = make_server(port=port, delay=delay)
+        print("Stand-in lextool at http://%s:%d/lextool.pl" % server.server_address)
+        server.serve_forever()
+
+    return cli_lextool_stub
+
+
+def __getattr__(name):
+    if name == 'cli_lextool_stub':
+        return make_cli()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+if __name__ == '__main__':
+    make_cli()()
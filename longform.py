@@ -0,0 +1,449 @@
+"""
+Align long recordings in chunks.
+
+HVite's search over an hour of audio is slow, needs a lot of memory and,
+when it fails, loses the whole file. Here the transcript is cut at line
+boundaries (very long lines at word boundaries) into chunks of about
+chunk_seconds of speech, which are aligned by do_alignment with
+wave_start/wave_end (through parallel.py, so a chunk that hangs or kills
+its process is contained), so readAlignedMLF already puts every time on
+the clock of the whole file.
+
+The first pass aligns every chunk at once, each in the window its
+characters take at the average speaking rate of the file, plus margin
+seconds on either side. A chunk's alignment is kept when its words come
+after the chunk before it, clear of the start of the window, and its
+last transcript entry is an anchor: the entry's last word ends a run of
+confidently aligned words, that is words in order, every phone no longer
+than MAX_PHONE_SECONDS, and clear of the end of the window, where HVite
+crams the words that didn't fit.
+
+Each run of chunks that doesn't fit its estimated window is aligned again
+in order, between the end of the chunk before it and the first word of
+the chunk after it. Each of those chunks' windows starts at the anchor
+the chunk before it ends on and runs for as long as its characters take
+at the speaking rate measured so far, plus margin seconds, so errors in
+the estimate never add up. The entries after the anchor start the next
+chunk. A chunk that cannot be aligned is retried once with a wider
+window; a chunk with no confident anchor is kept as aligned and the next
+one starts after its last word.
+
+Every chunk can then be aligned again in the window between its anchors
+(refine, in parallel). The chunks are stitched together in order with
+line_idx mapped back to the original transcript. A chunk that fails in
+both passes has its words spread evenly between its anchors and marked
+"unaligned", so the rest of the file is never lost.
+
+Usage: align_long(wavfile, trsfile, outfile, chunk_seconds=120, processes=8)
+Command line: python -m p2fa_vislab.longform [options] wavfile trsfile outfile
+"""
+
+import os
+import shutil
+import tempfile
+
+try:
+    import simplejson as json
+except:
+    import json
+
+from .align import parse_beams, writeOutputs
+from .alignment import Alignment
+from .audio import wav_info
+from .parallel import align_parallel
+
+PAUSE_WORDS = ("{p}", "{br}")
+
+# what a confidently aligned word is (see find_anchor)
+CONFIDENT_RUN = 3
+MAX_PHONE_SECONDS = 0.5
+EDGE_SECONDS = 1.0
+# word times are rounded to 5 places
+TIME_TOLERANCE = 0.000005
+
+
+class Chunk(object):
+    def __init__(self, index):
+        self.index = index
+        self.lines = []      # transcript entries given to do_alignment
+        self.line_idx = []   # index in the original transcript of each entry
+        self.chars = 0
+        self.start = 0.0     # the anchors the chunk starts and ends on
+        self.end = None
+        self.window = None
+        self.words = None
+        self.error = None
+
+    def add(self, line, line_idx):
+        self.lines.append(line)
+        self.line_idx.append(line_idx)
+        self.chars += len(line["line"])
+
+
+def read_transcript(trsfile):
+    with open(trsfile, 'r') as f:
+        return json.load(f)
+
+
+def wav_duration(wavfile):
+    SR, nframes = wav_info(wavfile)
+    return nframes / float(SR)
+
+
+def split_line(line, max_chars):
+    # cut a line longer than max_chars into pieces at word boundaries
+    if len(line["line"]) <= max_chars:
+        return [line]
+    pieces = []
+    current = []
+    length = 0
+    for token in line["line"].split():
+        if current and length + len(token) > max_chars:
+            pieces.append(" ".join(current))
+            current = []
+            length = 0
+        current.append(token)
+        length += len(token) + 1
+    if current:
+        pieces.append(" ".join(current))
+
+    out = []
+    for text in pieces:
+        piece = dict(line)
+        piece["line"] = text
+        out.append(piece)
+    return out
+
+
+def plan_pieces(dialog, duration, chunk_seconds):
+    # the transcript entries, with lines longer than a chunk cut up, as (entry, line_idx),
+    # the most characters in a chunk and a first guess at the characters spoken per second
+    total_chars = max(sum(len(dl["line"]) for dl in dialog), 1)
+    chars_per_second = total_chars / max(duration, 1e-6)
+    max_chars = max(int(chunk_seconds * chars_per_second), 1)
+
+    pieces = []
+    for line_idx, dl in enumerate(dialog):
+        for piece in split_line(dl, max_chars):
+            pieces.append((piece, line_idx))
+    return pieces, max_chars, chars_per_second
+
+
+def next_chunk(pieces, pos, index, max_chars):
+    # the chunk of the entries from pos on
+    chunk = Chunk(index)
+    for piece, line_idx in pieces[pos:]:
+        if chunk.chars > 0 and chunk.chars + len(piece["line"]) > max_chars:
+            break
+        chunk.add(piece, line_idx)
+    return chunk
+
+
+def run_chunks(wavfile, chunks, work_root, processes, timeout, passname, beams = None):
+    # align every chunk in its window, setting chunk.words or chunk.error
+    jobs = []
+    for chunk in chunks:
+        trsfile = os.path.join(work_root, "%s_%04d.json" % (passname, chunk.index))
+        with open(trsfile, 'w') as f:
+            json.dump(chunk.lines, f)
+        # the chunk's Alignment comes back in memory, so no outfile
+        job = {"wavfile": wavfile, "trsfile": trsfile, "outfile": None, "wave_start": chunk.window[0]}
+        if chunk.window[1] is not None:
+            job["wave_end"] = chunk.window[1]
+        jobs.append(job)
+
+    results = align_parallel(jobs, processes = processes, timeout = timeout,
+                             work_root = os.path.join(work_root, passname), phonemes = True, beams = beams)
+    for chunk, result in zip(chunks, results):
+        chunk.words = None
+        chunk.error = result["error"]
+        if chunk.error is None:
+            chunk.words = result["alignment"].to_dict(phonemes = True)["words"]
+
+
+def clip_window(start, end, duration):
+    start = max(0.0, start)
+    end = min(end, duration)
+    # leave the end open for the last chunk so no audio is cut off
+    return (round(start, 3), None if end >= duration else round(end, 3))
+
+
+def real_words(words):
+    return [w for w in words or [] if w["word"] not in PAUSE_WORDS]
+
+
+def confident(word):
+    phones = word.get("phonemes")
+    return bool(phones) and not word.get("unaligned") and word["start"] < word["end"] and \
+        all(en - st <= MAX_PHONE_SECONDS for p, st, en in phones)
+
+
+def find_anchor(chunk, start):
+    # (entry, time) of the last entry of the chunk that ends with a run of CONFIDENT_RUN
+    # confidently aligned words, in order after start and EDGE_SECONDS clear of the end
+    # of the window, and where its last word ends; None if there is no such entry
+    words = real_words(chunk.words)
+    window_end = chunk.window[1]
+    anchor = None
+    run = 0
+    last_end = start
+    for i, word in enumerate(words):
+        if word["start"] < last_end - TIME_TOLERANCE or not confident(word):
+            # out of order or badly aligned
+            run = 0
+        else:
+            run += 1
+        last_end = max(last_end, word["end"])
+        ends_entry = i + 1 == len(words) or words[i + 1]["line_idx"] != word["line_idx"]
+        if run >= CONFIDENT_RUN and ends_entry and (window_end is None or
+                                                    word["end"] <= window_end - EDGE_SECONDS):
+            anchor = (word["line_idx"], word["end"])
+    return anchor
+
+
+def cut_chunk(chunk, entry):
+    # keep the chunk's entries up to entry, and their words; the rest start the next chunk
+    last = max(i for i, w in enumerate(chunk.words) if w.get("line_idx") == entry)
+    chunk.words = chunk.words[:last + 1]
+    chunk.lines = chunk.lines[:entry + 1]
+    chunk.line_idx = chunk.line_idx[:entry + 1]
+    chunk.chars = sum(len(line["line"]) for line in chunk.lines)
+
+
+def align_in_order(wavfile, pieces, max_chars, chars_per_second, start, end, duration, margin, work_root, timeout,
+                   beams, index = 0):
+    # the anchor pass over pieces, which are spoken between start and end: each chunk in a window
+    # from where the one before it was anchored; returns the chunks and where the last one ends
+    chunks = []
+    pos = 0
+    first = start
+    chars = 0
+    while pos < len(pieces):
+        chunk = next_chunk(pieces, pos, index + len(chunks), max_chars)
+        chunk.start = start
+        last_chunk = pos + len(chunk.lines) == len(pieces)
+        expected = chunk.chars / chars_per_second
+        for widen in (1, 3):
+            chunk_end = end if last_chunk else min(start + expected + widen * margin, end)
+            chunk.window = clip_window(start, chunk_end, duration)
+            run_chunks(wavfile, [chunk], work_root, 1, timeout, "first_%d" % widen, beams)
+            if chunk.words is not None or last_chunk:
+                break
+
+        anchor = None
+        if chunk.words is not None and not last_chunk:
+            anchor = find_anchor(chunk, start)
+        if anchor is not None:
+            cut_chunk(chunk, anchor[0])
+            start = anchor[1]
+        elif real_words(chunk.words):
+            start = max(start, real_words(chunk.words)[-1]["end"])
+        else:
+            start = min(start + expected, end)
+
+        pos += len(chunk.lines)
+        chars += chunk.chars
+        if start > first:
+            # the rate so far, for the next chunk's window
+            chars_per_second = chars / (start - first)
+        chunks.append(chunk)
+    return chunks, start
+
+
+def plan_chunks(pieces, max_chars, chars_per_second, duration, margin):
+    # the chunks of the whole transcript, each in the window its characters take at the average
+    # speaking rate, margin seconds wider on either side
+    chunks = []
+    pos = 0
+    chars = 0
+    while pos < len(pieces):
+        chunk = next_chunk(pieces, pos, len(chunks), max_chars)
+        pos += len(chunk.lines)
+        start = chars / chars_per_second
+        chars += chunk.chars
+        end = duration if pos == len(pieces) else chars / chars_per_second + margin
+        chunk.window = clip_window(start - margin, end, duration)
+        chunks.append(chunk)
+    return chunks
+
+
+def fits(chunk, start):
+    # whether a chunk's alignment in its estimated window can be kept: its words come after start,
+    # clear of the start of the window (where HVite crams the words of a window that starts late),
+    # and its last entry is an anchor (see find_anchor), unless the window runs to the end of the file
+    words = real_words(chunk.words)
+    if not words or words[0]["start"] < start - TIME_TOLERANCE:
+        return False
+    if chunk.window[0] > 0 and words[0]["start"] < chunk.window[0] + EDGE_SECONDS:
+        return False
+    if chunk.window[1] is None:
+        return True
+    anchor = find_anchor(chunk, chunk.window[0])
+    return anchor is not None and anchor[0] == len(chunk.lines) - 1
+
+
+def align_chunks(wavfile, pieces, max_chars, chars_per_second, duration, margin, work_root, processes, timeout,
+                 beams):
+    # the first pass: every chunk at once in its estimated window, then each run of chunks that
+    # doesn't fit there again in order, from the end of the chunk before it to the start of the one after
+    coarse = plan_chunks(pieces, max_chars, chars_per_second, duration, margin)
+    run_chunks(wavfile, coarse, work_root, processes, timeout, "coarse", beams)
+
+    chunks = []
+    failed = []
+    start = 0.0
+    for chunk in coarse + [None]:
+        if chunk is not None and not fits(chunk, start):
+            failed.append(chunk)
+            continue
+        if failed:
+            end = duration if chunk is None else real_words(chunk.words)[0]["start"]
+            run = [(line, line_idx) for c in failed for line, line_idx in zip(c.lines, c.line_idx)]
+            realigned, start = align_in_order(wavfile, run, max_chars, chars_per_second, start, end, duration,
+                                              margin, work_root, timeout, beams, index = len(chunks))
+            chunks.extend(realigned)
+            failed = []
+        if chunk is None:
+            break
+        chunk.start = start
+        start = max(start, real_words(chunk.words)[-1]["end"])
+        chunks.append(chunk)
+
+    for i, chunk in enumerate(chunks):
+        chunk.index = i
+    for chunk, nxt in zip(chunks[:-1], chunks[1:]):
+        chunk.end = nxt.start
+    chunks[-1].end = duration
+    return chunks
+
+
+def unaligned_words(chunk, start, end):
+    # spread the chunk's words over [start, end] in proportion to their length
+    tokens = []
+    for line, line_idx in zip(chunk.lines, chunk.line_idx):
+        for token in line["line"].split():
+            tokens.append((token, line_idx, line))
+    total = float(sum(len(t[0]) + 1 for t in tokens)) or 1.0
+
+    words = []
+    t = start
+    for token, line_idx, line in tokens:
+        length = (end - start) * (len(token) + 1) / total
+        word = {"word": token, "alignedWord": token.upper(), "start": round(t, 5),
+                "end": round(t + length, 5), "line_idx": line_idx, "unaligned": True}
+        if "speaker" in line:
+            word["speaker"] = line["speaker"]
+        if "emotion" in line:
+            word["emotion"] = line["emotion"]
+        words.append(word)
+        t += length
+    return words
+
+
+def stitch(chunks):
+    out = []
+    prev_end = 0.0
+    for chunk in chunks:
+        if chunk.words is None:
+            words = unaligned_words(chunk, chunk.start, max(chunk.start, chunk.end))
+        else:
+            words = []
+            for word in chunk.words:
+                word = dict(word)
+                if "line_idx" in word:
+                    word["line_idx"] = chunk.line_idx[word["line_idx"]]
+                words.append(word)
+
+        for word in words:
+            if word["end"] <= prev_end and word["word"] in PAUSE_WORDS:
+                continue
+            word["start"] = max(word["start"], prev_end)
+            word["end"] = max(word["end"], word["start"])
+            if "phonemes" in word:
+                word["phonemes"] = [[p, max(st, word["start"]), min(en, word["end"])]
+                                    for p, st, en in word["phonemes"]]
+            out.append(word)
+            prev_end = word["end"]
+    return out
+
+
+def align_long(wavfile, trsfile, outfile, json = True, textgrid = False, phonemes = False,
+               chunk_seconds = 120.0, margin = 15.0, refine = True, processes = None, timeout = None,
+               work_root = None, keep_work_dir = False, beams = None):
+    """Align wavfile to trsfile (a JSON transcript) chunk by chunk and write the
+    stitched alignment to outfile. Returns the chunks, with their windows and
+    errors, for reporting."""
+    dialog = read_transcript(trsfile)
+    duration = wav_duration(wavfile)
+    pieces, max_chars, chars_per_second = plan_pieces(dialog, duration, chunk_seconds)
+
+    made_root = work_root is None
+    if made_root:
+        work_root = tempfile.mkdtemp(prefix = "p2fa-long-")
+    elif not os.path.exists(work_root):
+        os.makedirs(work_root)
+
+    try:
+        chunks = align_chunks(wavfile, pieces, max_chars, chars_per_second, duration, margin, work_root, processes,
+                              timeout, beams)
+
+        if refine and len(chunks) > 1:
+            # fine pass: each chunk between its anchors, all at once
+            first = [(c.words, c.window) for c in chunks]
+            for chunk in chunks:
+                chunk.window = clip_window(chunk.start, chunk.end, duration)
+            run_chunks(wavfile, chunks, work_root, processes, timeout, "fine", beams)
+            for chunk, (words, window) in zip(chunks, first):
+                if chunk.words is None and words is not None:
+                    chunk.words = words
+                    chunk.window = window
+    finally:
+        if made_root and not keep_work_dir:
+            shutil.rmtree(work_root, ignore_errors = True)
+
+    # written like any other alignment
+    alignment = Alignment.from_words(stitch(chunks))
+    writeOutputs(outfile, alignment, json = json, textgrid = textgrid, phonemes = phonemes)
+
+    return chunks
+
+
+def make_cli():
+    # click is only imported when the command line is used
+    import click
+
+    @click.command()
+    @click.argument('wavfile')
+    @click.argument('trsfile')
+    @click.argument('outfile')
+    @click.option('--json/--no-json', default = True, help = "Export json alignment")
+    @click.option('--textgrid/--no-textgrid', default = False, help = "Export Praat TextGrid alignment")
+    @click.option('--phonemes/--no-phonemes', default = False, help = "Add phoneme information to JSON output")
+    @click.option('--chunk-seconds', default = 120.0, help = "Approximate length of each chunk of audio")
+    @click.option('--margin', default = 15.0,
+                  help = "Seconds of audio added around the expected window of a chunk in the first pass")
+    @click.option('--refine/--no-refine', default = True, help = "Realign each chunk between its anchors")
+    @click.option('--processes', '-j', default = None, type = int,
+                  help = "Number of worker processes for aligning the chunks")
+    @click.option('--timeout', default = None, type = float, help = "Seconds allowed for each chunk")
+    @click.option('--beams', default = None, help = "Comma-separated HVite beam widths to try in turn (0 is no pruning)")
+    def cli_align_long(wavfile, trsfile, outfile, json, textgrid, phonemes, chunk_seconds, margin, refine, processes,
+                       timeout, beams):
+        chunks = align_long(wavfile, trsfile, outfile, json, textgrid, phonemes, chunk_seconds, margin, refine,
+                            processes, timeout, beams = parse_beams(beams))
+        unaligned = [c for c in chunks if c.words is None]
+        for chunk in unaligned:
+            print("Chunk %d (lines %d-%d): %s" % (chunk.index, chunk.line_idx[0], chunk.line_idx[-1], chunk.error))
+        print("Aligned %d of %d chunks" % (len(chunks) - len(unaligned), len(chunks)))
+
+    return cli_align_long
+
+
+def __getattr__(name):
+    if name == 'cli_align_long':
+        return make_cli()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+if __name__ == '__main__':
+    make_cli()()
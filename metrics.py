@@ -0,0 +1,262 @@
+"""
+Per-stage timing and resource metrics of an alignment.
+
+While a Metrics object is recording (see recording()), do_alignment,
+align_batch and detect_breaths time each of their stages (wall-clock
+and CPU time of the thread running it), every HCopy/HVite run records
+its wall time, exit status and resource usage (user and system time,
+peak RSS), and the dictionary, feature and pronunciation caches count
+their hits and misses, as prep_mlf counts the words missing from the
+dictionary. Nothing is recorded, and next to nothing spent, when no
+Metrics is recording. Stages may nest (resolve_oov is part of prep_mlf)
+and a stage that runs more than once adds up.
+
+The metrics go to a JSON sidecar (write_json) or a Prometheus textfile
+(write_prometheus, for node_exporter's textfile collector). With
+profile=True the Python stages are also run under cProfile
+(write_profile saves the stats for python -m pstats).
+
+Usage: with recording(Metrics("job1")) as m:
+           do_alignment(wavfile, trsfile, outfile)
+       m.write_json("out.metrics.json"); m.write_prometheus("/var/lib/node_exporter/p2fa.prom")
+"""
+
+import contextlib
+import collections
+import contextvars
+import os
+import subprocess
+import time
+
+try:
+    import simplejson as json
+except:
+    import json
+
+CACHES = ("dictionary", "feature", "pronunciation")
+
+_current = contextvars.ContextVar("p2fa_metrics", default = None)
+
+# the fields of a resource.struct_rusage that child() reads
+Usage = collections.namedtuple("Usage", ["ru_utime", "ru_stime", "ru_maxrss"])
+
+
+class Metrics(object):
+    def __init__(self, name = None, profile = False):
+        self.name = name
+        self.started = time.time()
+        # {stage: {"wall": seconds, "cpu": seconds, "runs": n}}, in the order they first finished
+        self.stages = {}
+        self.children = []
+        self.counters = {}
+        self.profiler = None
+        self._depth = 0
+        if profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self._depth == 0 and self.profiler is not None:
+            self.profiler.enable()
+        self._depth += 1
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            s = self.stages.setdefault(name, {"wall": 0.0, "cpu": 0.0, "runs": 0})
+            s["wall"] += time.perf_counter() - wall
+            s["cpu"] += time.thread_time() - cpu
+            s["runs"] += 1
+            self._depth -= 1
+            if self._depth == 0 and self.profiler is not None:
+                self.profiler.disable()
+
+    def child(self, tool, wall, returncode, rusage = None):
+        # one HTK run; rusage is the resource.struct_rusage of the process, if known
+        run = {"tool": tool, "wall": wall, "returncode": returncode}
+        if rusage is not None:
+            run.update({"user": rusage.ru_utime, "sys": rusage.ru_stime, "max_rss_kib": rusage.ru_maxrss})
+        self.children.append(run)
+
+    def count(self, name, n = 1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def caches(self):
+        caches = {}
+        for cache in CACHES:
+            hits = self.counters.get(cache + "_cache_hits", 0)
+            misses = self.counters.get(cache + "_cache_misses", 0)
+            if hits or misses:
+                caches[cache] = {"hits": hits, "misses": misses, "hit_rate": float(hits) / (hits + misses)}
+        return caches
+
+    def tools(self):
+        # the HTK runs added up per tool
+        tools = {}
+        for run in self.children:
+            t = tools.setdefault(run["tool"], {"runs": 0, "failures": 0, "wall": 0.0, "user": 0.0, "sys": 0.0,
+                                               "max_rss_kib": 0})
+            t["runs"] += 1
+            t["failures"] += run["returncode"] != 0
+            t["wall"] += run["wall"]
+            t["user"] += run.get("user", 0.0)
+            t["sys"] += run.get("sys", 0.0)
+            t["max_rss_kib"] = max(t["max_rss_kib"], run.get("max_rss_kib", 0))
+        return tools
+
+    def to_dict(self, profile_top = 20):
+        out = {"name": self.name, "started": self.started, "stages": self.stages, "htk": self.children,
+               "htk_totals": self.tools(), "caches": self.caches(), "counters": self.counters}
+        if self.profiler is not None:
+            out["profile"] = self.profile_top(profile_top)
+        return out
+
+    def profile_top(self, n = 20):
+        # the n functions with the most cumulative time in the Python stages
+        import pstats
+        stats = pstats.Stats(self.profiler)
+        rows = []
+        for (filename, line, function), (cc, nc, tt, ct, callers) in stats.stats.items():
+            rows.append({"function": "%s:%d(%s)" % (filename, line, function), "calls": nc, "tottime": tt,
+                         "cumtime": ct})
+        return sorted(rows, key = lambda r: -r["cumtime"])[:n]
+
+    def write_json(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent = 4)
+
+    def write_profile(self, path):
+        if self.profiler is not None:
+            self.profiler.dump_stats(path)
+
+    def prometheus(self):
+        """The metrics in the Prometheus text format"""
+        job = {"job": self.name or ""}
+        lines = []
+
+        def metric(name, help, rows):
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s gauge" % name)
+            for labels, value in rows:
+                lines.append("%s{%s} %r" % (name, ",".join('%s="%s"' % (k, _escape(v)) for k, v in
+                                                           sorted(dict(job, **labels).items())), float(value)))
+
+        metric("p2fa_stage_seconds", "Wall-clock time of an alignment stage.",
+               [({"stage": s}, v["wall"]) for s, v in self.stages.items()])
+        metric("p2fa_stage_cpu_seconds", "CPU time of the thread running an alignment stage.",
+               [({"stage": s}, v["cpu"]) for s, v in self.stages.items()])
+        metric("p2fa_stage_runs", "Times an alignment stage ran.",
+               [({"stage": s}, v["runs"]) for s, v in self.stages.items()])
+        tools = self.tools()
+        for key, name, help in [("runs", "p2fa_htk_runs", "HTK tool runs."),
+                                ("failures", "p2fa_htk_failures", "HTK tool runs with a non-zero exit status."),
+                                ("wall", "p2fa_htk_seconds", "Wall-clock time of the HTK tool runs."),
+                                ("user", "p2fa_htk_user_seconds", "User CPU time of the HTK tool runs."),
+                                ("sys", "p2fa_htk_sys_seconds", "System CPU time of the HTK tool runs.")]:
+            metric(name, help, [({"tool": t}, v[key]) for t, v in tools.items()])
+        metric("p2fa_htk_max_rss_bytes", "Peak resident set size of an HTK tool run.",
+               [({"tool": t}, v["max_rss_kib"] * 1024) for t, v in tools.items()])
+        caches = self.caches()
+        metric("p2fa_cache_hits", "Cache hits.", [({"cache": c}, v["hits"]) for c, v in caches.items()])
+        metric("p2fa_cache_misses", "Cache misses.", [({"cache": c}, v["misses"]) for c, v in caches.items()])
+        metric("p2fa_cache_hit_ratio", "Cache hit rate.", [({"cache": c}, v["hit_rate"]) for c, v in caches.items()])
+        metric("p2fa_count", "Counts such as out-of-dictionary words, pauses and breaths.",
+               [({"name": k}, v) for k, v in sorted(self.counters.items()) if not k.endswith(("_hits", "_misses"))])
+        metric("p2fa_last_run_timestamp_seconds", "When the alignment started.", [({}, self.started)])
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        # written then renamed, so the textfile collector never reads half a file
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmp, path)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def current():
+    """The Metrics recording in this thread or task, or None"""
+    return _current.get()
+
+
+@contextlib.contextmanager
+def recording(metrics = None):
+    if metrics is None:
+        metrics = Metrics()
+    token = _current.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current.reset(token)
+
+
+@contextlib.contextmanager
+def stage(name):
+    metrics = _current.get()
+    if metrics is None:
+        yield
+    else:
+        with metrics.stage(name):
+            yield
+
+
+def count(name, n = 1):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.count(name, n)
+
+
+def child(tool, wall, returncode, rusage = None):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.child(tool, wall, returncode, rusage)
+
+
+def usage_since(before, after):
+    # the usage of the children reaped between two getrusage(RUSAGE_CHILDREN);
+    # the peak RSS is the largest of any child reaped so far
+    return Usage(after.ru_utime - before.ru_utime, after.ru_stime - before.ru_stime, after.ru_maxrss)
+
+
+def wait(proc, timeout = None):
+    # proc.wait(timeout) that also returns the child's resource usage
+    if timeout is None:
+        _, status, rusage = os.wait4(proc.pid, 0)
+    else:
+        deadline = time.monotonic() + timeout
+        delay = 0.001
+        while True:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid == proc.pid:
+                break
+            if time.monotonic() >= deadline:
+                raise subprocess.TimeoutExpired(proc.args, timeout)
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, rusage
+
+
+@contextlib.contextmanager
+def command_line(base, metrics_file = False, prometheus_file = None, profile = False):
+    # what the command lines' --metrics, --prometheus and --profile do: record
+    # while running, then write base.metrics.json, the textfile and base.prof
+    if not (metrics_file or prometheus_file or profile):
+        yield None
+        return
+    # (also when the run fails, to show how far it got)
+    with recording(Metrics(os.path.basename(base), profile = profile)) as m:
+        try:
+            yield m
+        finally:
+            if metrics_file:
+                m.write_json(base + ".metrics.json")
+            if prometheus_file:
+                m.write_prometheus(prometheus_file)
+            if profile:
+                m.write_profile(base + ".prof")
@@ -0,0 +1,106 @@
+"""
+Columnar phone and word alignments read from HVite's aligned MLF.
+
+An entry is read once, a line at a time, into NumPy columns: a phone id,
+start and end time for every phone, and for every word its label and the
+index of its first phone (word_first, with one extra entry at the end, so
+the phones of word i are word_first[i]:word_first[i + 1]). Times are
+converted to seconds (with the 11025 Hz correction and wave_start offset)
+on whole columns at once. Words with no phones are optional words, like a
+pause, that were not realized. All of the output writers take this
+structure.
+
+Usage: alignment = read_aligned_mlf(open(mlffile), SR, wave_start)
+       for i in alignment.spoken_words(): alignment.word_start(i), ...
+"""
+
+import numpy as np
+
+# HTK times are in units of 100 ns
+HTK_TIME_UNIT = 10000000.0
+# HVite times are of the first sample of a frame; move them to its centre
+FRAME_OFFSET = 0.0125
+
+
+class PhoneAlignment(object):
+    __slots__ = ("word_labels", "word_first", "phone_names", "phone_ids", "start", "end")
+
+    def __init__(self, word_labels, word_first, phone_names, phone_ids, start, end):
+        self.word_labels = word_labels
+        self.word_first = word_first
+        self.phone_names = phone_names
+        self.phone_ids = phone_ids
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return len(self.word_labels)
+
+    def n_phones(self):
+        return len(self.phone_ids)
+
+    def spoken_words(self):
+        """Indices of the words with at least one phone"""
+        return np.flatnonzero(np.diff(self.word_first) > 0)
+
+    def word_start(self, i):
+        return float(self.start[self.word_first[i]])
+
+    def word_end(self, i):
+        return float(self.end[self.word_first[i + 1] - 1])
+
+    def word_phones(self, i):
+        """[phone, start, end] of each phone of word i"""
+        first, last = self.word_first[i], self.word_first[i + 1]
+        return [[self.phone_names[p], st, en] for p, st, en in
+                zip(self.phone_ids[first:last].tolist(), self.start[first:last].tolist(),
+                    self.end[first:last].tolist())]
+
+    def to_lists(self):
+        """The alignment as a list of [word, [phone, start, end], ...] lists"""
+        return [[self.word_labels[i]] + self.word_phones(i) for i in range(len(self))]
+
+
+def read_aligned_mlf(lines, SR, wave_start = 0.0):
+    # Read one entry of an aligned MLF from lines (any iterable of lines,
+    # e.g. an open file positioned after the entry's label) up to its '.'.
+    word_labels = []
+    word_of = []
+    phone_index = {}
+    phone_names = []
+    phone_ids = []
+    start = []
+    end = []
+    for line in lines:
+        fields = line.split()
+        if not fields or fields[0] == '.':
+            break
+        if len(fields) == 5:
+            # the start of a word: it has a word label
+            word_labels.append(fields[4])
+        elif not word_labels:
+            raise ValueError("Aligned MLF entry has a phone before its first word")
+        ph = fields[2]
+        if ph not in phone_index:
+            phone_index[ph] = len(phone_names)
+            phone_names.append(ph)
+        phone_ids.append(phone_index[ph])
+        word_of.append(len(word_labels) - 1)
+        start.append(int(fields[0]))
+        end.append(int(fields[1]))
+
+    start = np.array(start, dtype=np.float64) / HTK_TIME_UNIT + FRAME_OFFSET
+    end = np.array(end, dtype=np.float64) / HTK_TIME_UNIT + FRAME_OFFSET
+    if SR == 11025:
+        start *= 11000.0 / 11025.0
+        end *= 11000.0 / 11025.0
+    start += wave_start
+    end += wave_start
+
+    # empty phones are left out; their word stays, maybe with no phones
+    keep = start < end
+    counts = np.bincount(np.array(word_of, dtype=np.int64)[keep], minlength=len(word_labels))
+    word_first = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    return PhoneAlignment(word_labels, word_first, phone_names, np.array(phone_ids, dtype=np.int32)[keep],
+                          start[keep], end[keep])
@@ -0,0 +1,94 @@
+"""
+Split transcript lines into the words given to HVite.
+
+Each line goes through the same steps prep_mlf always applied (event
+tags like {laugh} become {LG}, hanging punctuation is dropped, the rest
+of the punctuation is stripped except decimal points, hyphenated words
+are split), with every pattern compiled once and the common steps done
+in one translate or regex pass. A word comes out together with the
+original, punctuated token it came from, so the word map for the output
+is built in the same pass.
+
+Usage: for line_idx, token, words in iter_words(lines): ...
+       normalize_line("Hello, world-wide...") -> (["Hello,", "world-wide..."], ["Hello", "world-wide"])
+"""
+
+import re
+
+# event tags in transcripts and the dictionary words for them
+EVENTS = {"{br}": "{BR}", "&lt;noise&gt;": "{NS}", "{laugh}": "{LG}", "{laughter}": "{LG}",
+          "{cough}": "{CG}", "{lipsmack}": "{LS}"}
+eventPat = re.compile("|".join(re.escape(e) for e in sorted(EVENTS, key = len, reverse = True)))
+
+# punctuation that is dropped when it stands on its own
+HANGING = [',', '.', ':', ';', '!', '?', '"', '%', '(', ')', '-', '--', '---']
+hangingPat = re.compile(r"(?:^| )(?:[,.:;!?\"%()]|-{1,3}) ")
+
+hyphPunctPat = re.compile(r"(-[-]+[,\.:;!\?\"%\(\)-]*)")
+ellipsisPat = re.compile(r"([A-Za-z])\.\.\.([A-Za-z])")
+# decimal points survive the punctuation stripping
+decimalPat = re.compile(r"(\d)\.(\d)")
+# punctuation stripped from words; pairs of hyphens go too
+STRIP = str.maketrans("", "", ",.:;!?\"%()")
+hyphenRunPat = re.compile(r"-{2,}")
+spacePat = re.compile(r"\s+")
+
+# this pattern matches hyphenated words, such as TWENTY-TWO; however, it doesn't work with longer things like SOMETHING-OR-OTHER
+hyphenPat = re.compile(r'([a-zA-Z]+)-([a-zA-Z]+)')
+
+
+class TranscriptError(ValueError):
+    pass
+
+
+def _drop_hanging(txt):
+    for pun in HANGING:
+        if txt.startswith(pun + ' '):
+            txt = txt[2:]
+
+        # remove hanging punctuation before we get started
+        txt = txt.replace(' ' + pun + ' ', ' ')
+    return txt
+
+
+def _odd_hyphen(match):
+    return '-' * (len(match.group(0)) % 2)
+
+
+def normalize_line(line):
+    """(tokens as written, tokens with their punctuation stripped) of a line"""
+    txt = eventPat.sub(lambda m: EVENTS[m.group(0)], line.replace('\n', ''))
+    if hangingPat.search(txt):
+        txt = _drop_hanging(txt)
+
+    txt = hyphPunctPat.sub(r"\1 ", txt)
+    txt = ellipsisPat.sub(r"\1... \2", txt)
+
+    with_pun = txt.split()
+
+    txt = decimalPat.sub("\\1\0\\2", txt.replace('...', ''))
+    txt = hyphenRunPat.sub(_odd_hyphen, txt.translate(STRIP)).replace("\0", ".")
+    # a quote at the start of a word goes
+    words = spacePat.sub(' ', txt).replace(" '", " ").split()
+
+    if len(words) != len(with_pun):
+        # Try not to use hyphenated words either, if at all possible!
+        raise TranscriptError("Floating punctuation! Remove this from your transcript: %r" % line)
+    return with_pun, words
+
+
+def split_word(word):
+    # break up any hyphenated words into two separate words, upper-cased
+    return [w.upper() for w in hyphenPat.sub(r'\1 \2', word).split()]
+
+
+def iter_words(lines):
+    """(line index, token as written, [dictionary words]) for each token of lines,
+    which may be any iterable (e.g. a stream of transcript lines)"""
+    for i, line in enumerate(lines):
+        try:
+            with_pun, words = normalize_line(line)
+        except TranscriptError as e:
+            raise TranscriptError("line %d: %s" % (i, e))
+        for token, word in zip(with_pun, words):
+            yield i, token, split_word(word)
@@ -0,0 +1,136 @@
+"""
+Pronounce numbers by spelling them out and joining the dictionary
+pronunciations of the words, instead of asking the pronunciation service.
+
+Handles cardinals (42, 4500), years (1984, 1900, 1905 -> NINETEEN OH FIVE),
+plurals (1980s, 70s), ordinals (21st, 100th) and decimals (3.14). Tokens
+are upper-case, as they are in prep_mlf. Results are memoized, and one
+inflect engine is shared by everything in the process (it keeps state
+between calls, so threads take turns with it).
+
+Usage: NumberPronouncer.for_dictionary(idx).pronounce("1980S")
+"""
+
+import re
+import threading
+
+number_re = re.compile(r"^(\d+)(S|'S|ST|ND|RD|TH)?$")
+decimal_re = re.compile(r"^(\d*)\.(\d+)$")
+
+_engine = None
+_engine_lock = threading.RLock()
+
+
+def engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            # inflect is slow to import, so only numbers that need spelling out load it
+            import inflect
+            _engine = inflect.engine()
+    return _engine
+
+
+def is_year(digits):
+    # this is probably a year
+    return len(digits) == 4 and 1000 < int(digits) < 2000
+
+
+def number_to_words(n, ordinal = False):
+    infl = engine()
+    with _engine_lock:
+        if ordinal:
+            n = infl.ordinal(n)
+        text = infl.number_to_words(n, andword = '')
+    return text.upper().replace('-', ' ').replace(',', ' ').split()
+
+
+def year_to_words(digits):
+    year1 = number_to_words(int(digits[:2]))
+    year2 = digits[2:]
+    if year2 == "00":
+        return year1 + ["HUNDRED"]
+    elif year2[0] == "0":
+        return year1 + ["OH"] + number_to_words(int(year2[1]))
+    return year1 + number_to_words(int(year2))
+
+
+def verbalize(token):
+    """Words that spell out a number token, or None if it isn't one"""
+    match = decimal_re.match(token)
+    if match:
+        whole, frac = match.groups()
+        words = number_to_words(int(whole)) if whole else []
+        return words + ["POINT"] + [number_to_words(int(d))[0] for d in frac]
+
+    match = number_re.match(token)
+    if match is None:
+        return None
+    digits, suffix = match.groups()
+
+    if suffix in ("ST", "ND", "RD", "TH"):
+        return number_to_words(int(digits), ordinal = True)
+
+    if is_year(digits):
+        words = year_to_words(digits)
+    else:
+        words = number_to_words(int(digits))
+
+    if suffix in ("S", "'S"):
+        words[-1] = words[-1] + "+S"
+    return words
+
+
+class NumberPronouncer(object):
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    def __init__(self, dictionary):
+        self.dictionary = dictionary
+        self.memo = {}
+
+    @classmethod
+    def for_dictionary(cls, dictionary):
+        # one memo per dictionary, shared by every file aligned in this process
+        key = id(dictionary)
+        with cls._instances_lock:
+            if key not in cls._instances or cls._instances[key].dictionary is not dictionary:
+                cls._instances[key] = cls(dictionary)
+            return cls._instances[key]
+
+    def word(self, word):
+        if word.endswith("+S"):
+            return self.plural(word[:-2])
+        prs = self.dictionary.get(word)
+        if not prs:
+            return None
+        return prs[0]
+
+    def plural(self, word):
+        # EIGHTY -> EIGHTIES, HUNDRED -> HUNDREDS, SIX -> SIXES, ...
+        candidates = [word + "S", word + "ES"]
+        if word.endswith("Y"):
+            candidates.insert(0, word[:-1] + "IES")
+        for candidate in candidates:
+            prs = self.dictionary.get(candidate)
+            if prs:
+                return prs[0]
+        pr = self.word(word)
+        if pr is None:
+            return None
+        return pr + " Z"
+
+    def pronounce(self, token):
+        """Pronunciation of a number token, or None if it isn't a number we can spell out"""
+        if token in self.memo:
+            return self.memo[token]
+
+        pr = None
+        words = verbalize(token)
+        if words is not None:
+            prs = [self.word(w) for w in words]
+            if None not in prs:
+                pr = ' '.join(prs)
+
+        self.memo[token] = pr
+        return pr
@@ -0,0 +1,199 @@
+"""
+Run many alignments at once across worker processes.
+
+Each job gets its own scratch directory under work_root (its own tmp files,
+dict.tmp and HTK outputs), nothing is written to the current directory
+except the job's outfile, and nothing changes directory, so any number of
+jobs can run side by side. Results come back in the order of the jobs.
+A job that raises or runs past its timeout is reported as failed without
+affecting the others; a timed-out job's HTK processes are killed. When a
+worker dies outright the pool breaks: the jobs that were running then are
+run again one at a time to find the one that died, the others are resumed
+in a fresh pool, and only the job that killed its worker is failed.
+
+Jobs are given like batch.py manifests: dicts with wavfile, trsfile and
+outfile, (wavfile, trsfile, outfile) tuples, or a manifest file. Other keys
+of a dict job (e.g. wave_start, wave_end) are passed to do_alignment.
+
+Usage: align_parallel(jobs, processes=8, timeout=600, textgrid=True)
+Command line: python -m p2fa_vislab.parallel [options] manifest
+"""
+
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+from .align import do_alignment, job_file_name, parse_beams
+from .batch import read_manifest
+
+
+class JobTimeout(Exception):
+    pass
+
+
+def _alarm(signum, frame):
+    raise JobTimeout()
+
+
+def _init_worker():
+    # connections made before the fork can't be shared with the parent (only
+    # the modules the parent had loaded have any)
+    pronunciation = sys.modules.get(__package__ + ".pronunciation")
+    if pronunciation is not None:
+        pronunciation._default_cache = None
+        pronunciation._session = None
+    features = sys.modules.get(__package__ + ".features")
+    if features is not None:
+        features._default_cache = None
+
+
+def _running_file(work_dir):
+    # there while the job's worker is running it, so it's left behind by a worker that died
+    return work_dir + ".running"
+
+
+def _run_job(args):
+    index, wavfile, trsfile, outfile, work_dir, timeout, keep_work_dir, options = args
+    start = time.time()
+    open(_running_file(work_dir), 'w').close()
+    result = {"index": index, "wavfile": wavfile, "trsfile": trsfile, "outfile": outfile,
+              "work_dir": work_dir, "error": None, "alignment": None}
+
+    if timeout:
+        signal.signal(signal.SIGALRM, _alarm)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        result["alignment"] = do_alignment(wavfile, trsfile, outfile, work_dir = work_dir, timeout = timeout,
+                                           **options)
+    except JobTimeout:
+        result["error"] = "Timed out after %g seconds" % timeout
+    except Exception as e:
+        result["error"] = "%s: %s" % (type(e).__name__, e)
+        result["traceback"] = traceback.format_exc()
+    finally:
+        if timeout:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        if not keep_work_dir:
+            shutil.rmtree(work_dir, ignore_errors = True)
+        os.remove(_running_file(work_dir))
+
+    result["seconds"] = time.time() - start
+    return result
+
+
+def _run_pool(tasks, processes, results):
+    # run tasks in a fresh pool until they're all done or a worker dies,
+    # returns the ones with no result yet
+    with ProcessPoolExecutor(max_workers = processes, initializer = _init_worker) as pool:
+        futures = [pool.submit(_run_job, task) for task in tasks]
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except BrokenProcessPool:
+                # every job not done yet ends up here
+                continue
+            results[result["index"]] = result
+    return [task for task in tasks if results[task[0]] is None]
+
+
+def _died(task, message):
+    index, wavfile, trsfile, outfile, work_dir = task[:5]
+    return {"index": index, "wavfile": wavfile, "trsfile": trsfile, "outfile": outfile, "work_dir": work_dir,
+            "error": message, "alignment": None}
+
+
+def align_parallel(jobs, processes = None, timeout = None, work_root = None, keep_work_dirs = False, **options):
+    """Align jobs in processes worker processes (default: one per CPU) and return
+    one result dict per job, in order, with "error" set to None for the ones that worked
+    and "alignment" set to their Alignment.
+    Other keyword arguments (json, textgrid, phonemes, prune_dict, beams) go to do_alignment."""
+    jobs = read_manifest(jobs)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    made_root = work_root is None
+    if made_root:
+        work_root = tempfile.mkdtemp(prefix = "p2fa-")
+
+    tasks = []
+    for i, job in enumerate(jobs):
+        work_dir = os.path.join(work_root, "%06d_%s" % (i, job_file_name(job.wavfile)))
+        job_options = dict(options)
+        job_options.update(job.options)
+        tasks.append((i, job.wavfile, job.trsfile, job.outfile, work_dir, timeout, keep_work_dirs, job_options))
+
+    results = [None] * len(tasks)
+    try:
+        if not os.path.exists(work_root):
+            os.makedirs(work_root)
+        pending = tasks
+        while pending:
+            pending = _run_pool(pending, processes, results)
+            # a worker died outright (killed, crashed in HTK's libraries, ...) and
+            # took the pool down; one of the jobs running then is to blame
+            running = [task for task in pending if os.path.exists(_running_file(task[4]))]
+            if pending and not running:
+                # the pool broke before any job started
+                for task in pending:
+                    results[task[0]] = _died(task, "Worker process died before the job started")
+                break
+            for task in running:
+                os.remove(_running_file(task[4]))
+                if len(running) > 1:
+                    # run again on its own, from a clean work_dir
+                    shutil.rmtree(task[4], ignore_errors = True)
+                    if not _run_pool([task], 1, results):
+                        continue
+                    os.remove(_running_file(task[4]))
+                results[task[0]] = _died(task, "Worker process died")
+                if not keep_work_dirs:
+                    shutil.rmtree(task[4], ignore_errors = True)
+            pending = [task for task in pending if results[task[0]] is None]
+    finally:
+        if made_root and not keep_work_dirs:
+            shutil.rmtree(work_root, ignore_errors = True)
+
+    return results
+
+
+def make_cli():
+    # click is only imported when the command line is used
+    import click
+
+    @click.command()
+    @click.argument('manifest')
+    @click.option('--processes', '-j', default = None, type = int, help = "Number of worker processes")
+    @click.option('--timeout', default = None, type = float, help = "Seconds allowed for each file")
+    @click.option('--json/--no-json', default = True, help = "Export json alignment")
+    @click.option('--textgrid/--no-textgrid', default = False, help = "Export Praat TextGrid alignment")
+    @click.option('--phonemes/--no-phonemes', default = False, help = "Add phoneme information to JSON output")
+    @click.option('--prune-dict/--no-prune-dict', default = False,
+                  help = "Give HVite a dictionary with only the words in the transcript")
+    @click.option('--beams', default = None, help = "Comma-separated HVite beam widths to try in turn (0 is no pruning)")
+    def cli_align_parallel(manifest, processes, timeout, json, textgrid, phonemes, prune_dict, beams):
+        results = align_parallel(manifest, processes = processes, timeout = timeout, json = json,
+                                 textgrid = textgrid, phonemes = phonemes, prune_dict = prune_dict,
+                                 beams = parse_beams(beams))
+        failed = [r for r in results if r["error"] is not None]
+        for r in failed:
+            print("%s: %s" % (r["wavfile"], r["error"]))
+        print("Aligned %d of %d files" % (len(results) - len(failed), len(results)))
+
+    return cli_align_parallel
+
+
+def __getattr__(name):
+    if name == 'cli_align_parallel':
+        return make_cli()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+if __name__ == '__main__':
+    make_cli()()
@@ -0,0 +1,328 @@
+"""
+PLP features like HCopy's, computed with NumPy.
+
+Reads the HCopy configs in model/<sr>/config (PLP_0_D_A_Z: 25 ms Hamming
+window every 10 ms, pre-emphasis, 20 mel channels, LPC order 12) and
+follows HTK's front end step for step: per-frame zero mean,
+pre-emphasis, Hamming window, FFT power spectrum, triangular mel filter
+bank, equal-loudness curve and cube-root compression, inverse DFT to
+autocorrelation, Durbin recursion, LPC to cepstrum, liftering, c0 from
+the prediction error, mean removal (_Z) and regression deltas and
+accelerations. Frames are processed in blocks of matrix operations.
+
+Features are written as uncompressed HTK parameter files, which HVite
+reads like HCopy's compressed ones, or returned as arrays. The aligner
+still runs HCopy: this isn't used in its place until test/test_plp.py
+has checked it against HCopy's features.
+
+Usage: PLP.from_config("model/11025/config").wav_features("a.wav")
+       create_plp("model/11025/config", "tmp/a_wav_codetr.scp")  # like running HCopy
+Command line: python -m p2fa_vislab.plp config wavfile reference.plp
+              compares our features for wavfile with HCopy's
+"""
+
+import math
+import struct
+import sys
+import wave
+
+import numpy as np
+
+# HTK parameter kinds and qualifiers
+PLP_KIND = 11
+QUALIFIERS = {"E": 0o100, "N": 0o200, "D": 0o400, "A": 0o1000, "C": 0o2000, "Z": 0o4000, "K": 0o10000,
+              "0": 0o20000}
+BASE_MASK = 0o77
+
+BLOCK_FRAMES = 4096
+
+_extractors = {}
+
+
+def read_config(path):
+    """HTK config file as a dict of upper-case names to values"""
+    config = {}
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if '=' not in line:
+                continue
+            name, value = [s.strip() for s in line.split('=', 1)]
+            name = name.split(':')[-1].strip().upper()
+            if value in ('T', 'TRUE'):
+                value = True
+            elif value in ('F', 'FALSE'):
+                value = False
+            else:
+                try:
+                    value = float(value)
+                except ValueError:
+                    pass
+            config[name] = value
+    return config
+
+
+def parm_kind(target_kind):
+    parts = target_kind.upper().split('_')
+    if parts[0] != "PLP":
+        raise ValueError("only PLP features are supported, not %s" % target_kind)
+    kind = PLP_KIND
+    for q in parts[1:]:
+        kind |= QUALIFIERS[q]
+    return kind
+
+
+def regression(x, window):
+    # HTK's delta formula, repeating the first and last frames at the ends
+    if len(x) == 0:
+        return x.copy()
+    padded = np.concatenate([np.repeat(x[:1], window, axis=0), x, np.repeat(x[-1:], window, axis=0)])
+    n = len(x)
+    out = np.zeros_like(x)
+    for t in range(1, window + 1):
+        out += t * (padded[window + t:window + t + n] - padded[window - t:window - t + n])
+    return out / (2.0 * sum(t * t for t in range(1, window + 1)))
+
+
+class PLP(object):
+    def __init__(self, config):
+        self.config = config
+        self.target_kind = config.get("TARGETKIND", "PLP_0_D_A_Z")
+        self.kind = parm_kind(self.target_kind)
+        if self.kind & (QUALIFIERS["E"] | QUALIFIERS["N"]):
+            raise ValueError("energy qualifiers are not supported: %s" % self.target_kind)
+        if config.get("LOFREQ", -1) >= 0 or config.get("HIFREQ", -1) >= 0:
+            raise ValueError("LOFREQ/HIFREQ are not supported")
+
+        self.source_rate = float(config["SOURCERATE"])       # sample period, 100 ns units
+        self.target_rate = float(config.get("TARGETRATE", 100000.0))
+        self.frame_size = int(config.get("WINDOWSIZE", 256000.0) / self.source_rate)
+        self.frame_rate = int(self.target_rate / self.source_rate)
+        self.zmean = config.get("ZMEANSOURCE", False)
+        self.hamming = config.get("USEHAMMING", True)
+        self.preemph = float(config.get("PREEMCOEF", 0.97))
+        self.num_chans = int(config.get("NUMCHANS", 20))
+        self.lpc_order = int(config.get("LPCORDER", 12))
+        self.num_ceps = int(config.get("NUMCEPS", 12))
+        self.lifter = int(config.get("CEPLIFTER", 22))
+        self.compress = float(config.get("COMPRESSFACT", 0.33))
+        self.use_power = config.get("USEPOWER", False)
+        self.delta_window = int(config.get("DELTAWINDOW", 2))
+        self.acc_window = int(config.get("ACCWINDOW", 2))
+        if self.num_ceps > self.lpc_order:
+            raise ValueError("NUMCEPS must not be more than LPCORDER")
+
+        self.fft_n = 2
+        while self.fft_n < self.frame_size:
+            self.fft_n *= 2
+        self._init_fbank()
+        self._init_plp()
+
+        n = np.arange(self.frame_size)
+        self.window = 0.54 - 0.46 * np.cos(2 * np.pi * n / (self.frame_size - 1))
+        i = np.arange(1, self.num_ceps + 1)
+        self.lifter_weights = 1.0 + self.lifter / 2.0 * np.sin(np.pi * i / self.lifter) if self.lifter > 0 \
+            else np.ones(self.num_ceps)
+
+    @classmethod
+    def from_config(cls, path):
+        if path not in _extractors:
+            _extractors[path] = cls(read_config(path))
+        return _extractors[path]
+
+    @property
+    def sample_rate(self):
+        return 1e7 / self.source_rate
+
+    def _init_fbank(self):
+        # mel filter bank as in HTK's InitFBank: channel centres evenly spaced in
+        # mel from 0 to the Nyquist frequency, FFT bins 1 .. fft_n/2 - 1
+        nby2 = self.fft_n // 2
+        fres = 1.0e7 / (self.source_rate * self.fft_n * 700.0)
+
+        def mel(k):
+            return 1127.0 * np.log(1.0 + (k - 1.0) * fres)
+
+        max_chan = self.num_chans + 1
+        mlo, mhi = 0.0, mel(nby2 + 1)
+        self.centres = np.array([0.0] + [float(c) / max_chan * (mhi - mlo) + mlo for c in range(1, max_chan + 1)])
+
+        klo, khi = 2, nby2
+        weights = np.zeros((nby2 + 1, self.num_chans + 2))
+        for k in range(klo, khi + 1):
+            melk = mel(k)
+            chan = 1
+            while chan <= max_chan and self.centres[chan] < melk:
+                chan += 1
+            chan -= 1
+            if chan > 0:
+                lo_wt = (self.centres[chan + 1] - melk) / (self.centres[chan + 1] - self.centres[chan])
+            else:
+                lo_wt = (self.centres[1] - melk) / (self.centres[1] - mlo)
+            weights[k, chan] += lo_wt
+            weights[k, chan + 1] += 1.0 - lo_wt
+        # HTK's bin k is the FFT's k - 1
+        self.fbank = weights[1:nby2 + 1, 1:self.num_chans + 1]
+
+    def _init_plp(self):
+        # equal-loudness curve at the channel centres and cosines for the IDFT (InitPLP)
+        f = 700.0 * (np.exp(self.centres[1:self.num_chans + 1] / 1127.0) - 1.0)
+        fsq = f * f
+        fsub = fsq / (fsq + 1.6e5)
+        self.eql = fsub * fsub * ((fsq + 1.44e6) / (fsq + 9.61e6))
+
+        n_auto = self.lpc_order + 1
+        n_freq = self.num_chans + 2
+        angle = np.pi / (n_freq - 1)
+        i = np.arange(n_auto)[:, None]
+        j = np.arange(n_freq)[None, :]
+        cm = 2.0 * np.cos(angle * i * j)
+        cm[:, 0] = 1.0
+        cm[:, -1] = np.cos(angle * np.arange(n_auto) * (n_freq - 1))
+        self.idft = cm.T / (2.0 * (n_freq - 1))
+
+    def n_frames(self, n_samples):
+        if n_samples < self.frame_size:
+            return 0
+        return (n_samples - self.frame_size) // self.frame_rate + 1
+
+    def static(self, frames):
+        """Cepstra c1..cN and c0 of a block of (frames, frame_size) samples"""
+        s = np.array(frames, dtype=np.float64)
+        if self.zmean:
+            s -= s.mean(axis=1, keepdims=True)
+        s[:, 1:] -= self.preemph * s[:, :-1].copy()
+        s[:, 0] *= 1.0 - self.preemph
+        if self.hamming:
+            s *= self.window
+
+        spec = np.fft.rfft(s, n=self.fft_n, axis=1)[:, :self.fft_n // 2]
+        ek = spec.real ** 2 + spec.imag ** 2
+        if not self.use_power:
+            ek = np.sqrt(ek)
+        fbank = np.maximum(ek @ self.fbank, 1.0)
+
+        aspec = (fbank * self.eql) ** self.compress
+        aspec = np.concatenate([aspec[:, :1], aspec, aspec[:, -1:]], axis=1)
+        r = aspec @ self.idft
+
+        # Durbin recursion, all frames at once
+        p = self.lpc_order
+        a = np.zeros((len(r), p + 1))
+        E = r[:, 0].copy()
+        for i in range(1, p + 1):
+            ki = (r[:, i] + np.einsum('fj,fj->f', a[:, 1:i], r[:, i - 1:0:-1])) / E
+            E *= 1.0 - ki * ki
+            new = a.copy()
+            new[:, i] = -ki
+            new[:, 1:i] = a[:, 1:i] - ki[:, None] * a[:, i - 1:0:-1]
+            a = new
+
+        c = np.zeros((len(r), self.num_ceps + 1))
+        for n in range(1, self.num_ceps + 1):
+            acc = np.zeros(len(r))
+            for i in range(1, n):
+                acc += (n - i) * a[:, i] * c[:, n - i]
+            c[:, n] = -(a[:, n] + acc / n)
+        c[:, 1:] *= self.lifter_weights
+        c[:, 0] = np.log(E)
+        return np.concatenate([c[:, 1:], c[:, :1]], axis=1)
+
+    def features(self, samples):
+        """Feature vectors (frames, dims) for samples at the config's rate, scaled like 16-bit integers"""
+        samples = np.asarray(samples, dtype=np.float64)
+        n = self.n_frames(len(samples))
+        dims = self.num_ceps + (1 if self.kind & QUALIFIERS["0"] else 0)
+        if n == 0:
+            static = np.zeros((0, dims))
+        else:
+            frames = np.lib.stride_tricks.sliding_window_view(samples, self.frame_size)[::self.frame_rate][:n]
+            static = np.concatenate([self.static(frames[i:i + BLOCK_FRAMES])
+                                     for i in range(0, n, BLOCK_FRAMES)])
+            static = static[:, :dims]
+        if self.kind & QUALIFIERS["Z"] and len(static) > 0:
+            # HTK removes the mean of the cepstra but not of c0
+            static[:, :self.num_ceps] -= static[:, :self.num_ceps].mean(axis=0)
+
+        parts = [static]
+        if self.kind & QUALIFIERS["D"]:
+            parts.append(regression(static, self.delta_window))
+            if self.kind & QUALIFIERS["A"]:
+                parts.append(regression(parts[-1], self.acc_window))
+        return np.concatenate(parts, axis=1).astype(np.float32)
+
+    def wav_features(self, wavfile):
+        f = wave.open(wavfile, 'r')
+        SR = f.getframerate()
+        channels = f.getnchannels()
+        sampwidth = f.getsampwidth()
+        data = f.readframes(f.getnframes())
+        f.close()
+
+        if abs(1e7 / SR - self.source_rate) > 0.01:
+            raise ValueError("%s is %d Hz, the config is for %g Hz" % (wavfile, SR, self.sample_rate))
+        if channels != 1 or sampwidth != 2:
+            raise ValueError("%s must be 16 bit and mono" % wavfile)
+        return self.features(np.frombuffer(data, dtype='<i2'))
+
+    def write(self, path, feats):
+        write_htk(path, feats, int(round(self.target_rate)), self.kind)
+
+
+def write_htk(path, feats, samp_period, kind):
+    # uncompressed, big-endian HTK parameter file
+    feats = np.asarray(feats, dtype='>f4')
+    with open(path, 'wb') as f:
+        f.write(struct.pack('>iihh', feats.shape[0], samp_period, 4 * feats.shape[1], kind & ~QUALIFIERS["C"]
+                            & ~QUALIFIERS["K"]))
+        f.write(feats.tobytes())
+
+
+def read_htk(path):
+    """(features, sample period, parameter kind) of an HTK parameter file, compressed or not"""
+    with open(path, 'rb') as f:
+        data = f.read()
+    n, samp_period, samp_size, kind = struct.unpack('>iihh', data[:12])
+    body = data[12:]
+    if kind & QUALIFIERS["C"]:
+        dims = samp_size // 2
+        A = np.frombuffer(body[:4 * dims], dtype='>f4').astype(np.float64)
+        B = np.frombuffer(body[4 * dims:8 * dims], dtype='>f4').astype(np.float64)
+        n -= 4
+        x = np.frombuffer(body[8 * dims:8 * dims + 2 * n * dims], dtype='>i2').reshape(n, dims)
+        feats = (x + B) / A
+    else:
+        dims = samp_size // 4
+        feats = np.frombuffer(body[:4 * n * dims], dtype='>f4').reshape(n, dims).astype(np.float64)
+    return feats, samp_period, kind & ~QUALIFIERS["C"] & ~QUALIFIERS["K"]
+
+
+def create_plp(hcopy_config, scpfile):
+    """Do what HCopy -C hcopy_config -S scpfile does: write the .plp file of each "wav plp" line"""
+    extractor = PLP.from_config(hcopy_config)
+    with open(scpfile, 'r') as f:
+        pairs = [line.split() for line in f if line.strip() != ""]
+    for wavfile, plpfile in pairs:
+        extractor.write(plpfile, extractor.wav_features(wavfile))
+
+
+def compare(hcopy_config, wavfile, reference):
+    """Largest difference between our features for wavfile and HCopy's in reference,
+    per dimension, relative to the spread of each dimension in the reference"""
+    ours = PLP.from_config(hcopy_config).wav_features(wavfile).astype(np.float64)
+    theirs, samp_period, kind = read_htk(reference)
+    if ours.shape != theirs.shape:
+        raise ValueError("shapes differ: %s vs reference %s" % (ours.shape, theirs.shape))
+    spread = np.maximum(theirs.std(axis=0), 1e-6)
+    return np.abs(ours - theirs).max(axis=0) / spread
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 4:
+        print(__doc__)
+        sys.exit(2)
+    diffs = compare(*sys.argv[1:])
+    print("max difference / std per dimension:")
+    print(" ".join("%.4f" % d for d in diffs))
+    # HCopy's compressed files are only good to about 1/32767 of the range
+    sys.exit(0 if math.isfinite(diffs.max()) and diffs.max() < 0.01 else 1)
@@ -8,26 +8,174 @@ Usage: create a pronounce object, add words to pronounce object
        
 Command line: python pronunciation.py list of words to pronounce
 
+Cache misses are sent to the lextool in chunks of Pronounce.chunk_size words,
+a few chunks at a time, over one pooled HTTP session, retrying failed
+requests. P2FA_LEXTOOL_URL points Pronounce at another server, such as the
+local stand-in in lextool_stub.py.
+
+Results are remembered in a persistent sqlite cache (see PronunciationCache),
+so a word only goes to the web service the first time it is seen. Set
+P2FA_PRONUNCIATION_CACHE to move the cache file and P2FA_OFFLINE=1 to never
+touch the network.
+
+Words the lextool can't be asked about (offline, or the request failed),
+or that its reply leaves out, are pronounced by the local G2P engine in
+g2p.py instead, unless fallback=False or P2FA_G2P_FALLBACK=0, in which
+case a LookupError or the request error is raised (prep_mlf raises a
+LookupError naming the words left out).
+
 Copyright 2013 - Steven Rubin - srubin@cs.berkeley.edu
 MIT License
 """
 
 import requests
 import sys
+import os
 import re
+import sqlite3
 import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import metrics
+
+
+class PronunciationCache(object):
+    """
+    On-disk cache of lextool results keyed by (normalized word, stress mode),
+    with least-recently-used eviction once it holds more than max_entries words.
+    """
+    default_path = os.path.join(os.path.expanduser("~"), ".cache", "p2fa", "pronunciations.sqlite")
+
+    def __init__(self, path=None, max_entries=200000):
+        if path is None:
+            path = os.environ.get("P2FA_PRONUNCIATION_CACHE", PronunciationCache.default_path)
+        if path != ":memory:" and not os.path.exists(os.path.dirname(os.path.abspath(path))):
+            os.makedirs(os.path.dirname(os.path.abspath(path)))
+
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        # one connection shared by the threads using the cache (e.g. the server's
+        # workers), used by one of them at a time, as are the counters
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS pronunciations ("
+                            "word TEXT NOT NULL, stress INTEGER NOT NULL, prs TEXT NOT NULL, "
+                            "last_used REAL NOT NULL, PRIMARY KEY (word, stress))")
+            self.db.execute("CREATE INDEX IF NOT EXISTS pronunciations_last_used "
+                            "ON pronunciations (last_used)")
+
+    def get_many(self, words, add_fake_stress):
+        """Return {word: [pronunciation, ...]} for the cached words; the rest count as misses"""
+        stress = int(bool(add_fake_stress))
+        found = {}
+        with self.lock:
+            for word in set(words):
+                row = self.db.execute("SELECT prs FROM pronunciations WHERE word = ? AND stress = ?",
+                                      (word, stress)).fetchone()
+                if row is not None:
+                    found[word] = row[0].split("\t")
+            self.hits += len(found)
+            self.misses += len(set(words)) - len(found)
+
+            if len(found) > 0:
+                now = time.time()
+                with self.db:
+                    self.db.executemany("UPDATE pronunciations SET last_used = ? WHERE word = ? AND stress = ?",
+                                        [(now, w, stress) for w in found])
+        metrics.count("pronunciation_cache_hits", len(found))
+        metrics.count("pronunciation_cache_misses", len(set(words)) - len(found))
+        return found
+
+    def put_many(self, prs, add_fake_stress):
+        stress = int(bool(add_fake_stress))
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO pronunciations VALUES (?, ?, ?, ?)",
+                                [(w, stress, "\t".join(p), now) for w, p in prs.items()])
+            self.evict()
+
+    def evict(self):
+        with self.lock:
+            count = self.db.execute("SELECT COUNT(*) FROM pronunciations").fetchone()[0]
+            if count > self.max_entries:
+                self.db.execute("DELETE FROM pronunciations WHERE rowid IN "
+                                "(SELECT rowid FROM pronunciations ORDER BY last_used LIMIT ?)",
+                                (count - self.max_entries,))
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM pronunciations").fetchone()[0]
+
+    def stats(self):
+        with self.lock:
+            hits, misses = self.hits, self.misses
+            entries = len(self)
+        total = hits + misses
+        return {"hits": hits, "misses": misses, "entries": entries,
+                "hit_rate": float(hits) / total if total else 0.0}
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def default_cache():
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = PronunciationCache()
+    return _default_cache
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def session():
+    """One pooled HTTP session shared by every Pronounce in the process"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+    return _session
+
 
 class Pronounce(object):
     url = "http://www.speech.cs.cmu.edu/cgi-bin/tools/logios/lextool.pl"
+    chunk_size = 500
+    concurrency = 4
+    retries = 3
+    timeout = 60
     dict_re = re.compile(r"http://.*\d+\.dict")
     other_pr = re.compile(r"(.*)\(\d+\)$")
     vowel_re = re.compile(r"AA|AE|AH|AO|AW|AY|EH|ER|EY|IH|IY|OW|OY|UH|UW")
 
-    def __init__(self, words=None):
+    def __init__(self, words=None, cache=None, offline=None, fallback=None):
         if words:
             self.words = words
         else:
             self.words = []
+        # cache=None uses the shared default cache, cache=False disables caching
+        if cache is None:
+            cache = default_cache()
+        elif cache is False:
+            cache = None
+        self.cache = cache
+        if offline is None:
+            offline = os.environ.get("P2FA_OFFLINE", "") not in ("", "0")
+        self.offline = offline
+        if fallback is None:
+            fallback = os.environ.get("P2FA_G2P_FALLBACK", "1") not in ("", "0")
+        self.fallback = fallback
 
     def add(self, word):
         self.words.append(word)
@@ -38,17 +186,86 @@ class Pronounce(object):
         punc_map = dict((ord(c), None) for c in string.punctuation)
         w_nopunc = [s.translate(punc_map) for s in w_upper]
 
-        wordfile = {'wordfile': ('words.txt', " ".join(w_nopunc))}
+        cached = {}
+        if self.cache is not None:
+            cached = self.cache.get_many(w_nopunc, add_fake_stress)
+        missing = sorted(set(w for w in w_nopunc if w not in cached))
 
-        res = requests.post(Pronounce.url,
-                            data={"formtype": "simple"},
-                            files=wordfile, allow_redirects=True)
-        base_url = res.url
+        if len(missing) > 0:
+            fetched = None
+            if not self.offline:
+                try:
+                    fetched = self.lextool(missing, add_fake_stress)
+                except (requests.RequestException, AttributeError):
+                    if not self.fallback:
+                        raise
+            if fetched is not None:
+                if self.cache is not None:
+                    self.cache.put_many(fetched, add_fake_stress)
+                # words the lextool's reply left out are guessed like the rest
+                left = [w for w in missing if w not in fetched]
+                if len(left) > 0 and self.fallback:
+                    fetched.update(self.g2p(left, add_fake_stress))
+            elif self.fallback:
+                # guesses aren't cached, so the lextool is asked again when it's reachable
+                fetched = self.g2p(missing, add_fake_stress)
+            else:
+                raise LookupError("No cached pronunciation (offline mode) for: " + " ".join(missing))
+            cached.update(fetched)
+
+        # generate output dict
+        pronunciations = {}
+        for idx, w in enumerate(w_nopunc):
+            if w not in cached:
+                continue
+            orig = self.words[idx]
+            if orig in pronunciations:
+                continue
+            pronunciations[orig] = [w_upper[idx]] + cached[w]
+
+        return pronunciations
+
+    def g2p(self, words, add_fake_stress=False):
+        from .g2p import LocalPronounce
+        prs = LocalPronounce(words).p(add_fake_stress=add_fake_stress)
+        return dict((w, prs[w][1:]) for w in words)
+
+    def lextool(self, words, add_fake_stress=False):
+        """Ask the CMU lextool for words (already upper-case without punctuation)"""
+        chunks = [words[i:i + Pronounce.chunk_size] for i in range(0, len(words), Pronounce.chunk_size)]
+        if len(chunks) == 1:
+            return self.lextool_chunk(chunks[0], add_fake_stress)
+
+        pronunciations = {}
+        with ThreadPoolExecutor(max_workers=Pronounce.concurrency) as pool:
+            for prs in pool.map(lambda c: self.lextool_chunk(c, add_fake_stress), chunks):
+                pronunciations.update(prs)
+        return pronunciations
+
+    def lextool_chunk(self, words, add_fake_stress=False):
+        for attempt in range(Pronounce.retries):
+            try:
+                return self.lextool_request(words, add_fake_stress)
+            except (requests.RequestException, AttributeError):
+                # AttributeError: the response had no link to a .dict file
+                if attempt == Pronounce.retries - 1:
+                    raise
+                time.sleep(0.5 * 2 ** attempt)
+
+    def lextool_request(self, words, add_fake_stress=False):
+        wordfile = {'wordfile': ('words.txt', " ".join(words))}
+        url = os.environ.get("P2FA_LEXTOOL_URL", Pronounce.url)
+
+        res = session().post(url,
+                             data={"formtype": "simple"},
+                             files=wordfile, allow_redirects=True,
+                             timeout=Pronounce.timeout)
+        res.raise_for_status()
         text = res.text
         dict_path = Pronounce.dict_re.search(text).group(0)
-        res = requests.get(dict_path)
+        res = session().get(dict_path, timeout=Pronounce.timeout)
+        res.raise_for_status()
         
-        # generate output dict
         pronunciations = {}
         for line in res.text.split('\n'):
             if len(line) > 0:
@@ -56,17 +273,14 @@ class Pronounce(object):
                 match = Pronounce.other_pr.match(pr[0])
                 if match:
                     pr[0] = match.group(1)
-                idx = w_nopunc.index(pr[0])
-                orig = self.words[idx]
-                upword = w_upper[idx]
                 
                 if add_fake_stress:
                     pr[1] = re.sub(Pronounce.vowel_re, r"\g<0>0", pr[1])
                 
-                if orig in pronunciations:
-                    pronunciations[orig].append(pr[1])
+                if pr[0] in pronunciations:
+                    pronunciations[pr[0]].append(pr[1])
                 else:
-                    pronunciations[orig] = [upword, pr[1]]
+                    pronunciations[pr[0]] = [pr[1]]
 
         return pronunciations
 
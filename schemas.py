@@ -0,0 +1,61 @@
+"""
+The transcript and alignment schemas from the alignment-schemas submodule.
+
+jsonschema, the schema files and the compiled validators are loaded on
+first use and kept for the life of the process, so importing the aligner
+costs none of it and a missing submodule only matters when something is
+actually validated.
+
+Usage: validate("transcript", dialog)             # raises jsonschema.ValidationError
+       error = first_error("word", word)          # None if word is valid
+"""
+
+import os
+
+try:
+    import simplejson as json
+except:
+    import json
+
+SCHEMA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "alignment-schemas")
+SCHEMA_FILES = {"transcript": "transcript_schema.json", "alignment": "alignment_schema.json"}
+
+_schemas = {}
+_validators = {}
+
+
+class SchemaMissing(IOError):
+    pass
+
+
+def load_schema(name):
+    """The schema called name: transcript, alignment, or word (an item of an alignment's words)"""
+    if name not in _schemas:
+        if name == "word":
+            _schemas[name] = load_schema("alignment")["properties"]["words"]["items"]
+        else:
+            path = os.path.join(SCHEMA_DIR, SCHEMA_FILES[name])
+            try:
+                with open(path, 'r') as f:
+                    _schemas[name] = json.load(f)
+            except (IOError, OSError) as e:
+                raise SchemaMissing("Can't read %s (%s); run git submodule update --init to get "
+                                    "alignment-schemas" % (path, e))
+    return _schemas[name]
+
+
+def validator(name):
+    if name not in _validators:
+        import jsonschema
+        # a word is checked by the rules of the draft of the alignment schema
+        root = load_schema("alignment" if name == "word" else name)
+        _validators[name] = jsonschema.validators.validator_for(root)(load_schema(name))
+    return _validators[name]
+
+
+def validate(name, instance):
+    validator(name).validate(instance)
+
+
+def first_error(name, instance):
+    return next(iter(validator(name).iter_errors(instance)), None)
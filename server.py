@@ -0,0 +1,380 @@
+"""
+A long-running alignment server that keeps everything warm.
+
+Starting an alignment from scratch costs a Python start, the dictionary
+index, the inflect engine, the schemas and, with the native decoder, the
+models. The server loads all of that once (warm_up) and
+then runs jobs from a bounded queue on a pool of worker threads, each in
+a scratch directory of its own. When the queue is full a new job is
+refused with 503 and a Retry-After header, so clients back off instead
+of piling up work.
+
+HTTP API (over TCP, or over a Unix socket with --socket):
+
+  POST   /jobs              {"type": "align", "wavfile": ..., "trsfile": ..., "outfile": ..., other
+                            do_alignment options} or {"type": "breaths", "wavfile": ...,
+                            "alignment_file": ..., "out_alignment_file": ...}
+                            -> 202 {"id": ..., "status": "queued"}
+  GET    /jobs/<id>         the job's status: queued, running, done or error (with the error)
+  GET    /jobs/<id>/result  the alignment as JSON once the job is done (409 before)
+  DELETE /jobs/<id>         forget a finished job, or cancel a queued one
+  GET    /status            queue length, workers and job counts
+
+Finished jobs are kept (most recent keep_jobs of them) until deleted.
+
+A job's result comes back from /jobs/<id>/result. Files are only written
+when the server is given an output_root (--output-root): outfile and
+out_alignment_file are then paths relative to it, and a path that is
+absolute or would leave it (through .. or a link) is refused with 400.
+
+Command line: python -m p2fa_vislab.align serve [--port 8765 | --socket path] [--workers 4]
+              (or python -m p2fa_vislab.server ...)
+"""
+
+import os
+import queue
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+try:
+    import simplejson as json
+except:
+    import json
+
+from . import align, features, numerals, pronunciation, schemas
+from .dictionary import load_dictionary
+
+JOB_TYPES = ("align", "breaths")
+
+# do_alignment options a client may set
+ALIGN_OPTIONS = ("json", "textgrid", "phonemes", "prune_dict", "wave_start", "wave_end", "beams", "formats",
+                 "validate", "timeout")
+
+
+def output_path(output_root, path):
+    # where under output_root a job may write path, or ValueError
+    if output_root is None:
+        raise ValueError("this server writes no files (see --output-root); get the result from /jobs/<id>/result")
+    if not isinstance(path, str) or path == "" or os.path.isabs(path) or ".." in path.replace("\\", "/").split("/"):
+        raise ValueError("output paths must be relative to the output root: %r" % (path,))
+    root = os.path.realpath(output_root)
+    full = os.path.realpath(os.path.join(root, path))
+    if os.path.commonpath([root, full]) != root:
+        raise ValueError("output path leaves the output root: %r" % (path,))
+    return full
+
+
+class Job(object):
+    def __init__(self, kind, params):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.params = params
+        self.status = "queued"
+        self.error = None
+        self.traceback = None
+        self.result = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+
+    def info(self):
+        return {"id": self.id, "type": self.kind, "status": self.status, "error": self.error,
+                "submitted": self.submitted, "started": self.started, "finished": self.finished}
+
+
+def warm_up():
+    # load everything alignments share, once per process; what can't be
+    # loaded (e.g. models not in the tree) is just loaded on first use
+    loaded = {}
+    steps = [("dictionary", lambda: load_dictionary(align.MODEL_DIR)),
+             ("schemas", lambda: (schemas.validator("transcript"), schemas.validator("word"))),
+             ("pronunciation cache", pronunciation.default_cache),
+             ("feature cache", features.default_feature_cache),
+             ("number pronouncer", numerals.engine)]
+    for SR in align.SR_MODELS:
+        hmmdir = os.path.join(align.MODEL_DIR, str(SR))
+        if align.DECODER == "native":
+            steps.append(("models %d" % SR, lambda h = hmmdir: align.decoder.Decoder.load(
+                h, align.phoneset_file(align.MODEL_DIR))))
+
+    for name, step in steps:
+        start = time.time()
+        try:
+            step()
+            loaded[name] = round(time.time() - start, 3)
+        except Exception as e:
+            loaded[name] = "%s: %s" % (type(e).__name__, e)
+    return loaded
+
+
+class AlignmentService(object):
+    def __init__(self, workers = 4, queue_size = 64, work_root = None, keep_jobs = 1000, output_root = None):
+        self.workers = workers
+        self.output_root = output_root
+        self.queue = queue.Queue(maxsize = queue_size)
+        self.made_root = work_root is None
+        self.work_root = work_root if work_root is not None else tempfile.mkdtemp(prefix = "p2fa-serve-")
+        self.keep_jobs = keep_jobs
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.warm = {}
+
+    def start(self):
+        self.warm = warm_up()
+        for i in range(self.workers):
+            t = threading.Thread(target = self._worker, name = "p2fa-worker-%d" % i, daemon = True)
+            t.start()
+            self.threads.append(t)
+
+    def stop(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        if self.made_root:
+            shutil.rmtree(self.work_root, ignore_errors = True)
+
+    def submit(self, kind, params):
+        """The queued Job, or None when the queue is full"""
+        if kind not in JOB_TYPES:
+            raise ValueError("unknown job type: %r" % kind)
+        required = ("wavfile", "trsfile") if kind == "align" else ("wavfile", "alignment_file")
+        missing = [k for k in required if k not in params]
+        if missing:
+            raise ValueError("missing %s" % ", ".join(missing))
+        if kind == "align":
+            unknown = set(params) - set(required) - set(ALIGN_OPTIONS) - {"outfile"}
+        else:
+            unknown = set(params) - set(required) - {"out_alignment_file"}
+        if unknown:
+            raise ValueError("unknown options: %s" % ", ".join(sorted(unknown)))
+        params = dict(params)
+        for key in ("outfile", "out_alignment_file"):
+            if params.get(key) is not None:
+                params[key] = output_path(self.output_root, params[key])
+
+        job = Job(kind, params)
+        with self.lock:
+            try:
+                self.queue.put_nowait(job)
+            except queue.Full:
+                return None
+            self.jobs[job.id] = job
+            self._forget_old()
+        return job
+
+    def get(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def delete(self, job_id):
+        """True if the job was forgotten (a queued job is cancelled); False if it is running"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.status == "running":
+                return False
+            if job.status == "queued":
+                job.status = "cancelled"
+            del self.jobs[job_id]
+            return True
+
+    def status(self):
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job.status] = counts.get(job.status, 0) + 1
+        return {"workers": self.workers, "queued": self.queue.qsize(), "queue_size": self.queue.maxsize,
+                "jobs": counts, "warm": self.warm}
+
+    def _forget_old(self):
+        # the oldest finished jobs go once there are more than keep_jobs
+        finished = [j.id for j in self.jobs.values() if j.status in ("done", "error")]
+        for job_id in finished[:max(len(self.jobs) - self.keep_jobs, 0)]:
+            del self.jobs[job_id]
+
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            # (under the lock, so a DELETE either cancels the job first or sees it running)
+            with self.lock:
+                if job.status == "cancelled":
+                    continue
+                job.status = "running"
+                job.started = time.time()
+            work_dir = os.path.join(self.work_root, job.id)
+            try:
+                job.result = self._run(job, work_dir)
+                job.status = "done"
+            except Exception as e:
+                job.error = "%s: %s" % (type(e).__name__, e)
+                job.traceback = traceback.format_exc()
+                job.status = "error"
+            finally:
+                job.finished = time.time()
+                shutil.rmtree(work_dir, ignore_errors = True)
+
+    def _run(self, job, work_dir):
+        params = dict(job.params)
+        if job.kind == "align":
+            options = dict((k, params[k]) for k in ALIGN_OPTIONS if k in params)
+            if isinstance(options.get("beams"), str):
+                options["beams"] = align.parse_beams(options["beams"])
+            if params.get("outfile") is not None:
+                os.makedirs(os.path.dirname(params["outfile"]), exist_ok = True)
+            alignment = align.do_alignment(params["wavfile"], params["trsfile"], params.get("outfile"),
+                                           work_dir = work_dir, **options)
+            return alignment.to_dict(phonemes = options.get("phonemes", False))
+
+        from .detect_breaths import alignment_with_breaths
+        out = params.get("out_alignment_file") or os.path.join(work_dir, "breaths.json")
+        os.makedirs(work_dir, exist_ok = True)
+        os.makedirs(os.path.dirname(out), exist_ok = True)
+        alignment_with_breaths(params["wavfile"], params["alignment_file"], out, work_dir = work_dir)
+        with open(out, 'r') as f:
+            return json.load(f)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # the service is set on the server
+    def _send(self, code, body, headers = None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _job(self):
+        # (job, rest of the path) for /jobs/<id>[/...], or (None, None)
+        parts = self.path.strip("/").split("/")
+        if len(parts) < 2 or parts[0] != "jobs":
+            return None, None
+        return self.server.service.get(parts[1]), "/".join(parts[2:])
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/status":
+            return self._send(200, self.server.service.status())
+        job, rest = self._job()
+        if job is None:
+            return self._send(404, {"error": "no such job"})
+        if rest == "":
+            return self._send(200, job.info())
+        if rest == "result":
+            if job.status != "done":
+                return self._send(409, job.info())
+            return self._send(200, job.result)
+        self._send(404, {"error": "not found"})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/jobs":
+            return self._send(404, {"error": "not found"})
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            params = json.loads(self.rfile.read(length).decode("utf-8"))
+            kind = params.pop("type", "align")
+            job = self.server.service.submit(kind, params)
+        except (ValueError, AttributeError, TypeError) as e:
+            return self._send(400, {"error": str(e)})
+        if job is None:
+            return self._send(503, {"error": "queue full"}, {"Retry-After": "1"})
+        self._send(202, job.info(), {"Location": "/jobs/" + job.id})
+
+    def do_DELETE(self):
+        parts = self.path.strip("/").split("/")
+        if len(parts) != 2 or parts[0] != "jobs":
+            return self._send(404, {"error": "not found"})
+        if self.server.service.get(parts[1]) is None:
+            return self._send(404, {"error": "no such job"})
+        if not self.server.service.delete(parts[1]):
+            return self._send(409, {"error": "job is running"})
+        self._send(200, {"id": parts[1], "deleted": True})
+
+    def address_string(self):
+        # a Unix socket has no client address
+        return self.client_address[0] if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, host = "127.0.0.1", port = 8765, socket_path = None, verbose = False):
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, RequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+    server.service = service
+    server.verbose = verbose
+    return server
+
+
+def serve(host = "127.0.0.1", port = 8765, socket_path = None, workers = 4, queue_size = 64, work_root = None,
+          keep_jobs = 1000, verbose = False, output_root = None):
+    service = AlignmentService(workers, queue_size, work_root, keep_jobs, output_root)
+    service.start()
+    print("Warm: %s" % json.dumps(service.warm))
+    server = make_server(service, host, port, socket_path, verbose)
+    print("Serving on %s" % (socket_path if socket_path is not None else "http://%s:%d" % (host, port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.stop()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+
+
+def make_cli():
+    # click is only imported when the command line is used
+    import click
+
+    @click.command()
+    @click.option('--host', default = "127.0.0.1", help = "Address to listen on")
+    @click.option('--port', default = 8765, help = "Port to listen on")
+    @click.option('--socket', 'socket_path', default = None, help = "Listen on this Unix socket instead")
+    @click.option('--workers', default = 4, help = "Alignments run at the same time")
+    @click.option('--queue-size', default = 64, help = "Jobs waiting before new ones are refused")
+    @click.option('--work-root', default = None, help = "Directory for the jobs' scratch directories")
+    @click.option('--keep-jobs', default = 1000, help = "Finished jobs remembered for their results")
+    @click.option('--output-root', default = None,
+                  help = "Directory the jobs' outfiles are written under (none are written without it)")
+    @click.option('--verbose/--quiet', default = False, help = "Log every request")
+    def cli_serve(host, port, socket_path, workers, queue_size, work_root, keep_jobs, output_root, verbose):
+        serve(host, port, socket_path, workers, queue_size, work_root, keep_jobs, verbose, output_root)
+
+    return cli_serve
+
+
+def __getattr__(name):
+    if name == 'cli_serve':
+        return make_cli()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+if __name__ == '__main__':
+    make_cli()()
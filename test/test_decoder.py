@@ -0,0 +1,100 @@
+import math
+import os
+import shutil
+import wave
+
+import numpy as np
+import pytest
+
+from .. import align, decoder, plp
+from ..features import FeatureCache
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# 10 ms frames
+FRAME = 0.01
+# one-dimensional models: sil and sp emit around 0, aa around 10 and bb around 20
+SYNTHETIC_MODEL = os.path.join(HERE, "synthetic_model")
+
+
+def gaussian(mean):
+    return decoder.Gaussians([1.0], [[mean]], [[1.0]], [math.log(2 * math.pi)])
+
+
+def test_band_keeps_states_reached_backwards():
+    # sil's last state can go back to its first, as in HTK's sil model
+    sil = decoder.HMM("sil", [gaussian(0.0), gaussian(10.0), gaussian(20.0)],
+                      [[0, 1.0, 0, 0, 0],
+                       [0, 0.5, 0.5, 0, 0],
+                       [0, 0, 0.5, 0.5, 0],
+                       [0, 0.2, 0, 0.4, 0.4],
+                       [0, 0, 0, 0, 0]])
+    a = decoder.HMM("a", [gaussian(30.0)], [[0, 1.0, 0], [0, 0.5, 0.5], [0, 0, 0]])
+    dec = decoder.Decoder({"sil": sil, "a": a})
+    net = decoder.Network(dec, ["SIL", "A"], {"SIL": [["sil"]], "A": [["a"]]})
+    feats = np.array([[0.0], [10.0], [20.0], [0.0], [10.0], [20.0], [30.0], [30.0]])
+
+    # with a beam tight enough that sil's first state is pruned while in its last
+    path, emit, total = dec.viterbi(net, feats, beam = 50.0)
+    assert path.tolist() == [0, 1, 2, 0, 1, 2, 3, 3]
+    assert path.tolist() == dec.viterbi(net, feats)[0].tolist()
+
+
+@pytest.mark.skipif(not os.path.exists(os.path.join(align.MODEL_DIR, "11025", "hmmdefs")),
+                    reason = "no acoustic models (model/11025/hmmdefs) in the tree")
+@pytest.mark.skipif(not os.path.exists(os.path.join(align.HTK_BIN, "HCopy")), reason = "no HCopy for the features")
+def test_native_alignment_matches_reference(monkeypatch, tmp_path):
+    monkeypatch.setattr(align, "DECODER", "native")
+    trsfile = str(tmp_path / "BREY00538.json")
+    with open(os.path.join(HERE, "BREY00538.txt"), 'r') as f:
+        line = f.read().strip()
+    with open(trsfile, 'w') as f:
+        align.json.dump([{"speaker": "A", "line": line}], f)
+
+    alignment = align.do_alignment(os.path.join(HERE, "BREY00538.wav"), trsfile, None,
+                                   work_dir = str(tmp_path / "work"), feature_cache = False)
+    with open(os.path.join(HERE, "BREY00538.json"), 'r') as f:
+        reference = align.json.load(f)["words"]
+
+    words = [w for w in alignment if not w.is_pause()]
+    assert [w.alignedWord for w in words] == [r["word"] for r in reference]
+    for w, r in zip(words, reference):
+        assert abs(w.start - r["start"]) <= FRAME
+        assert abs(w.end - r["end"]) <= FRAME
+
+
+def test_native_alignment_of_synthetic_models(monkeypatch, tmp_path):
+    # do_alignment end to end with the native decoder, on features whose
+    # segmentation is known (taken from the feature cache instead of HCopy)
+    model_dir = str(tmp_path / "model")
+    shutil.copytree(SYNTHETIC_MODEL, model_dir)
+    monkeypatch.setattr(align, "MODEL_DIR", model_dir)
+    monkeypatch.setattr(align, "DECODER", "native")
+    monkeypatch.chdir(tmp_path)
+
+    segments = [(0.0, 10), (10.0, 6), (20.0, 6), (0.0, 8), (20.0, 5), (10.0, 7), (0.0, 10)]
+    feats = np.concatenate([np.full((n, 1), mean) for mean, n in segments])
+    feats += np.random.RandomState(0).randn(*feats.shape) * 0.1
+    wavfile = str(tmp_path / "a.wav")
+    w = wave.open(wavfile, 'wb')
+    w.setnchannels(1)
+    w.setsampwidth(2)
+    w.setframerate(16000)
+    w.writeframes(b"\0\0" * (len(feats) * 160))
+    w.close()
+    plpfile = str(tmp_path / "a.plp")
+    plp.write_htk(plpfile, feats, 100000, plp.parm_kind("PLP"))
+    trsfile = str(tmp_path / "a.json")
+    with open(trsfile, 'w') as f:
+        align.json.dump([{"speaker": "A", "line": "ab, ba."}], f)
+
+    cache = FeatureCache(str(tmp_path / "cache"))
+    cache.put(cache.key(wavfile, "0.0", None, 16000, os.path.join(model_dir, "16000", "config")), wavfile, plpfile)
+    alignment = align.do_alignment(wavfile, trsfile, None, work_dir = str(tmp_path / "work"), feature_cache = cache)
+    assert cache.hits == 1
+
+    words = [w for w in alignment if not w.is_pause()]
+    assert [w.alignedWord for w in words] == ["AB", "BA"]
+    # readAlignedMLF puts times 12.5 ms later, as for HVite's output
+    assert [(round(w.start - 0.0125, 2), round(w.end - 0.0125, 2)) for w in words] == [(0.1, 0.22), (0.3, 0.42)]
+    assert [[(p.phone, round(p.end - 0.0125, 2)) for p in alignment.word_phones(w.index)] for w in words] == \
+        [[("aa", 0.16), ("bb", 0.22)], [("bb", 0.35), ("aa", 0.42)]]
@@ -0,0 +1,104 @@
+import os
+
+from .. import align, dictionary
+from ..dictionary import DictionaryIndex
+
+DICT = ["HELLO  HH AH0 L OW1",
+        "A  AH0",
+        "HELL  HH EH1 L",
+        "HELLO  HH EH0 L OW1",
+        "sp  sp",
+        "sil  sil",
+        "A  EY1"]
+
+
+def write_lines(path, lines):
+    with open(path, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+    return str(path)
+
+
+def test_pronunciations_keep_their_order(tmp_path):
+    src = write_lines(tmp_path / "dict", DICT)
+    idx = DictionaryIndex.load([src], index_path = str(tmp_path / "dict.idx"))
+
+    assert len(idx) == 5
+    assert idx.get("HELLO") == ["HH AH0 L OW1", "HH EH0 L OW1"]
+    assert idx.get("A") == ["AH0", "EY1"]
+    assert idx.lines("HELL") == ["HELL  HH EH1 L\n"]
+    assert "HELLO" in idx and b"HELLO" in idx
+
+
+def test_no_prefix_matches(tmp_path):
+    src = write_lines(tmp_path / "dict", DICT)
+    idx = DictionaryIndex.load([src], index_path = str(tmp_path / "dict.idx"))
+
+    # HELL's record is a prefix of HELLO's, and HELLO of neither
+    assert "HEL" not in idx
+    assert "HELLOS" not in idx
+    assert idx.get("HEL") is None
+    assert idx.get("HELLOS", []) == []
+    assert idx.lines("H") == []
+
+
+def test_rebuilt_when_a_source_changes(tmp_path):
+    src = write_lines(tmp_path / "dict", DICT)
+    index_path = str(tmp_path / "dict.idx")
+    idx = DictionaryIndex.load([src], index_path = index_path)
+    assert os.path.exists(index_path)
+    assert DictionaryIndex.load([src], index_path = index_path) is idx
+
+    write_lines(src, DICT + ["WORLD  W ER1 L D"])
+    st = os.stat(src)
+    os.utime(src, ns = (st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    idx = DictionaryIndex.load([src], index_path = index_path)
+    assert idx.get("WORLD") == ["W ER1 L D"]
+
+    # and a new process finds the rebuilt index on disk
+    dictionary._loaded.pop(index_path)
+    assert DictionaryIndex.load([src], index_path = index_path).get("WORLD") == ["W ER1 L D"]
+
+
+def test_local_dictionary_is_merged(tmp_path, monkeypatch):
+    model = tmp_path / "model"
+    model.mkdir()
+    write_lines(model / "dict", DICT)
+    monkeypatch.chdir(tmp_path)
+    write_lines(tmp_path / "dict.local", ["HELLO  HH AH1 L OW0", "ZYX  Z IH1 K S"])
+
+    idx = dictionary.load_dictionary(str(model))
+    # the main dictionary's pronunciations come first
+    assert idx.get("HELLO") == ["HH AH0 L OW1", "HH EH0 L OW1", "HH AH1 L OW0"]
+    assert idx.get("ZYX") == ["Z IH1 K S"]
+    assert "ZYX" not in dictionary.load_dictionary(str(model), local_dict = None)
+
+
+def test_htk_dictionaries(tmp_path):
+    src = write_lines(tmp_path / "dict", DICT)
+    idx = DictionaryIndex.load([src], index_path = str(tmp_path / "dict.idx"))
+
+    full = str(tmp_path / "full.dict")
+    idx.write_htk_dict(full, ["HELM  HH EH1 L M\n", "B  B IY1"])
+    with open(full) as f:
+        assert f.read().splitlines() == ["A  AH0", "A  EY1", "B  B IY1", "HELL  HH EH1 L", "HELLO  HH AH0 L OW1",
+                                         "HELLO  HH EH0 L OW1", "HELM  HH EH1 L M", "sil  sil", "sp  sp"]
+
+    pruned = str(tmp_path / "pruned.dict")
+    idx.write_pruned_dict(pruned, ["HELLO", "HELLO", "NOTAWORD"], ["B  B IY1"])
+    with open(pruned) as f:
+        assert f.read().splitlines() == ["B  B IY1", "HELLO  HH AH0 L OW1", "HELLO  HH EH0 L OW1", "sil  sil",
+                                         "sp  sp"]
+
+
+def test_model_dictionary(tmp_path):
+    # indexed in tmp_path, so nothing is written to model/
+    idx = DictionaryIndex.load([os.path.join(align.MODEL_DIR, "dict")], index_path = str(tmp_path / "dict.idx"))
+
+    assert len(idx) > 100000
+    assert idx.get("HELLO") == ["HH AH0 L OW1", "HH EH0 L OW1"]
+    assert idx.get("THE") == ["DH AH0", "DH AH1", "DH IY0"]
+    assert idx.get("RECORD")[0] == "R AH0 K AO1 R D"
+    assert idx.get('"CLOSE-QUOTE') == ["K L OW1 Z K W OW1 T"]
+    for word in ["sp", "{SL}", "{BR}"]:
+        assert word in idx
+    assert "HELLOHELLO" not in idx
@@ -0,0 +1,75 @@
+import csv
+import hashlib
+import json
+import os
+
+import pytest
+
+from .. import align
+from ..export import export_alignment
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ALIGNED_MLF = os.path.join(os.path.dirname(HERE), "examples", "align.mlf")
+# the words of the first file of examples/align.mlf (BI3) as a dialog transcript
+TRANSCRIPT = os.path.join(HERE, "align_BI3.json")
+
+# sha256 of what the aligner wrote for them before the performance work
+# (commit 2937741: its prep_mlf, readAlignedMLF(..., 11025, 0.0), writeJSON
+# and writeTextGrid); the files are several MB each
+EXPECTED = {"json": "60573775f5e0cb56e156085635d480bddc14d6712b314b979a2a6b811b5e4852",
+            "phonemes": "ad35b3f3aa86e708b42ca92a94827a7cd8359cf6f1c92e1bbca513581622f5e8",
+            "textgrid": "d00d506327d50289eda90f4c4b06ca38b06743dfef5d167c5a1aee342d544bff"}
+
+
+def sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+@pytest.fixture(scope = "module")
+def aligned(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp("export")
+    global_map = align.GlobalMap()
+    idx = align.load_dictionary(align.MODEL_DIR, local_dict = None)
+    align.prep_mlf(TRANSCRIPT, str(tmp / "tmp.mlf"), idx, "sp", ["sp"], "BI3", global_map, dialog_file = True,
+                   dict_tmp_file = None)
+    return tmp, global_map, align.readAlignedMLF(ALIGNED_MLF, 11025, 0.0)
+
+
+def test_json_is_unchanged(aligned):
+    tmp, global_map, word_alignments = aligned
+    align.writeJSON(str(tmp / "out.json"), word_alignments, global_map)
+    assert sha256(tmp / "out.json") == EXPECTED["json"]
+    align.writeJSON(str(tmp / "phonemes.json"), word_alignments, global_map, phonemes = True)
+    assert sha256(tmp / "phonemes.json") == EXPECTED["phonemes"]
+
+
+def test_textgrid_is_unchanged(aligned):
+    tmp, global_map, word_alignments = aligned
+    align.writeTextGrid(str(tmp / "out.TextGrid"), word_alignments)
+    assert sha256(tmp / "out.TextGrid") == EXPECTED["textgrid"]
+
+
+def test_formats_in_one_pass(aligned):
+    tmp, global_map, word_alignments = aligned
+    alignment = align.makeAlignment(word_alignments, global_map)
+    outputs = {fmt: str(tmp / ("all." + fmt)) for fmt in ["json", "ndjson", "csv", "textgrid"]}
+    alignment.write(outputs, validate = True)
+
+    assert sha256(outputs["json"]) == EXPECTED["json"]
+    assert sha256(outputs["textgrid"]) == EXPECTED["textgrid"]
+    with open(outputs["json"]) as f:
+        words = json.load(f)["words"]
+    with open(outputs["ndjson"]) as f:
+        assert [json.loads(line) for line in f] == words
+    with open(outputs["csv"], newline = '') as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == len(words)
+    assert [row["alignedWord"] for row in rows] == [w["alignedWord"] for w in words]
+    assert rows[0]["word"] == "ok" and rows[0]["speaker"] == "Speaker 0" and rows[0]["line_idx"] == "0"
+
+
+def test_unknown_format(aligned):
+    tmp, global_map, word_alignments = aligned
+    with pytest.raises(ValueError, match = "unknown output formats: xml"):
+        export_alignment({"xml": str(tmp / "out.xml")}, word_alignments, [])
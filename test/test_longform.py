@@ -0,0 +1,72 @@
+from .. import longform
+
+# 40 entries of 4 words; word j is said 0.5 s after word j - 1 and lasts 0.3 s
+WORDS = ["alpha", "bravo", "charlie", "delta"]
+DIALOG = [{"speaker": "A", "line": " ".join(WORDS)} for _ in range(40)]
+
+
+def true_times(pause_after = None, pause = 0.0):
+    times = []
+    for j in range(len(DIALOG) * len(WORDS)):
+        start = 0.5 * j + (pause if pause_after is not None and j > pause_after else 0.0)
+        times.append((start, start + 0.3))
+    return times
+
+
+def fake_aligner(times, passes):
+    # stands in for run_chunks: a word lands at its true time if that is inside the chunk's
+    # window, otherwise HVite crams it against the edge of the window
+    def run_chunks(wavfile, chunks, work_root, processes, timeout, passname, beams = None):
+        passes.append((passname, len(chunks)))
+        for chunk in chunks:
+            first_word = chunk.line_idx[0] * len(WORDS)
+            lo, hi = chunk.window[0], chunk.window[1] if chunk.window[1] is not None else float("inf")
+            words = []
+            for i, line in enumerate(chunk.lines):
+                for token in line["line"].split():
+                    j = first_word + len(words)
+                    st, en = times[j]
+                    if st < lo:
+                        st, en = lo + 0.001 * len(words), lo + 0.001 * (len(words) + 1)
+                    elif en > hi:
+                        st, en = hi - 0.001 * (100 - len(words)), hi - 0.001 * (99 - len(words))
+                    words.append({"word": token, "alignedWord": token.upper(), "start": round(st, 5),
+                                  "end": round(en, 5), "line_idx": i, "phonemes": [["AH0", st, en]]})
+            chunk.words = words
+            chunk.error = None
+    return run_chunks
+
+
+def align(monkeypatch, times, duration):
+    passes = []
+    monkeypatch.setattr(longform, "run_chunks", fake_aligner(times, passes))
+    pieces, max_chars, chars_per_second = longform.plan_pieces(DIALOG, duration, 10.0)
+    chunks = longform.align_chunks("long.wav", pieces, max_chars, chars_per_second, duration, 3.0, "work", 4, None,
+                                   None)
+    return chunks, passes, longform.stitch(chunks)
+
+
+def test_chunks_in_their_estimated_windows(monkeypatch):
+    times = true_times()
+    chunks, passes, words = align(monkeypatch, times, 80.0)
+
+    # every chunk at once, and none again in order
+    assert passes == [("coarse", len(chunks))]
+    assert len(chunks) > 4
+    assert [(w["start"], w["end"]) for w in words] == [(round(st, 5), round(en, 5)) for st, en in times]
+    assert [w["line_idx"] for w in words] == [j // len(WORDS) for j in range(len(times))]
+    for chunk, nxt in zip(chunks[:-1], chunks[1:]):
+        assert chunk.end == nxt.start
+
+
+def test_chunks_off_their_estimate_are_aligned_in_order(monkeypatch):
+    # a long pause puts the words before it early and the words after it late for the average rate
+    times = true_times(pause_after = 79, pause = 7.0)
+    chunks, passes, words = align(monkeypatch, times, 87.0)
+
+    assert passes[0][0] == "coarse"
+    assert [p for p in passes[1:] if p != ("first_1", 1)] == []
+    assert 0 < len(passes) - 1 < passes[0][1]
+    assert [(w["start"], w["end"]) for w in words] == [(round(st, 5), round(en, 5)) for st, en in times]
+    assert [w["line_idx"] for w in words] == [j // len(WORDS) for j in range(len(times))]
+    assert [c.index for c in chunks] == list(range(len(chunks)))
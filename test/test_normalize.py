@@ -0,0 +1,79 @@
+import re
+
+import pytest
+
+from ..normalize import TranscriptError, iter_words, normalize_line, split_word
+
+LINES = ["Hello, world-wide...",
+         "ok why don't you go ahead and count to ten so i.",
+         "- so , that's it : {laugh} i said \"no\" (really) ! ok",
+         "well--i mean--- it's {br} {cough} fine {lipsmack} &lt;noise&gt;",
+         "wait...what? 'quoted' words; 100% sure",
+         ", the twenty-two something-or-other {laughter}",
+         "   spaced    out\n"]
+
+
+def old_normalize_line(line):
+    # the steps prep_mlf took before normalize.py (commit 2937741)
+    txt = line.replace('\n', '')
+    txt = txt.replace('{br}', '{BR}').replace('&lt;noise&gt;', '{NS}')
+    txt = txt.replace('{laugh}', '{LG}').replace('{laughter}', '{LG}')
+    txt = txt.replace('{cough}', '{CG}').replace('{lipsmack}', '{LS}')
+    for pun in [',', '.', ':', ';', '!', '?', '"', '%', '(', ')', '-', '--', '---']:
+        if txt.startswith(pun + ' '):
+            txt = txt[2:]
+        txt = txt.replace(' ' + pun + ' ', ' ')
+    txt = re.sub(r"(-[-]+[,\.:;!\?\"%\(\)-]*)", r"\1 ", txt)
+    txt = re.sub(r"([A-Za-z])\.\.\.([A-Za-z])", r"\1... \2", txt)
+    with_pun = txt.split()
+    txt = txt.replace('...', '')
+    for pun in [',', '.', ':', ';', '!', '?', '"', '%', '(', ')', '--', '---']:
+        txt = txt.replace(pun, '')
+    txt = re.sub(r"\s+", ' ', txt)
+    txt = re.sub(r"\s'", " ", txt)
+    return with_pun, txt.split()
+
+
+@pytest.mark.parametrize("line", LINES)
+def test_same_as_prep_mlf_did(line):
+    assert normalize_line(line) == old_normalize_line(line)
+
+
+def test_normalize_line():
+    assert normalize_line("Hello, world-wide...") == (["Hello,", "world-wide..."], ["Hello", "world-wide"])
+    assert normalize_line("{laugh} oh {br}")[1] == ["{LG}", "oh", "{BR}"]
+    assert normalize_line("i mean--- it")[1] == ["i", "mean-", "it"]
+    assert normalize_line("") == ([], [])
+
+
+def test_decimal_points_are_kept():
+    # for numerals.py, which spells out 3.14 as THREE POINT ONE FOUR
+    assert normalize_line("pi is 3.14.") == (["pi", "is", "3.14."], ["pi", "is", "3.14"])
+    assert normalize_line("in 1.5, 2.25 or 3")[1] == ["in", "1.5", "2.25", "or", "3"]
+
+
+def test_floating_punctuation():
+    with pytest.raises(TranscriptError, match = "Floating punctuation"):
+        normalize_line("well ... ok")
+    # TranscriptError is a ValueError
+    with pytest.raises(ValueError):
+        normalize_line("the end !")
+
+
+def test_split_word():
+    assert split_word("twenty-two") == ["TWENTY", "TWO"]
+    assert split_word("don't") == ["DON'T"]
+    # only the first pair of a longer hyphenated word
+    assert split_word("something-or-other") == ["SOMETHING", "OR-OTHER"]
+    assert split_word("{LG}") == ["{LG}"]
+
+
+def test_iter_words():
+    lines = (line for line in ["Hello, twenty-two.", "{br} ok"])
+    assert list(iter_words(lines)) == [(0, "Hello,", ["HELLO"]), (0, "twenty-two.", ["TWENTY", "TWO"]),
+                                       (1, "{BR}", ["{BR}"]), (1, "ok", ["OK"])]
+
+
+def test_iter_words_names_the_line():
+    with pytest.raises(TranscriptError, match = "^line 1: Floating punctuation"):
+        list(iter_words(["fine", "not ... fine"]))
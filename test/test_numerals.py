@@ -0,0 +1,74 @@
+import threading
+
+import pytest
+
+from .. import align, numerals
+from ..numerals import NumberPronouncer
+
+# the spellings listed in numerals.py
+SPELLINGS = [("42", "FORTY TWO"),
+             ("4500", "FOUR THOUSAND FIVE HUNDRED"),
+             ("1984", "NINETEEN EIGHTY FOUR"),
+             ("1900", "NINETEEN HUNDRED"),
+             ("1905", "NINETEEN OH FIVE"),
+             ("1980S", "NINETEEN EIGHTY+S"),
+             ("1980'S", "NINETEEN EIGHTY+S"),
+             ("70S", "SEVENTY+S"),
+             ("21ST", "TWENTY FIRST"),
+             ("100TH", "ONE HUNDREDTH"),
+             ("3.14", "THREE POINT ONE FOUR"),
+             (".5", "POINT FIVE"),
+             ("2000", "TWO THOUSAND"),
+             ("0", "ZERO")]
+
+
+@pytest.mark.parametrize("token,words", SPELLINGS)
+def test_verbalize(token, words):
+    assert numerals.verbalize(token) == words.split()
+
+
+@pytest.mark.parametrize("token", ["BOB", "1980X", "3.", "1,000", "", "-4"])
+def test_not_numbers(token):
+    assert numerals.verbalize(token) is None
+
+
+def test_pronunciations_from_the_model_dictionary():
+    idx = align.load_dictionary(align.MODEL_DIR, local_dict = None)
+    pronouncer = NumberPronouncer.for_dictionary(idx)
+    assert NumberPronouncer.for_dictionary(idx) is pronouncer
+
+    assert pronouncer.pronounce("42") == "F AO1 R T IY0 T UW1"
+    assert pronouncer.pronounce("1905") == "N AY1 N T IY1 N OW1 F AY1 V"
+    # EIGHTIES is in the dictionary
+    assert pronouncer.pronounce("1980S") == "N AY1 N T IY1 N EY1 T IY0 Z"
+    assert pronouncer.pronounce("100TH") == "W AH1 N HH AH1 N D R AH0 D TH"
+    assert pronouncer.pronounce("3.14") == "TH R IY1 P OY1 N T W AH1 N F AO1 R"
+    assert pronouncer.pronounce("BOB") is None
+
+
+def test_plurals():
+    pronouncer = NumberPronouncer({"SIX": ["S IH1 K S"], "SIXES": ["S IH1 K S AH0 Z"], "TEN": ["T EH1 N"],
+                                   "SEVENTY": ["S EH1 V AH0 N T IY0"]})
+    assert pronouncer.pronounce("6S") == "S IH1 K S AH0 Z"
+    # no TENS or SEVENTIES: the singular and a Z
+    assert pronouncer.pronounce("10S") == "T EH1 N Z"
+    assert pronouncer.pronounce("70S") == "S EH1 V AH0 N T IY0 Z"
+    # a word of the spelling that isn't in the dictionary
+    assert pronouncer.pronounce("11") is None
+
+
+def test_threads_share_the_engine():
+    expected = {n: (numerals.number_to_words(n), numerals.number_to_words(n, ordinal = True))
+                for n in range(1000, 1200)}
+    wrong = []
+
+    def spell():
+        for n, words in expected.items():
+            if (numerals.number_to_words(n), numerals.number_to_words(n, ordinal = True)) != words:
+                wrong.append(n)
+    threads = [threading.Thread(target = spell) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert wrong == []
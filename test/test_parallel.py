@@ -0,0 +1,29 @@
+import os
+import signal
+import time
+
+from .. import parallel
+
+
+def fake_alignment(wavfile, trsfile, outfile, work_dir = 'tmp', timeout = None, **options):
+    # stands in for do_alignment in the (forked) workers
+    os.makedirs(work_dir)
+    time.sleep(0.2)
+    if wavfile == "crash.wav":
+        os.kill(os.getpid(), signal.SIGKILL)
+    return "aligned " + wavfile
+
+
+def test_dead_worker_fails_only_its_job(monkeypatch, tmp_path):
+    monkeypatch.setattr(parallel, "do_alignment", fake_alignment)
+    jobs = [("%d.wav" % i, "%d.json" % i, None) for i in range(6)]
+    jobs[2] = ("crash.wav", "crash.json", None)
+
+    results = parallel.align_parallel(jobs, processes = 3, work_root = str(tmp_path / "work"))
+
+    assert [r["wavfile"] for r in results] == [job[0] for job in jobs]
+    assert results[2]["error"] == "Worker process died"
+    for r in results[:2] + results[3:]:
+        assert r["error"] is None
+        assert r["alignment"] == "aligned " + r["wavfile"]
+    assert os.listdir(str(tmp_path / "work")) == []
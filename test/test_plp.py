@@ -0,0 +1,39 @@
+# The native front end against HCopy. The references are HCopy's features for
+# test/BREY00538.wav at the sample rate of each model, made with HTK 3.4 by
+#
+#   python -c "from p2fa_vislab.audio import prepare_wav; prepare_wav('test/BREY00538.wav', 'b.wav', SR)"
+#   echo "b.wav test/BREY00538_SR.plp" > b.scp && HCopy -C model/SR/config -S b.scp
+#
+# and a test is skipped until its reference is there.
+
+import os
+
+import pytest
+
+from .. import plp
+from ..audio import prepare_wav
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MODEL_DIR = os.path.join(os.path.dirname(HERE), "model")
+WAVFILE = os.path.join(HERE, "BREY00538.wav")
+
+# largest difference allowed in any coefficient, relative to its standard
+# deviation in the reference (HCopy's compressed files are good to about 1/32767
+# of the range of each coefficient)
+TOLERANCE = 0.01
+
+
+@pytest.mark.parametrize("SR", [8000, 11025, 16000])
+def test_features_match_hcopy(SR, tmp_path):
+    reference = os.path.join(HERE, "BREY00538_%d.plp" % SR)
+    if not os.path.exists(reference):
+        pytest.skip("no HCopy reference %s" % os.path.basename(reference))
+    wavfile = str(tmp_path / "b.wav")
+    prepare_wav(WAVFILE, wavfile, SR)
+
+    config = os.path.join(MODEL_DIR, str(SR), "config")
+    feats = plp.PLP.from_config(config).wav_features(wavfile)
+    theirs, samp_period, kind = plp.read_htk(reference)
+    assert feats.shape == theirs.shape
+    assert (samp_period, kind) == (100000, plp.parm_kind("PLP_0_D_A_Z"))
+    assert plp.compare(config, wavfile, reference).max() < TOLERANCE
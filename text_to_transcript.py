@@ -6,17 +6,13 @@ import simplejson as json
 import os.path
 
 import click
-import jsonschema
+
+from . import schemas
 
 
 def text_to_transcript(text_file, output_file = None, speaker_name = "Narrator"):
     text = open(text_file).read()
 
-    filedir = os.path.dirname(os.path.realpath(__file__))
-    schema_path = os.path.join(filedir, "alignment-schemas/transcript_schema.json")
-
-    transcript_schema = json.load(open(schema_path))
-
     paragraphs = text.split("\n\n")
     out = []
     for para in paragraphs:
@@ -27,7 +23,7 @@ def text_to_transcript(text_file, output_file = None, speaker_name = "Narrator")
         line = {"speaker": speaker_name, "line": para}
         out.append(line)
 
-    jsonschema.validate(out, transcript_schema)
+    schemas.validate("transcript", out)
     if output_file is None:
         print(json.dumps(out, indent = 4))
     else: